@@ -15,9 +15,9 @@ from src.llm.query_llm import OpenAI_LLM_v2
 from src.llm.prompt_builder import landmark_caption_prompt_builder, \
     route_planning_prompt_builder, parse_viewpoint_response_v2
 
-from airsim_plugin.airsim_settings import ObservationDirections
+from airsim_plugin.airsim_settings import ObservationDirections, AirsimActions, PanoCameraIds
 
-from utils.env_utils import getPoseAfterMakeActions, get_pano_observations, get_front_observations
+from utils.env_utils import getPoseAfterMakeAction, get_pano_observations, get_front_observations
 from utils.maps import build_semantic_map, visualize_semantic_point_cloud, update_camera_pose,\
     convert_global_pc, statistical_filter, find_closest_node, compute_shortest_path
 from utils.utils import calculate_movement_steps, calculate_movement_steps_mem, append_text_to_image
@@ -33,6 +33,7 @@ from scipy.spatial.transform import Rotation as R
 from evaluator.nav_evaluator import CityNavEvaluator
 
 from airsim_plugin.AirVLNSimulatorClientTool import AirVLNSimulatorClientTool
+from src.common.param import args
 
 
 def convert_airsim_pose(pose):
@@ -321,7 +322,7 @@ def explore_pipeline_by_sam(
     return int(step_size), new_pose, next_subgoal_found
 
 
-def CityNavAgent(scene_id, split, data_dir="./data", max_step_size=200, vlm_name="dino", record=False):
+def CityNavAgent(scene_id, split, data_dir="./data", max_step_size=200, vlm_name="dino", record=False, use_pano_cameras=False):
     data_root = os.path.join(data_dir, f"gt_by_env/{env_id}/{split}_landmk.json")
     graph_root = os.path.join(data_dir, f"mem_graphs_pruned/{env_id}/{split}")
     graph_act_root = os.path.join(data_dir, f'mem_graphs/{env_id}.pkl')
@@ -411,7 +412,7 @@ def CityNavAgent(scene_id, split, data_dir="./data", max_step_size=200, vlm_name
 
         # take off
         for _ in range(5):
-            new_pose = getPoseAfterMakeActions(curr_pose, [4])
+            new_pose = getPoseAfterMakeAction(curr_pose, AirsimActions.GO_UP)
             curr_pose = new_pose
             tool.setPoses([[curr_pose]])
 
@@ -420,7 +421,7 @@ def CityNavAgent(scene_id, split, data_dir="./data", max_step_size=200, vlm_name
             time_s = time.time()
             # get observation
             try:
-                pano_obs, pano_pose = get_pano_observations(curr_pose, tool, scene_id=scene_id)
+                pano_obs, pano_pose = get_pano_observations(curr_pose, tool, scene_id=scene_id, use_pano_cameras=use_pano_cameras)
                 pano_obs_imgs = [pano_obs[6][0], pano_obs[7][0], pano_obs[0][0], pano_obs[1][0], pano_obs[2][0], pano_obs[4][0]]
                 pano_obs_deps = [pano_obs[6][1], pano_obs[7][1], pano_obs[0][1], pano_obs[1][1], pano_obs[2][1], pano_obs[4][1]]
                 pano_obs_poses = [pano_pose[6], pano_pose[7], pano_pose[0], pano_pose[1], pano_pose[2], pano_pose[4]]
@@ -681,8 +682,13 @@ if __name__ == '__main__':
     split = "val_seen"
     save_demo = False
 
+    # the pano views come from the server's camera ring when it was started with --pano_camera_num
+    use_pano_cameras = int(args.pano_camera_num) > 0
+    if use_pano_cameras:
+        assert int(args.pano_camera_num) == len(PanoCameraIds), 'error args param: pano_camera_num'
+
     # 1. record path; 2. replay the path; 3. make demo video
-    CityNavAgent(env_id, split, max_step_size=60, vlm_name="sam", record=save_demo)
+    CityNavAgent(env_id, split, max_step_size=60, vlm_name="sam", record=save_demo, use_pano_cameras=use_pano_cameras)
     if save_demo:
         replay_path(f"./output/output_data_{env_id}.json", env_id, img_type='rgb')
         make_demo_video('./output/video', env_id=env_id, episode_id='3IRIK4HM3JIZ640FRHTYZU0EJ9Y6CH')
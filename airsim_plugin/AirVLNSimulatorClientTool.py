@@ -1,14 +1,15 @@
 import msgpackrpc
 import time
+import random
 import airsim
 import threading
-import random
 import copy
 import numpy as np
 import cv2
-import os
+from concurrent.futures import ThreadPoolExecutor
 
 from src.common.param import args
+from airsim_plugin.airsim_settings import PanoCameraIds
 
 from utils.logger import logger
 
@@ -37,14 +38,114 @@ class MyThread(threading.Thread):
             return None
 
 
+def decodeDepthVis(image_data_uint8, height: int, width: int) -> np.ndarray:
+    """
+    Decode a compressed DepthVis png response in memory.
+
+    The green channel is scaled to [0, 1] straight into a float32 (H, W, 1)
+    buffer, without a round trip through the filesystem.
+    """
+    img3d = cv2.imdecode(np.frombuffer(image_data_uint8, dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert img3d is not None, 'DEPTH图片解码错误'
+
+    img_depth = np.empty((height, width, 1), dtype=np.float32)
+    np.multiply(img3d[:, :, 1].reshape(height, width, 1), 1.0 / 255, out=img_depth, casting='unsafe')
+
+    return img_depth
+
+
+class SceneSlotError(Exception):
+    """
+    A machine is asked for more scenes than its server has slots (--max_scene_num),
+    reopening again cannot help
+    """
+    pass
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the n-th retry waits a random time
+    in [0, min(max_delay, base_delay * multiplier ** (n-1))].
+    """
+    def __init__(self, max_attempts=3, base_delay=0.1, max_delay=1.0, multiplier=2.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+
+    def get_delay(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (self.multiplier ** max(attempt - 1, 0)))
+        return random.uniform(0, delay)
+
+    def sleep(self, attempt: int) -> None:
+        time.sleep(self.get_delay(attempt))
+
+
+class CircuitBreaker:
+    """
+    Per-drone breaker. After failure_threshold failed calls in a row (each one
+    already retried with backoff by _runOnDrone) the drone is opened and its calls fail fast;
+    after reset_timeout seconds one trial call is let through (half open) and
+    closes the breaker again on success.
+    """
+    def __init__(self, failure_threshold=1, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failure_cnt = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        return time.time() - self.opened_at >= self.reset_timeout
+
+    def record_success(self) -> None:
+        self.failure_cnt = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failure_cnt += 1
+        if self.failure_cnt >= self.failure_threshold:
+            self.opened_at = time.time()
+
+
 class AirVLNSimulatorClientTool:
-    def __init__(self, machines_info) -> None:
+    def __init__(self, machines_info, retry_policy: RetryPolicy = None) -> None:
         self.machines_info = copy.deepcopy(machines_info)
         self.socket_clients = []
         self.airsim_clients = [[None for _ in list(item['open_scenes'])] for item in machines_info ]
+        self.airsim_addresses = [[None for _ in list(item['open_scenes'])] for item in machines_info ]
+        self.airsim_timeout = int(args.airsim_call_timeout)
+
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.circuit_breakers = [[CircuitBreaker() for _ in list(item['open_scenes'])] for item in machines_info ]
+
+        # one long-lived worker per drone, reused by every image / pose call
+        drone_num = sum([len(item['open_scenes']) for item in machines_info])
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(drone_num, 1),
+            thread_name_prefix='AirVLNSimulatorClientTool',
+        )
+
+        # (index_1, index_2) of the drones whose call failed in the last batched call
+        self.failed_drones = []
+
+        # wall time of the batched calls per machine, read by the scene placement
+        self.machine_step_time = [0.0 for _ in machines_info]
+        self.machine_step_cnt = [0 for _ in machines_info]
 
         self._init_check()
 
+    def __del__(self):
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        executor = getattr(self, '_executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+            self._executor = None
+
     def _init_check(self) -> None:
         ips = [item['MACHINE_IP'] for item in self.machines_info]
         assert len(ips) == len(set(ips)), 'MACHINE_IP repeat'
@@ -69,6 +170,154 @@ class AirVLNSimulatorClientTool:
 
         return
 
+    def _resetDrone(self, index_1: int, index_2: int) -> None:
+        """
+        Reconnect the AirSim client of one drone, the scene itself keeps running.
+        """
+        address = self.airsim_addresses[index_1][index_2]
+        if address is None:
+            raise Exception('drone {}-{} has no airsim address'.format(index_1, index_2))
+
+        logger.warning('重置无人机连接 {}-{}: {}:{}'.format(index_1, index_2, address[0], address[1]))
+        airsim_client = self.airsim_clients[index_1][index_2]
+        if airsim_client is not None:
+            try:
+                airsim_client.close()
+            except Exception as e:
+                pass
+
+        airsim_client = airsim.VehicleClient(ip=address[0], port=address[1], timeout_value=self.airsim_timeout)
+        airsim_client.confirmConnection()
+        self.airsim_clients[index_1][index_2] = airsim_client
+
+    def droneAvailable(self, index_1: int, index_2: int) -> bool:
+        """
+        False while the circuit breaker of the drone is open
+        """
+        return self.circuit_breakers[index_1][index_2].allow()
+
+    def _runOnDrone(self, index_1: int, index_2: int, func, func_args: tuple):
+        """
+        Call func(airsim_client, *func_args) for one drone behind its circuit breaker.
+
+        This is the only retry layer: the image / pose functions raise on their first
+        failure, a failed call resets this drone alone and is tried again with the backoff
+        of retry_policy. Each attempt is bounded by airsim_timeout, so a dead scene opens
+        the breaker within a few seconds and its later calls fail fast.
+        """
+        breaker = self.circuit_breakers[index_1][index_2]
+        if not breaker.allow():
+            raise Exception('drone {}-{} circuit open'.format(index_1, index_2))
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = func(self.airsim_clients[index_1][index_2], *func_args)
+                break
+            except Exception as e:
+                logger.error('drone {}-{} failed, attempt {}: {}'.format(index_1, index_2, attempt, e))
+                if attempt >= self.retry_policy.max_attempts:
+                    breaker.record_failure()
+                    raise
+
+            self.retry_policy.sleep(attempt)
+            try:
+                self._resetDrone(index_1, index_2)
+            except Exception as e:
+                logger.error('drone {}-{} reset failed: {}'.format(index_1, index_2, e))
+
+        breaker.record_success()
+        return result
+
+    def _runOnDrones(self, func, args_list: list, drones: list = None):
+        """
+        Submit func once per drone to the worker pool and wait for all of them.
+
+        :param func: called as func(airsim_client, *args) through _runOnDrone
+        :param args_list: nested as [machine][scene], one args tuple per drone without the airsim client
+        :param drones: (index_1, index_2) of the drones to run on, all drones if None
+        :return: (results nested like args_list, None for failed or skipped drones, True if every call succeeded)
+        """
+        if drones is not None:
+            drones = set([(int(index_1), int(index_2)) for index_1, index_2 in drones])
+
+        def _timed(index_1, index_2, func_args):
+            result = self._runOnDrone(index_1, index_2, func, func_args)
+            return result, time.time()
+
+        start = time.time()
+        futures = []
+        for index_1, _ in enumerate(args_list):
+            futures.append([])
+            for index_2, _ in enumerate(args_list[index_1]):
+                if drones is not None and (index_1, index_2) not in drones:
+                    futures[index_1].append(None)
+                    continue
+                futures[index_1].append(
+                    self._executor.submit(_timed, index_1, index_2, args_list[index_1][index_2])
+                )
+
+        results = []
+        failed_drones = []
+        for index_1, _ in enumerate(futures):
+            results.append([])
+            machine_ok = True
+            machine_end = start
+            for index_2, _ in enumerate(futures[index_1]):
+                result = None
+                if futures[index_1][index_2] is not None:
+                    try:
+                        result, end = futures[index_1][index_2].result()
+                        machine_end = max(machine_end, end)
+                    except Exception as e:
+                        logger.error(e)
+                        failed_drones.append((index_1, index_2))
+                        machine_ok = False
+                results[index_1].append(result)
+
+            # only whole-machine calls tell the scene placement how fast the machine steps
+            machine_ok = machine_ok and None not in futures[index_1]
+            if machine_ok and len(futures[index_1]) > 0 and index_1 < len(self.machine_step_time):
+                self.machine_step_time[index_1] += machine_end - start
+                self.machine_step_cnt[index_1] += 1
+
+        self.failed_drones = failed_drones
+        return results, len(failed_drones) == 0
+
+    def getMachineStepLatencies(self) -> list:
+        """
+        :return: mean seconds of one batched call per machine, None for machines without a successful call
+        """
+        return [
+            self.machine_step_time[index] / self.machine_step_cnt[index] if self.machine_step_cnt[index] > 0 else None
+            for index, _ in enumerate(self.machines_info)
+        ]
+
+    def _checkSceneSlots(self) -> None:
+        for index, socket_client in enumerate(self.socket_clients):
+            try:
+                max_scene_num = int(socket_client.call('get_max_scene_num'))
+            except Exception as e:
+                logger.warning('无法获取max_scene_num，机器{}: {}'.format(index, e))
+                continue
+
+            machine_info = self.machines_info[index]
+            scene_num = len([_ for _ in machine_info['open_scenes'] if _ is not None])
+            if int(machine_info['MAX_SCENE_NUM']) > max_scene_num:
+                logger.warning(
+                    'MAX_SCENE_NUM of {} is {}, but its server only has {} scene slots (--max_scene_num)'.format(
+                        machine_info['MACHINE_IP'], machine_info['MAX_SCENE_NUM'], max_scene_num,
+                    )
+                )
+            if scene_num > max_scene_num:
+                self._closeSocketConnection()
+                raise SceneSlotError(
+                    '{} scenes requested from {}, but its server only has {} scene slots (--max_scene_num)'.format(
+                        scene_num, machine_info['MACHINE_IP'], max_scene_num,
+                    )
+                )
+
     def _closeSocketConnection(self) -> None:
         socket_clients = self.socket_clients
 
@@ -93,7 +342,10 @@ class AirVLNSimulatorClientTool:
         self.airsim_clients = [[None for _ in list(item['open_scenes'])] for item in self.machines_info]
         return
 
-    def run_call(self, airsim_timeout: int=60) -> None:
+    def run_call(self, airsim_timeout: int=None) -> None:
+        if airsim_timeout is None:
+            airsim_timeout = self.airsim_timeout
+        self.airsim_timeout = airsim_timeout
         socket_clients = []
         for index, item in enumerate(self.machines_info):
             socket_clients.append(
@@ -106,16 +358,23 @@ class AirVLNSimulatorClientTool:
                 raise Exception('cannot establish socket')
 
         self.socket_clients = socket_clients
+        self._checkSceneSlots()
 
 
         before = time.time()
         self._closeConnection()
 
+        slot_errors = []
+
         def _run_command(index, socket_client: msgpackrpc.Client):
             logger.info(f'开始打开场景，机器{index}: {socket_client.address._host}:{socket_client.address._port}')
             result = socket_client.call('reopen_scenes', socket_client.address._host, self.machines_info[index]['open_scenes'])
 
             print(result)
+            if result[0] == False and result[1] is not None:
+                error = result[1].decode('utf-8') if isinstance(result[1], bytes) else str(result[1])
+                slot_errors.append(error)
+                raise SceneSlotError(error)
             if result[0] == False:
                 logger.error(f'打开场景失败，机器: {socket_client.address._host}:{socket_client.address._port}')
                 raise Exception('打开场景失败')
@@ -128,8 +387,10 @@ class AirVLNSimulatorClientTool:
             for i, port in enumerate(ports):
                 if self.machines_info[index]['open_scenes'][i] is None:
                     self.airsim_clients[index][i] = None
+                    self.airsim_addresses[index][i] = None
                 else:
                     self.airsim_clients[index][i] = airsim.VehicleClient(ip=ip, port=port, timeout_value=airsim_timeout)
+                    self.airsim_addresses[index][i] = (ip, port)
 
             logger.info(f'打开场景完毕，机器{index}: {socket_client.address._host}:{socket_client.address._port}')
             return
@@ -149,6 +410,8 @@ class AirVLNSimulatorClientTool:
             thread.get_result()
             thread_results.append(thread.flag_ok)
         threads = []
+        if len(slot_errors) > 0:
+            raise SceneSlotError('; '.join(slot_errors))
         if not (np.array(thread_results) == True).all():
             raise Exception('打开场景失败')
 
@@ -159,326 +422,357 @@ class AirVLNSimulatorClientTool:
         self._confirmConnection()
         self._closeSocketConnection()
 
-    def getImageResponses(self, get_rgb=True, get_depth=True, camera_id='front_0'):
+    def _getImages(self, airsim_client: airsim.VehicleClient, scen_id, get_rgb, get_depth, camera_id='front_0'):
+        if airsim_client is None:
+            raise Exception('error')
+            return None, None
+
+        img_rgb = None
+        img_depth = None
+
+        if not get_rgb and not get_depth:
+            return None, None
+
+        if scen_id in [1, 7]:
+            ImageRequest = []
+            if get_rgb:
+                ImageRequest.append(
+                    airsim.ImageRequest(camera_id, airsim.ImageType.Scene, pixels_as_float=False, compress=False)
+                )
+            if get_depth:
+                ImageRequest.append(
+                    airsim.ImageRequest(camera_id, airsim.ImageType.DepthVis, pixels_as_float=False, compress=True)
+                )
+
+            responses = airsim_client.simGetImages(ImageRequest, vehicle_name='Drone_1')
+
+            if get_rgb and get_depth:
+                response_rgb = responses[0]
+                response_depth = responses[1]
+            elif get_rgb and not get_depth:
+                response_rgb = responses[0]
+            elif not get_rgb and get_depth:
+                response_depth = responses[0]
 
-        def _getImages(airsim_client: airsim.VehicleClient, scen_id, get_rgb, get_depth, camera_id='front_0'):
-            if airsim_client is None:
-                raise Exception('error')
-                return None, None
 
             img_rgb = None
             img_depth = None
 
-            if not get_rgb and not get_depth:
-                return None, None
+            if get_rgb:
+                assert response_rgb.height == args.Image_Height_RGB and response_rgb.width == args.Image_Width_RGB, 'RGB图片size inconsistent'
 
-            if scen_id in [1, 7]:
-                time_sleep_cnt = 0
-                while True:
-                    try:
-                        ImageRequest = []
-                        if get_rgb:
-                            ImageRequest.append(
-                                airsim.ImageRequest(camera_id, airsim.ImageType.Scene, pixels_as_float=False, compress=False)
-                            )
-                        if get_depth:
-                            ImageRequest.append(
-                                airsim.ImageRequest(camera_id, airsim.ImageType.DepthVis, pixels_as_float=False, compress=True)
-                            )
-
-                        responses = airsim_client.simGetImages(ImageRequest, vehicle_name='Drone_1')
-
-                        if get_rgb and get_depth:
-                            response_rgb = responses[0]
-                            response_depth = responses[1]
-                        elif get_rgb and not get_depth:
-                            response_rgb = responses[0]
-                        elif not get_rgb and get_depth:
-                            response_depth = responses[0]
-                        else:
-                            break
-
-
-                        img_rgb = None
-                        img_depth = None
-
-                        if get_rgb:
-                            assert response_rgb.height == args.Image_Height_RGB and response_rgb.width == args.Image_Width_RGB, 'RGB图片size inconsistent'
-
-                            img1d = np.frombuffer(response_rgb.image_data_uint8, dtype=np.uint8)
-                            if args.run_type not in ['eval']:
-                                assert not (img1d.flatten()[0] == img1d).all(), 'RGB图片获取错误'
-                            img_rgb = img1d.reshape(response_rgb.height, response_rgb.width, 3)
-                            img_rgb = np.array(img_rgb)
-
-                        if get_depth:
-                            assert response_depth.height == args.Image_Height_DEPTH and response_depth.width == args.Image_Width_DEPTH, 'DEPTH图片size inconsistent'
-
-                            png_file_name = '/tmp/AirVLN_depth_{}_{}.png'.format(time.time(), random.randint(0, 10000))
-                            airsim.write_file(png_file_name, response_depth.image_data_uint8)
-                            img3d = cv2.imread(png_file_name)
-
-                            os.remove(png_file_name)
-
-                            img1d = img3d[:, :, 1]
-                            img1d = img1d.reshape(response_depth.height, response_depth.width, 1)
-
-                            obs_depth_img = img1d / 255
-
-                            img_depth = np.array(obs_depth_img, dtype=np.float32)
-
-                        break
-                    except:
-                        time_sleep_cnt += 1
-                        logger.error("图片获取错误")
-                        logger.error('time_sleep_cnt: {}'.format(time_sleep_cnt))
-                        time.sleep(1)
-
-                    if time_sleep_cnt > 20:
-                        raise Exception('图片获取失败')
-
-            else:
-                time_sleep_cnt = 0
-                while True:
-                    try:
-                        ImageRequest = []
-                        if get_rgb:
-                            ImageRequest.append(
-                                airsim.ImageRequest(camera_id, airsim.ImageType.Scene, pixels_as_float=False, compress=False)
-                            )
-                        if get_depth:
-                            ImageRequest.append(
-                                airsim.ImageRequest(camera_id, airsim.ImageType.DepthPerspective, pixels_as_float=True, compress=False)
-                            )
-
-                        responses = airsim_client.simGetImages(ImageRequest, vehicle_name='Drone_1')
-
-                        if get_rgb and get_depth:
-                            response_rgb = responses[0]
-                            response_depth = responses[1]
-                        elif get_rgb and not get_depth:
-                            response_rgb = responses[0]
-                        elif not get_rgb and get_depth:
-                            response_depth = responses[0]
-                        else:
-                            break
-
-                        if get_rgb:
-                            assert response_rgb.height == args.Image_Height_RGB and response_rgb.width == args.Image_Width_RGB, 'RGB图片获取错误'
-
-                            img1d = np.frombuffer(response_rgb.image_data_uint8, dtype=np.uint8)
-                            img_rgb = img1d.reshape(response_rgb.height, response_rgb.width, 3)
-                            img_rgb = np.array(img_rgb)
-
-                        if get_depth:
-                            assert response_depth.height == args.Image_Height_DEPTH and response_depth.width == args.Image_Width_DEPTH, 'DEPTH图片获取错误'
-
-                            depth_img_in_meters = airsim.list_to_2d_float_array(response_depth.image_data_float, response_depth.width, response_depth.height)
-                            if depth_img_in_meters.min() < 1e4:
-                                assert not (depth_img_in_meters.flatten()[0] == depth_img_in_meters).all(), 'DEPTH图片获取错误'
-                            depth_img_in_meters = depth_img_in_meters.reshape(response_depth.height, response_depth.width, 1)
-
-                            obs_depth_img = np.clip(depth_img_in_meters, 0, 100)
-                            obs_depth_img = obs_depth_img / 100
-                            # obs_depth_img = depth_img_in_meters
-                            img_depth = np.array(obs_depth_img, dtype=np.float32)
-
-                        break
-                    except:
-                        time_sleep_cnt += 1
-                        logger.error("图片获取错误")
-                        logger.error('time_sleep_cnt: {}'.format(time_sleep_cnt))
-                        time.sleep(1)
-
-                    if time_sleep_cnt > 20:
-                        raise Exception('图片获取失败')
-
-            return img_rgb, img_depth
+                img1d = np.frombuffer(response_rgb.image_data_uint8, dtype=np.uint8)
+                if args.run_type not in ['eval']:
+                    assert not (img1d.flatten()[0] == img1d).all(), 'RGB图片获取错误'
+                img_rgb = img1d.reshape(response_rgb.height, response_rgb.width, 3)
+                img_rgb = np.array(img_rgb)
 
-        threads = []
-        thread_results = []
-        for index_1 in range(len(self.airsim_clients)):
-            threads.append([])
-            for index_2 in range(len(self.airsim_clients[index_1])):
-                threads[index_1].append(
-                    MyThread(
-                        _getImages,
-                        (
-                            self.airsim_clients[index_1][index_2],
-                            self.machines_info[index_1]['open_scenes'][index_2],
-                            get_rgb, get_depth, camera_id))
+            if get_depth:
+                assert response_depth.height == args.Image_Height_DEPTH and response_depth.width == args.Image_Width_DEPTH, 'DEPTH图片size inconsistent'
+
+                img_depth = decodeDepthVis(response_depth.image_data_uint8, response_depth.height, response_depth.width)
+
+        else:
+            ImageRequest = []
+            if get_rgb:
+                ImageRequest.append(
+                    airsim.ImageRequest(camera_id, airsim.ImageType.Scene, pixels_as_float=False, compress=False)
                 )
-        for index_1, _ in enumerate(threads):
-            for index_2, _ in enumerate(threads[index_1]):
-                threads[index_1][index_2].setDaemon(True)
-                threads[index_1][index_2].start()
-        for index_1, _ in enumerate(threads):
-            for index_2, _ in enumerate(threads[index_1]):
-                threads[index_1][index_2].join()
-
-        responses = []
-        for index_1, _ in enumerate(threads):
-            responses.append([])
-            for index_2, _ in enumerate(threads[index_1]):
-                responses[index_1].append(
-                    threads[index_1][index_2].get_result()
+            if get_depth:
+                ImageRequest.append(
+                    airsim.ImageRequest(camera_id, airsim.ImageType.DepthPerspective, pixels_as_float=True, compress=False)
                 )
-                thread_results.append(threads[index_1][index_2].flag_ok)
-        threads = []
-        if not (np.array(thread_results) == True).all():
-            logger.error('getImageResponses失败')
-            return None
 
-        return responses
+            responses = airsim_client.simGetImages(ImageRequest, vehicle_name='Drone_1')
+
+            if get_rgb and get_depth:
+                response_rgb = responses[0]
+                response_depth = responses[1]
+            elif get_rgb and not get_depth:
+                response_rgb = responses[0]
+            elif not get_rgb and get_depth:
+                response_depth = responses[0]
+
+            if get_rgb:
+                assert response_rgb.height == args.Image_Height_RGB and response_rgb.width == args.Image_Width_RGB, 'RGB图片获取错误'
+
+                img1d = np.frombuffer(response_rgb.image_data_uint8, dtype=np.uint8)
+                img_rgb = img1d.reshape(response_rgb.height, response_rgb.width, 3)
+                img_rgb = np.array(img_rgb)
+
+            if get_depth:
+                assert response_depth.height == args.Image_Height_DEPTH and response_depth.width == args.Image_Width_DEPTH, 'DEPTH图片获取错误'
+
+                depth_img_in_meters = airsim.list_to_2d_float_array(response_depth.image_data_float, response_depth.width, response_depth.height)
+                if depth_img_in_meters.min() < 1e4:
+                    assert not (depth_img_in_meters.flatten()[0] == depth_img_in_meters).all(), 'DEPTH图片获取错误'
+                depth_img_in_meters = depth_img_in_meters.reshape(response_depth.height, response_depth.width, 1)
+
+                obs_depth_img = np.clip(depth_img_in_meters, 0, 100)
+                obs_depth_img = obs_depth_img / 100
+                # obs_depth_img = depth_img_in_meters
+                img_depth = np.array(obs_depth_img, dtype=np.float32)
+
+        return img_rgb, img_depth
+
+    def _getImages_v2(self, airsim_client: airsim.VehicleClient, scen_id, get_rgb, get_depth, camera_id='front_0'):
+        if airsim_client is None:
+            raise Exception('error')
+            return None, None
+
+        img_rgb = None
+        img_depth = None
+
+        if not get_rgb and not get_depth:
+            return None, None
+
+        ImageRequest = []
+        if get_rgb:
+            ImageRequest.append(
+                airsim.ImageRequest(camera_id, airsim.ImageType.Scene, pixels_as_float=False, compress=False)
+            )
+        if get_depth:
+            ImageRequest.append(
+                airsim.ImageRequest(camera_id, airsim.ImageType.DepthPlanar, pixels_as_float=True, compress=False)
+            )
 
+        responses = airsim_client.simGetImages(ImageRequest, vehicle_name='Drone_1')
 
-    def getImageResponses_v2(self, get_rgb=True, get_depth=True, camera_id='front_0'):
+        if get_rgb and get_depth:
+            response_rgb = responses[0]
+            response_depth = responses[1]
+        elif get_rgb and not get_depth:
+            response_rgb = responses[0]
+        elif not get_rgb and get_depth:
+            response_depth = responses[0]
 
-        def _getImages(airsim_client: airsim.VehicleClient, scen_id, get_rgb, get_depth, camera_id='front_0'):
-            if airsim_client is None:
-                raise Exception('error')
-                return None, None
+        if get_rgb:
+            assert response_rgb.height == args.Image_Height_RGB and response_rgb.width == args.Image_Width_RGB, 'RGB图片获取错误'
 
+            img1d = np.frombuffer(response_rgb.image_data_uint8, dtype=np.uint8)
+            img_rgb = img1d.reshape(response_rgb.height, response_rgb.width, 3)
+            img_rgb = np.array(img_rgb)
+
+        if get_depth:
+            assert response_depth.height == args.Image_Height_DEPTH and response_depth.width == args.Image_Width_DEPTH, 'DEPTH图片获取错误'
+
+            depth_img_in_meters = airsim.list_to_2d_float_array(response_depth.image_data_float, response_depth.width, response_depth.height)
+            if depth_img_in_meters.min() < 1e4:
+                assert not (depth_img_in_meters.flatten()[0] == depth_img_in_meters).all(), 'DEPTH图片获取错误'
+            depth_img_in_meters = depth_img_in_meters.reshape(response_depth.height, response_depth.width, 1)
+
+            obs_depth_img = np.clip(depth_img_in_meters, 0, 300)
+            obs_depth_img = obs_depth_img / 300
+            # obs_depth_img = depth_img_in_meters
+            img_depth = np.array(obs_depth_img, dtype=np.float32)
+
+        return img_rgb, img_depth
+
+    def _getPanoImages(self, airsim_client: airsim.VehicleClient, scen_id, get_rgb, get_depth, camera_ids=PanoCameraIds):
+        if airsim_client is None:
+            raise Exception('error')
+            return None
+
+        if not get_rgb and not get_depth:
+            return [(None, None) for _ in camera_ids]
+
+        ImageRequest = []
+        for camera_id in camera_ids:
+            if get_rgb:
+                ImageRequest.append(
+                    airsim.ImageRequest(camera_id, airsim.ImageType.Scene, pixels_as_float=False, compress=False)
+                )
+            if get_depth:
+                if scen_id in [1, 7]:
+                    ImageRequest.append(
+                        airsim.ImageRequest(camera_id, airsim.ImageType.DepthVis, pixels_as_float=False, compress=True)
+                    )
+                else:
+                    ImageRequest.append(
+                        airsim.ImageRequest(camera_id, airsim.ImageType.DepthPlanar, pixels_as_float=True, compress=False)
+                    )
+
+        responses = airsim_client.simGetImages(ImageRequest, vehicle_name='Drone_1')
+        assert len(responses) == len(ImageRequest), 'pano图片数量错误'
+
+        pano_images = []
+        index = 0
+        for _ in camera_ids:
             img_rgb = None
             img_depth = None
 
-            if not get_rgb and not get_depth:
-                return None, None
-
-            time_sleep_cnt = 0
-            while True:
-                try:
-                    ImageRequest = []
-                    if get_rgb:
-                        ImageRequest.append(
-                            airsim.ImageRequest(camera_id, airsim.ImageType.Scene, pixels_as_float=False, compress=False)
-                        )
-                    if get_depth:
-                        ImageRequest.append(
-                            airsim.ImageRequest(camera_id, airsim.ImageType.DepthPlanar, pixels_as_float=True, compress=False)
-                        )
-
-                    responses = airsim_client.simGetImages(ImageRequest, vehicle_name='Drone_1')
-
-                    if get_rgb and get_depth:
-                        response_rgb = responses[0]
-                        response_depth = responses[1]
-                    elif get_rgb and not get_depth:
-                        response_rgb = responses[0]
-                    elif not get_rgb and get_depth:
-                        response_depth = responses[0]
-                    else:
-                        break
-
-                    if get_rgb:
-                        assert response_rgb.height == args.Image_Height_RGB and response_rgb.width == args.Image_Width_RGB, 'RGB图片获取错误'
-
-                        img1d = np.frombuffer(response_rgb.image_data_uint8, dtype=np.uint8)
-                        img_rgb = img1d.reshape(response_rgb.height, response_rgb.width, 3)
-                        img_rgb = np.array(img_rgb)
-
-                    if get_depth:
-                        assert response_depth.height == args.Image_Height_DEPTH and response_depth.width == args.Image_Width_DEPTH, 'DEPTH图片获取错误'
-
-                        depth_img_in_meters = airsim.list_to_2d_float_array(response_depth.image_data_float, response_depth.width, response_depth.height)
-                        if depth_img_in_meters.min() < 1e4:
-                            assert not (depth_img_in_meters.flatten()[0] == depth_img_in_meters).all(), 'DEPTH图片获取错误'
-                        depth_img_in_meters = depth_img_in_meters.reshape(response_depth.height, response_depth.width, 1)
-
-                        obs_depth_img = np.clip(depth_img_in_meters, 0, 300)
-                        obs_depth_img = obs_depth_img / 300
-                        # obs_depth_img = depth_img_in_meters
-                        img_depth = np.array(obs_depth_img, dtype=np.float32)
-
-                    break
-                except:
-                    time_sleep_cnt += 1
-                    logger.error("图片获取错误")
-                    logger.error('time_sleep_cnt: {}'.format(time_sleep_cnt))
-                    time.sleep(1)
-
-                if time_sleep_cnt > 20:
-                    raise Exception('图片获取失败')
-
-            return img_rgb, img_depth
+            if get_rgb:
+                response_rgb = responses[index]
+                index += 1
+                assert response_rgb.height == args.Image_Height_RGB and response_rgb.width == args.Image_Width_RGB, 'RGB图片获取错误'
 
-        threads = []
-        thread_results = []
-        for index_1 in range(len(self.airsim_clients)):
-            threads.append([])
-            for index_2 in range(len(self.airsim_clients[index_1])):
-                threads[index_1].append(
-                    MyThread(
-                        _getImages,
-                        (
-                            self.airsim_clients[index_1][index_2],
-                            self.machines_info[index_1]['open_scenes'][index_2],
-                            get_rgb, get_depth, camera_id))
-                )
-        for index_1, _ in enumerate(threads):
-            for index_2, _ in enumerate(threads[index_1]):
-                threads[index_1][index_2].setDaemon(True)
-                threads[index_1][index_2].start()
-        for index_1, _ in enumerate(threads):
-            for index_2, _ in enumerate(threads[index_1]):
-                threads[index_1][index_2].join()
-
-        responses = []
-        for index_1, _ in enumerate(threads):
-            responses.append([])
-            for index_2, _ in enumerate(threads[index_1]):
-                responses[index_1].append(
-                    threads[index_1][index_2].get_result()
-                )
-                thread_results.append(threads[index_1][index_2].flag_ok)
-        threads = []
-        if not (np.array(thread_results) == True).all():
+                img1d = np.frombuffer(response_rgb.image_data_uint8, dtype=np.uint8)
+                img_rgb = img1d.reshape(response_rgb.height, response_rgb.width, 3)
+                img_rgb = np.array(img_rgb)
+
+            if get_depth:
+                response_depth = responses[index]
+                index += 1
+                assert response_depth.height == args.Image_Height_DEPTH and response_depth.width == args.Image_Width_DEPTH, 'DEPTH图片获取错误'
+
+                if scen_id in [1, 7]:
+                    img_depth = decodeDepthVis(response_depth.image_data_uint8, response_depth.height, response_depth.width)
+                else:
+                    depth_img_in_meters = airsim.list_to_2d_float_array(response_depth.image_data_float, response_depth.width, response_depth.height)
+                    if depth_img_in_meters.min() < 1e4:
+                        assert not (depth_img_in_meters.flatten()[0] == depth_img_in_meters).all(), 'DEPTH图片获取错误'
+                    depth_img_in_meters = depth_img_in_meters.reshape(response_depth.height, response_depth.width, 1)
+
+                    obs_depth_img = np.clip(depth_img_in_meters, 0, 300)
+                    obs_depth_img = obs_depth_img / 300
+                    img_depth = np.array(obs_depth_img, dtype=np.float32)
+
+            pano_images.append((img_rgb, img_depth))
+
+        return pano_images
+
+    def getImageResponses(self, get_rgb=True, get_depth=True, camera_id='front_0', drones=None):
+        responses, flag_ok = self._runOnDrones(
+            self._getImages,
+            [
+                [
+                    (
+                        self.machines_info[index_1]['open_scenes'][index_2],
+                        get_rgb, get_depth, camera_id)
+                    for index_2 in range(len(self.airsim_clients[index_1]))
+                ]
+                for index_1 in range(len(self.airsim_clients))
+            ],
+            drones=drones,
+        )
+        if drones is not None:
+            return responses
+        if not flag_ok:
             logger.error('getImageResponses失败')
             return None
 
         return responses
 
 
-    def setPoses(self, poses: list) -> bool:
-        def _setPoses(airsim_client: airsim.VehicleClient, pose: airsim.Pose) -> None:
-            if airsim_client is None:
-                raise Exception('error')
-                return
+    def getImageResponses_v2(self, get_rgb=True, get_depth=True, camera_id='front_0', drones=None):
+        responses, flag_ok = self._runOnDrones(
+            self._getImages_v2,
+            [
+                [
+                    (
+                        self.machines_info[index_1]['open_scenes'][index_2],
+                        get_rgb, get_depth, camera_id)
+                    for index_2 in range(len(self.airsim_clients[index_1]))
+                ]
+                for index_1 in range(len(self.airsim_clients))
+            ],
+            drones=drones,
+        )
+        if drones is not None:
+            return responses
+        if not flag_ok:
+            logger.error('getImageResponses失败')
+            return None
 
-            airsim_client.simSetVehiclePose(
-                pose=pose,
-                ignore_collision=False,
-                vehicle_name='Drone_1',
-            )
+        return responses
+
+
+    def getPanoImageResponses(self, get_rgb=True, get_depth=True, camera_ids=PanoCameraIds):
+        """
+        Fetch every view of the pano camera ring with one simGetImages call per drone.
+
+        The scene has to be opened by a server started with --pano_camera_num.
+        Each drone entry is a list of (rgb, depth), one per camera in camera_ids.
+        """
+        responses, flag_ok = self._runOnDrones(
+            self._getPanoImages,
+            [
+                [
+                    (
+                        self.machines_info[index_1]['open_scenes'][index_2],
+                        get_rgb, get_depth, camera_ids)
+                    for index_2 in range(len(self.airsim_clients[index_1]))
+                ]
+                for index_1 in range(len(self.airsim_clients))
+            ]
+        )
+        if not flag_ok:
+            logger.error('getPanoImageResponses失败')
+            return None
+
+        return responses
 
+    def _setPose(self, airsim_client: airsim.VehicleClient, pose: airsim.Pose) -> None:
+        if airsim_client is None:
+            raise Exception('error')
             return
 
-        threads = []
-        thread_results = []
-        for index_1 in range(len(self.airsim_clients)):
-            threads.append([])
-            for index_2 in range(len(self.airsim_clients[index_1])):
-                threads[index_1].append(
-                    MyThread(_setPoses, (self.airsim_clients[index_1][index_2], poses[index_1][index_2]))
-                )
-        for index_1, _ in enumerate(threads):
-            for index_2, _ in enumerate(threads[index_1]):
-                threads[index_1][index_2].setDaemon(True)
-                threads[index_1][index_2].start()
-        for index_1, _ in enumerate(threads):
-            for index_2, _ in enumerate(threads[index_1]):
-                threads[index_1][index_2].join()
-        for index_1, _ in enumerate(threads):
-            for index_2, _ in enumerate(threads[index_1]):
-                threads[index_1][index_2].get_result()
-                thread_results.append(threads[index_1][index_2].flag_ok)
-        threads = []
-        if not (np.array(thread_results) == True).all():
+        airsim_client.simSetVehiclePose(
+            pose=pose,
+            ignore_collision=False,
+            vehicle_name='Drone_1',
+        )
+
+        return
+
+    def _setPoseAndGetImages(self, airsim_client: airsim.VehicleClient, scen_id, pose: airsim.Pose, get_rgb, get_depth, camera_id='front_0', use_v2=False):
+        self._setPose(airsim_client, pose)
+
+        if use_v2:
+            return self._getImages_v2(airsim_client, scen_id, get_rgb, get_depth, camera_id)
+        else:
+            return self._getImages(airsim_client, scen_id, get_rgb, get_depth, camera_id)
+
+    def setPoses(self, poses: list, drones=None) -> bool:
+        _, flag_ok = self._runOnDrones(
+            self._setPose,
+            [
+                [
+                    (poses[index_1][index_2],)
+                    for index_2 in range(len(self.airsim_clients[index_1]))
+                ]
+                for index_1 in range(len(self.airsim_clients))
+            ],
+            drones=drones,
+        )
+        if not flag_ok:
             logger.error('setPoses失败')
             return False
 
         return True
 
+    def stepAndObserve(self, poses: list, get_rgb=True, get_depth=True, camera_id='front_0', use_v2=False, drones=None):
+        """
+        Set the poses and fetch the observations of every drone in one fan-out.
+
+        Each worker sets its drone pose and immediately requests the images,
+        so a step costs one pass over the clients instead of setPoses followed
+        by getImageResponses. Returns None if any drone fails, like
+        getImageResponses; with `drones` given only those drones run and the
+        failed ones are None in the result and listed in failed_drones.
+        """
+        responses, flag_ok = self._runOnDrones(
+            self._setPoseAndGetImages,
+            [
+                [
+                    (
+                        self.machines_info[index_1]['open_scenes'][index_2],
+                        poses[index_1][index_2],
+                        get_rgb, get_depth, camera_id, use_v2)
+                    for index_2 in range(len(self.airsim_clients[index_1]))
+                ]
+                for index_1 in range(len(self.airsim_clients))
+            ],
+            drones=drones,
+        )
+        if drones is not None:
+            return responses
+        if not flag_ok:
+            logger.error('stepAndObserve失败')
+            return None
+
+        return responses
+
     def closeScenes(self):
         try:
             socket_clients = []
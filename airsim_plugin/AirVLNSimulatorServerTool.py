@@ -11,6 +11,7 @@ import subprocess
 import errno
 import signal
 import copy
+from collections import OrderedDict
 
 
 AIRSIM_SETTINGS_TEMPLATE = {
@@ -65,7 +66,21 @@ AIRSIM_SETTINGS_TEMPLATE = {
 }
 
 
-def create_drones(drone_num_per_env=1, show_scene=False, uav_mode=False) -> dict:
+def create_pano_cameras(capture_settings: list, pano_camera_num=8) -> dict:
+    # ring of cameras sharing the drone origin, yaw step 360 / pano_camera_num degrees
+    # pano sequence: front, slightly right, right, slightly back right, back, ...
+    cameras = {}
+    for i in range(pano_camera_num):
+        cameras['pano_' + str(i)] = {
+            "CaptureSettings": copy.deepcopy(capture_settings),
+            "X": 0, "Y": 0, "Z": 0,
+            "Pitch": 0, "Roll": 0, "Yaw": 360 / pano_camera_num * i
+        }
+
+    return cameras
+
+
+def create_drones(drone_num_per_env=1, show_scene=False, uav_mode=False, pano_camera_num=0) -> dict:
     img_height = 512
     img_width = 512
     FOV = 90
@@ -198,6 +213,11 @@ def create_drones(drone_num_per_env=1, show_scene=False, uav_mode=False) -> dict
             "Pitch": 0, "Roll": 0, "Yaw": 0
         }
 
+        if pano_camera_num > 0:
+            drone['Cameras'].update(
+                create_pano_cameras(drone['Cameras']['front_0']['CaptureSettings'], pano_camera_num)
+            )
+
         if airsim_settings['SimMode'] == 'ComputerVision':
             drone['VehicleType'] = 'ComputerVision'
         elif airsim_settings['SimMode'] == 'Multirotor':
@@ -294,6 +314,44 @@ def KillPid(pid) -> None:
     return
 
 
+def FromPidGetChildPids(pid: int) -> list:
+    subprocess_execute = "pgrep -P {}".format(
+        pid,
+    )
+
+    try:
+        output = subprocess.check_output(subprocess_execute, shell=True)
+    except:
+        return []
+
+    child_pids = []
+    for line in output.split():
+        try:
+            child_pid = int(line)
+        except:
+            continue
+        child_pids.append(child_pid)
+        child_pids += FromPidGetChildPids(child_pid)
+
+    return child_pids
+
+
+def KillProcessTree(p: subprocess.Popen) -> None:
+    for child_pid in FromPidGetChildPids(p.pid):
+        try:
+            os.kill(child_pid, signal.SIGKILL)
+        except:
+            pass
+
+    try:
+        p.kill()
+        p.wait(timeout=5)
+    except:
+        pass
+
+    return
+
+
 def KillPorts(ports) -> None:
     threads = []
 
@@ -345,6 +403,44 @@ def KillAirVLN() -> None:
     return
 
 
+def ProbeAirsimPort(ip: str, port: int, timeout: int = 2) -> bool:
+    """
+    Check whether the AirSim api server of a scene answers ping on its port.
+    """
+    client = None
+    try:
+        client = msgpackrpc.Client(msgpackrpc.Address(ip, port), timeout=timeout, reconnect_limit=1)
+        return bool(client.call('ping'))
+    except:
+        return False
+    finally:
+        if client is not None:
+            try:
+                client.close()
+            except:
+                pass
+
+
+def WaitSceneReady(ip: str, port: int, p: subprocess.Popen, startup_timeout: float, probe_interval: float = 0.5):
+    """
+    Probe the AirSim port of a launched scene until it answers, its launcher exits
+    with an error, or startup_timeout seconds have passed.
+
+    :return: (ready, startup time in seconds)
+    """
+    start_time = time.time()
+    while time.time() - start_time < startup_timeout:
+        if ProbeAirsimPort(ip, port, timeout=max(1, int(probe_interval * 4))):
+            return True, time.time() - start_time
+
+        if p is not None and p.poll() is not None and p.returncode != 0:
+            break
+
+        time.sleep(probe_interval)
+
+    return False, time.time() - start_time
+
+
 class EventHandler(object):
     def __init__(self):
         scene_ports = []
@@ -354,142 +450,225 @@ class EventHandler(object):
             )
         self.scene_ports = scene_ports
 
+        self.max_scene_num = MAX_SCENE_NUM
+
         scene_gpus = []
-        while len(scene_gpus) < 100:
+        while len(scene_gpus) < max(100, self.max_scene_num):
             scene_gpus += GPU_IDS.copy()
         self.scene_gpus = scene_gpus
 
-        self.scene_used_ports = []
+        # warm scene pool, port -> {'scene_id', 'slot'}, ordered from least to most recently used
+        # a slot is one of the max_scene_num GPU places a scene can run in
+        self.scene_pool = OrderedDict()
 
     def ping(self) -> bool:
         return True
 
-    def _open_scenes(self, ip: str , scen_ids: list):
-        print(
-            "{}\t关闭场景中".format(
-                str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
-            )
-        )
-        KillPorts(self.scene_used_ports)
-        self.scene_used_ports = []
-        # KillAirVLN()
-        print(
-            "{}\t已关闭所有场景".format(
-                str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+    def get_max_scene_num(self) -> int:
+        return self.max_scene_num
+
+    def _refresh_scene_pool(self) -> None:
+        # forget scenes that are no longer listening on their port
+        for port in list(self.scene_pool.keys()):
+            pid = FromPortGetPid(port)
+            if pid is None or not isinstance(pid, int):
+                print(
+                    "{}\t场景{}已退出\tport:{}".format(
+                        str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+                        self.scene_pool[port]['scene_id'],
+                        port,
+                    )
+                )
+                del self.scene_pool[port]
+
+    def _evict_scenes(self, num: int, keep_ports: list) -> None:
+        evict_ports = []
+        for port in self.scene_pool.keys():
+            if len(evict_ports) >= num:
+                break
+            if port in keep_ports:
+                continue
+            evict_ports.append(port)
+
+        if len(evict_ports) < num:
+            raise Exception('not enough scene slots, max_scene_num: {}'.format(self.max_scene_num))
+
+        for port in evict_ports:
+            print(
+                "{}\t释放场景{}\tport:{}".format(
+                    str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+                    self.scene_pool[port]['scene_id'],
+                    port,
+                )
             )
-        )
+        KillPorts(evict_ports)
+        for port in evict_ports:
+            del self.scene_pool[port]
 
+    def _open_scenes(self, ip: str , scen_ids: list):
+        # more scenes than slots can never be opened, tell the client instead of failing every retry
+        scene_num = len([scen_id for scen_id in scen_ids if str(scen_id).lower() != 'none'])
+        if scene_num > self.max_scene_num:
+            error = 'not enough scene slots, requested: {}, max_scene_num: {}'.format(scene_num, self.max_scene_num)
+            print(error)
+            return False, error
+
+        self._refresh_scene_pool()
+
+        # reuse running scenes 1
+        ports = [None for _ in scen_ids]
+        for index, scen_id in enumerate(scen_ids):
+            if str(scen_id).lower() == 'none':
+                continue
 
-        # Occupied airsim port 1
-        ports = []
-        index = 0
-        while len(ports) < len(scen_ids):
-            pid = FromPortGetPid(self.scene_ports[index])
-            if pid is None or not isinstance(pid, int):
-                ports.append(self.scene_ports[index])
-            index += 1
+            for port, item in list(self.scene_pool.items()):
+                if str(item['scene_id']) == str(scen_id) and port not in ports:
+                    # a scene that still listens may be hung, only reuse it if its api answers
+                    if not ProbeAirsimPort(ip, port, timeout=SCENE_PROBE_TIMEOUT):
+                        print(
+                            "{}\t场景{}无响应,重新打开\tport:{}".format(
+                                str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+                                scen_id,
+                                port,
+                            )
+                        )
+                        KillPorts([port])
+                        del self.scene_pool[port]
+                        continue
 
-        KillPorts(ports)
+                    ports[index] = port
+                    print(
+                        "{}\t复用第{}个场景(场景{})\tport:{}".format(
+                            str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+                            index,
+                            scen_id,
+                            port,
+                        )
+                    )
+                    break
 
+        reuse_ports = [port for port in ports if port is not None]
+        launch_indexes = [
+            index for index, scen_id in enumerate(scen_ids)
+            if ports[index] is None and str(scen_id).lower() != 'none'
+        ]
 
-        # Occupied GPU 2
-        gpus = [self.scene_gpus[index] for index in range(len(scen_ids))]
 
+        # evict least recently used scenes when GPU slots run out 2
+        overflow_num = len(self.scene_pool) + len(launch_indexes) - self.max_scene_num
+        if overflow_num > 0:
+            self._evict_scenes(overflow_num, reuse_ports)
 
-        # search scene path 3
-        choose_env_exe_paths = []
-        for scen_id in scen_ids:
-            if str(scen_id).lower() == 'none':
-                choose_env_exe_paths.append(None)
+
+        # Occupied airsim port 3
+        index = 0
+        for i in range(len(scen_ids)):
+            if ports[i] is not None:
                 continue
 
+            while ports[i] is None:
+                port = self.scene_ports[index]
+                index += 1
+                if port in self.scene_pool.keys():
+                    continue
+
+                pid = FromPortGetPid(port)
+                if pid is None or not isinstance(pid, int):
+                    ports[i] = port
+
+
+        # Occupied GPU 4
+        used_slots = [item['slot'] for item in self.scene_pool.values()]
+        free_slots = [slot for slot in range(self.max_scene_num) if slot not in used_slots]
+        slots = {}
+        for i, index in enumerate(launch_indexes):
+            slots[index] = free_slots[i]
+        gpus = {index: self.scene_gpus[slot] for index, slot in slots.items()}
+
+
+        # search scene path 5
+        choose_env_exe_paths = {}
+        for index in launch_indexes:
+            scen_id = scen_ids[index]
+
             res = glob.glob((str(SEARCH_ENVs_PATH) + '/**/' + 'env_' + str(scen_id) + '/LinuxNoEditor/AirVLN.sh'), recursive=True)
             if len(res) > 0:
-                choose_env_exe_paths.append(res[0])
+                choose_env_exe_paths[index] = res[0]
             else:
                 print(f'can not find scene file: {scen_id}')
                 raise KeyError
 
 
-        p_s = []
-        for index in range(len(scen_ids)):
-            # airsim settings 4
-            airsim_settings = create_drones()
+        p_s = {}
+        for index in launch_indexes:
+            # airsim settings 6
+            settings_dir = CWD_DIR / 'airsim_plugin/settings' / str(slots[index]+1)
+            airsim_settings = create_drones(pano_camera_num=PANO_CAMERA_NUM)
             airsim_settings['ApiServerPort'] = int(ports[index])
             airsim_settings_write_content = json.dumps(airsim_settings)
-            if not os.path.exists(str(CWD_DIR / 'airsim_plugin/settings' / str(index+1))):
-                os.makedirs(str(CWD_DIR / 'airsim_plugin/settings' / str(index+1)), exist_ok=True)
-            with open(str(CWD_DIR / 'airsim_plugin/settings' / str(index+1) / 'settings.json'), 'w', encoding='utf-8') as dump_f:
+            if not os.path.exists(str(settings_dir)):
+                os.makedirs(str(settings_dir), exist_ok=True)
+            with open(str(settings_dir / 'settings.json'), 'w', encoding='utf-8') as dump_f:
                 dump_f.write(airsim_settings_write_content)
 
 
-            # open scene 5
-            if choose_env_exe_paths[index] is None:
-                p_s.append(None)
-                continue
-            else:
-                subprocess_execute = "bash {} -RenderOffscreen -NoSound -NoVSync -GraphicsAdapter={} --settings {} ".format(
-                    choose_env_exe_paths[index],
-                    gpus[index],
-                    str(CWD_DIR / 'airsim_plugin/settings' / str(index+1) / 'settings.json'),
-                )
-
-                try:
-                    p = subprocess.Popen(
-                        subprocess_execute,
-                        stdin=None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                        shell=True,
-                    )
-                    p_s.append(p)
-                except Exception as e:
-                    print(
-                        "{}\t{}".format(
-                            str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
-                            e,
-                        )
-                    )
-                    return False, None
-                except:
-                    return False, None
-        time.sleep(3)
-
-        # check
-        threads = []
+            # open scene 7
+            subprocess_execute = "bash {} -RenderOffscreen -NoSound -NoVSync -GraphicsAdapter={} --settings {} ".format(
+                choose_env_exe_paths[index],
+                gpus[index],
+                str(settings_dir / 'settings.json'),
+            )
 
-        def _check_scene(index, p):
-            if p is None:
+            try:
+                p = subprocess.Popen(
+                    subprocess_execute,
+                    stdin=None, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                    shell=True,
+                )
+                p_s[index] = p
+            except Exception as e:
                 print(
-                    "{}\t打开第{}个场景(场景{})\tgpu:{}".format(
+                    "{}\t{}".format(
                         str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
-                        index,
-                        None,
-                        gpus[index],
+                        e,
                     )
                 )
-                return
+                return False, None
+            except:
+                return False, None
 
-            for line in iter(p.stdout.readline, b''):
-                if 'Drone_' in str(line):
-                    break
+        # check 8
+        threads = []
+        ready = {}
 
-            try:
-                p.terminate()
-                # os.system(("kill -9 {}".format(p.pid)))
-                os.kill(p.pid, signal.SIGKILL)
-            except:
-                pass
+        def _check_scene(index, p):
+            ready[index], startup_time = WaitSceneReady(ip, ports[index], p, SCENE_STARTUP_TIMEOUT)
+
+            if not ready[index]:
+                # a hung scene may never bind its port, so kill it through the launcher
+                KillProcessTree(p)
+            else:
+                try:
+                    p.terminate()
+                    # os.system(("kill -9 {}".format(p.pid)))
+                    os.kill(p.pid, signal.SIGKILL)
+                except:
+                    pass
 
             print(
-                "{}\t打开第{}个场景(场景{})\tgpu:{}".format(
+                "{}\t{}第{}个场景(场景{})\tgpu:{}\tport:{}\t用时:{:.2f}s".format(
                     str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+                    '打开' if ready[index] else '打开失败',
                     index,
                     scen_ids[index],
                     gpus[index],
+                    ports[index],
+                    startup_time,
                 )
             )
             return
 
-        for index, p in enumerate(p_s):
+        for index, p in p_s.items():
             thread = threading.Thread(target=_check_scene, args=(index, p))
             threads.append(thread)
         for thread in threads:
@@ -499,9 +678,24 @@ class EventHandler(object):
             thread.join()
         threads = []
 
+        failed_indexes = [index for index in launch_indexes if not ready.get(index, False)]
+        launch_indexes = [index for index in launch_indexes if ready.get(index, False)]
+        if len(failed_indexes) > 0:
+            KillPorts([ports[index] for index in failed_indexes])
+
         # ChangeNice(ports)
 
-        self.scene_used_ports += copy.deepcopy(ports)
+        for index in launch_indexes:
+            self.scene_pool[ports[index]] = {
+                'scene_id': scen_ids[index],
+                'slot': slots[index],
+            }
+        for index, port in enumerate(ports):
+            if port in self.scene_pool.keys():
+                self.scene_pool.move_to_end(port)
+
+        if len(failed_indexes) > 0:
+            return False, None
 
         return True, (ip, ports)
 
@@ -531,8 +725,8 @@ class EventHandler(object):
         )
 
         try:
-            KillPorts(self.scene_used_ports)
-            self.scene_used_ports = []
+            KillPorts(list(self.scene_pool.keys()))
+            self.scene_pool = OrderedDict()
             # KillPorts(self.scene_ports)
             # KillAirVLN()
 
@@ -588,6 +782,30 @@ if __name__ == '__main__':
         default=30000,
         help='server port'
     )
+    parser.add_argument(
+        "--max_scene_num",
+        type=int,
+        default=16,
+        help='number of scenes kept running on the gpus, least recently used scenes are closed beyond it'
+    )
+    parser.add_argument(
+        "--scene_startup_timeout",
+        type=float,
+        default=120,
+        help='seconds to wait for the airsim api of a launched scene before it is treated as hung'
+    )
+    parser.add_argument(
+        "--scene_probe_timeout",
+        type=int,
+        default=2,
+        help='seconds a running scene has to answer ping before it is killed instead of reused'
+    )
+    parser.add_argument(
+        "--pano_camera_num",
+        type=int,
+        default=0,
+        help='number of pano cameras mounted on each drone, 0 to disable'
+    )
     args = parser.parse_args()
 
     HOST = '127.0.0.1'
@@ -604,5 +822,10 @@ if __name__ == '__main__':
         gpu_list.append(int(gpu.strip()))
     GPU_IDS = gpu_list.copy()
 
+    MAX_SCENE_NUM = int(args.max_scene_num)
+    SCENE_STARTUP_TIMEOUT = float(args.scene_startup_timeout)
+    SCENE_PROBE_TIMEOUT = int(args.scene_probe_timeout)
+    PANO_CAMERA_NUM = int(args.pano_camera_num)
+
     addr, server, thread = serve()
     print(f"start listening \t{addr._host}:{addr._port}")
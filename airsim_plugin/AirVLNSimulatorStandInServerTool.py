@@ -0,0 +1,318 @@
+# Stand-in for AirVLNSimulatorServerTool that needs no Unreal scenes or GPU.
+#
+# It serves the ping / reopen_scenes / close_scenes surface of EventHandler and,
+# for every opened scene, an AirSim-like msgpack-rpc api server that answers the
+# calls made by AirVLNSimulatorClientTool (confirmConnection, simSetVehiclePose,
+# simGetImages) with synthetic RGB / depth frames after a configurable latency.
+#
+# usage:
+#   python airsim_plugin/AirVLNSimulatorStandInServerTool.py --port 30000 --rpc_latency 0.02
+# then run AirVLNENV / VectorEnvUtil / SimRun loops with --simulator_tool_port 30000
+import argparse
+import threading
+import msgpack
+import msgpackrpc
+import random
+import time
+import copy
+import numpy as np
+import cv2
+
+
+# airsim.ImageType
+IMAGE_TYPE_SCENE = 0
+IMAGE_TYPE_DEPTH_PLANAR = 1
+IMAGE_TYPE_DEPTH_PERSPECTIVE = 2
+IMAGE_TYPE_DEPTH_VIS = 3
+
+SYNTHETIC_FRAME_NUM = 16
+
+DEFAULT_POSE = {
+    'position': {'x_val': 0.0, 'y_val': 0.0, 'z_val': 0.0},
+    'orientation': {'w_val': 1.0, 'x_val': 0.0, 'y_val': 0.0, 'z_val': 0.0},
+}
+
+
+class BinTypePacker(msgpack.Packer):
+    # AirSim (rpclib) sends image_data_uint8 as msgpack bin, msgpackrpc packs bytes as raw,
+    # which the utf-8 unpacker of airsim.VehicleClient would try to decode as text
+    def __init__(self, *args, **kwargs):
+        kwargs['use_bin_type'] = True
+        super(BinTypePacker, self).__init__(*args, **kwargs)
+
+
+def sleep_latency(latency: float, latency_std: float) -> None:
+    delay = latency
+    if latency_std > 0:
+        delay = random.gauss(latency, latency_std)
+    if delay > 0:
+        time.sleep(delay)
+
+
+class SyntheticFrames(object):
+    def __init__(self, rgb_height, rgb_width, depth_height, depth_width, seed=0):
+        rng = np.random.RandomState(seed)
+
+        self.rgb_frames = rng.randint(
+            0, 256, size=(SYNTHETIC_FRAME_NUM, rgb_height, rgb_width, 3), dtype=np.uint8
+        )
+
+        # depth in meters, a ramp plus noise so that no frame is constant
+        ramp = np.linspace(1, 120, depth_height, dtype=np.float32).reshape(depth_height, 1)
+        self.depth_frames = np.clip(
+            ramp + rng.normal(0, 2, size=(SYNTHETIC_FRAME_NUM, depth_height, depth_width)).astype(np.float32),
+            0.5, None,
+        ).astype(np.float32)
+
+    def get_rgb(self, frame_index: int) -> np.ndarray:
+        return self.rgb_frames[frame_index % SYNTHETIC_FRAME_NUM]
+
+    def get_depth(self, frame_index: int) -> np.ndarray:
+        return self.depth_frames[frame_index % SYNTHETIC_FRAME_NUM]
+
+
+class StandInAirsimHandler(object):
+    """
+    The AirSim api calls used by AirVLNSimulatorClientTool, for one scene.
+    """
+    def __init__(self, scene_id, frames: SyntheticFrames, latency: float, latency_std: float):
+        self.scene_id = scene_id
+        self.frames = frames
+        self.latency = latency
+        self.latency_std = latency_std
+
+        self.frame_index = 0
+        self.vehicle_poses = {}
+
+    def ping(self) -> bool:
+        return True
+
+    def getServerVersion(self) -> int:
+        return 1
+
+    def getMinRequiredClientVersion(self) -> int:
+        return 1
+
+    def simSetVehiclePose(self, pose, ignore_collision, vehicle_name=''):
+        sleep_latency(self.latency, self.latency_std)
+        self.vehicle_poses[vehicle_name] = copy.deepcopy(pose)
+        self.frame_index += 1
+        return None
+
+    def simGetVehiclePose(self, vehicle_name=''):
+        sleep_latency(self.latency, self.latency_std)
+        return self.vehicle_poses.get(vehicle_name, DEFAULT_POSE)
+
+    def simGetImages(self, requests, vehicle_name='', external=False):
+        sleep_latency(self.latency, self.latency_std)
+
+        pose = self.vehicle_poses.get(vehicle_name, DEFAULT_POSE)
+
+        responses = []
+        for camera_index, request in enumerate(requests):
+            responses.append(
+                self._get_image_response(request, pose, self.frame_index + camera_index)
+            )
+
+        return responses
+
+    def _get_image_response(self, request: dict, pose: dict, frame_index: int) -> dict:
+        image_type = int(request['image_type'])
+        pixels_as_float = bool(request['pixels_as_float'])
+        compress = bool(request['compress'])
+
+        if image_type == IMAGE_TYPE_SCENE:
+            img = self.frames.get_rgb(frame_index)
+        elif image_type in [IMAGE_TYPE_DEPTH_PLANAR, IMAGE_TYPE_DEPTH_PERSPECTIVE]:
+            img = self.frames.get_depth(frame_index)
+        elif image_type == IMAGE_TYPE_DEPTH_VIS:
+            img = np.clip(self.frames.get_depth(frame_index) / 100 * 255, 0, 255).astype(np.uint8)
+            img = np.stack([img, img, img], axis=2)
+        else:
+            raise NotImplementedError('image_type {} is not supported'.format(image_type))
+
+        image_data_uint8 = b''
+        image_data_float = []
+        if pixels_as_float:
+            image_data_float = img.astype(np.float32).flatten().tolist()
+        elif compress:
+            image_data_uint8 = cv2.imencode('.png', np.ascontiguousarray(img))[1].tobytes()
+        else:
+            image_data_uint8 = np.ascontiguousarray(img, dtype=np.uint8).tobytes()
+
+        return {
+            'image_data_uint8': image_data_uint8,
+            'image_data_float': image_data_float,
+            'camera_name': request['camera_name'],
+            'camera_position': pose['position'],
+            'camera_orientation': pose['orientation'],
+            'time_stamp': int(time.time() * 1e9),
+            'message': '',
+            'pixels_as_float': pixels_as_float,
+            'compress': compress,
+            'width': int(img.shape[1]),
+            'height': int(img.shape[0]),
+            'image_type': image_type,
+        }
+
+
+class EventHandler(object):
+    def __init__(self):
+        scene_ports = []
+        for i in range(1000):
+            scene_ports.append(
+                int(args.port) + (i+1)
+            )
+        self.scene_ports = scene_ports
+
+        self.max_scene_num = int(args.max_scene_num)
+
+        self.frames = SyntheticFrames(
+            args.rgb_height, args.rgb_width,
+            args.depth_height, args.depth_width,
+        )
+
+        # port -> (msgpackrpc server, StandInAirsimHandler), servers stay up between reopen_scenes calls
+        self.scene_servers = {}
+        self.scene_used_ports = []
+
+    def ping(self) -> bool:
+        return True
+
+    def get_max_scene_num(self) -> int:
+        return self.max_scene_num
+
+    def _open_scene_server(self, port: int, scen_id):
+        if port in self.scene_servers.keys():
+            _, handler = self.scene_servers[port]
+            handler.scene_id = scen_id
+            handler.frame_index = 0
+            handler.vehicle_poses = {}
+            return
+
+        handler = StandInAirsimHandler(scen_id, self.frames, args.rpc_latency, args.rpc_latency_std)
+        server = msgpackrpc.Server(handler, unpack_encoding='utf-8')
+        server.listen(msgpackrpc.Address(HOST, port))
+        serve_background(server, daemon=True)
+
+        self.scene_servers[port] = (server, handler)
+
+    def reopen_scenes(self, ip: str, scen_ids: list):
+        print(
+            "{}\tSTART reopen_scenes".format(
+                str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+            )
+        )
+        # same answer as the real server when more scenes than slots are asked for
+        scene_num = len([scen_id for scen_id in scen_ids if str(scen_id).lower() != 'none'])
+        if scene_num > self.max_scene_num:
+            error = 'not enough scene slots, requested: {}, max_scene_num: {}'.format(scene_num, self.max_scene_num)
+            print(error)
+            result = False, error
+        else:
+            try:
+                ports = self.scene_ports[:len(scen_ids)]
+                for index, scen_id in enumerate(scen_ids):
+                    self._open_scene_server(ports[index], scen_id)
+
+                sleep_latency(args.scene_launch_latency, 0)
+
+                self.scene_used_ports = copy.deepcopy(ports)
+                result = True, (ip, ports)
+            except Exception as e:
+                print(e)
+                result = False, None
+        print(
+            "{}\tEND reopen_scenes".format(
+                str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+            )
+        )
+        return result
+
+    def close_scenes(self, ip: str) -> bool:
+        print(
+            "{}\tSTART close_scenes".format(
+                str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+            )
+        )
+        self.scene_used_ports = []
+        print(
+            "{}\tEND close_scenes".format(
+                str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+            )
+        )
+        return True
+
+
+def serve_background(server, daemon=False):
+    def _start_server(server):
+        server.start()
+        server.close()
+
+    t = threading.Thread(target=_start_server, args=(server,))
+    t.setDaemon(daemon)
+    t.start()
+    return t
+
+
+def serve(daemon=False):
+    try:
+        server = msgpackrpc.Server(EventHandler())
+        addr = msgpackrpc.Address(HOST, PORT)
+        server.listen(addr)
+
+        thread = serve_background(server, daemon)
+
+        return addr, server, thread
+    except Exception as err:
+        print(err)
+        pass
+
+
+if __name__ == '__main__':
+    # Argument
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=30000,
+        help='server port'
+    )
+    parser.add_argument(
+        "--max_scene_num",
+        type=int,
+        default=16,
+        help='scene slots reported by get_max_scene_num, larger reopen_scenes requests are refused'
+    )
+    parser.add_argument(
+        "--rpc_latency",
+        type=float,
+        default=0.0,
+        help='seconds added to every simGetImages / simSetVehiclePose call'
+    )
+    parser.add_argument(
+        "--rpc_latency_std",
+        type=float,
+        default=0.0,
+        help='gaussian jitter of rpc_latency in seconds'
+    )
+    parser.add_argument(
+        "--scene_launch_latency",
+        type=float,
+        default=0.0,
+        help='seconds added to every reopen_scenes call'
+    )
+    parser.add_argument("--rgb_height", type=int, default=224)
+    parser.add_argument("--rgb_width", type=int, default=224)
+    parser.add_argument("--depth_height", type=int, default=256)
+    parser.add_argument("--depth_width", type=int, default=256)
+    args = parser.parse_args()
+
+    HOST = '127.0.0.1'
+    PORT = int(args.port)
+
+    # msgpackrpc.transport.tcp creates its packers through msgpack.Packer
+    msgpack.Packer = BinTypePacker
+
+    addr, server, thread = serve()
+    print(f"start listening \t{addr._host}:{addr._port}")
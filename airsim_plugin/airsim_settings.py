@@ -32,6 +32,19 @@ ObservationDirections = [
     "right"
 ]
 
+# cameras of the pano ring created by AirVLNSimulatorServerTool --pano_camera_num 8,
+# ordered clockwise from the front, 45 degrees apart
+PanoCameraIds = [
+    "pano_0",
+    "pano_1",
+    "pano_2",
+    "pano_3",
+    "pano_4",
+    "pano_5",
+    "pano_6",
+    "pano_7"
+]
+
 class Singleton(type):
     _instances: Dict["Singleton", "Singleton"] = {}
 
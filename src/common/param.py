@@ -33,9 +33,13 @@ class Param:
         self.parser.add_argument('--Image_Width_DEPTH', type=int, default=256)
 
         self.parser.add_argument('--inflection_weight_coef', type=float, default=1.9)
+        self.parser.add_argument('--dataloader_num_workers', type=int, default=4, help="DataLoader workers decoding lmdb trajectories, every worker keeps its own preload")
+        self.parser.add_argument('--dataloader_prefetch_factor', type=int, default=2, help="batches prefetched by every DataLoader worker")
 
         self.parser.add_argument('--nav_graph_path', type=str, default=str(project_prefix / 'DATA/data/disceret/processed/nav_graph_10'), help="nav_graph path")
         self.parser.add_argument('--token_dict_path', type=str, default=str(project_prefix / 'DATA/data/disceret/processed/token_dict_10'), help="token_dict path")
+        self.parser.add_argument('--nav_graph_csr_path', type=str, default=str(project_prefix / 'DATA/data/disceret/processed/nav_graph_csr_10'), help="memory-mapped csr nav_graph path, converted from nav_graph_path and token_dict_path on first use")
+        self.parser.add_argument('--nav_graph_cache_size', type=int, default=8, help="scenes kept loaded by each ShortestPathSensor, least recently used scenes are dropped")
         self.parser.add_argument('--vertices_path', type=str, default=str(project_prefix / 'DATA/data/disceret/scene_meshes'))
         self.parser.add_argument('--dagger_mode_load_scene', nargs='+', default=[])
         self.parser.add_argument('--dagger_update_size', type=int, default=8000)
@@ -44,6 +48,13 @@ class Param:
 
         self.parser.add_argument('--TF_mode_load_scene', nargs='+', default=[])
 
+        self.parser.add_argument('--lmdb_writer_queue_size', type=int, default=256, help="entries queued for the background lmdb writer before collection blocks")
+        self.parser.add_argument('--lmdb_group_commit_size', type=int, default=32, help="entries per lmdb group commit")
+        self.parser.add_argument('--lmdb_group_commit_interval', type=float, default=5.0, help="seconds before a partial lmdb group is committed")
+        self.parser.add_argument('--lmdb_codec', type=str, default="zstd", help="compression of collected lmdb values in [none zlib zstd]")
+        self.parser.add_argument('--lmdb_codec_float16', action="store_true", help="store visual features and depth as float16")
+        self.parser.add_argument('--lmdb_codec_depth_uint8', action="store_true", help="store depth frames quantized to uint8")
+
         self.parser.add_argument('--ablate_instruction', action="store_true")
         self.parser.add_argument('--ablate_rgb', action="store_true")
         self.parser.add_argument('--ablate_depth', action="store_true")
@@ -60,6 +71,8 @@ class Param:
         self.parser.add_argument('--tokenizer_use_bert', action="store_true")
 
         self.parser.add_argument("--simulator_tool_port", type=int, default=30000, help="simulator_tool port")
+        self.parser.add_argument("--pano_camera_num", type=int, default=0, help="pano cameras mounted by the simulator server (its --pano_camera_num), 0 to rotate the drone for pano views")
+        self.parser.add_argument("--airsim_call_timeout", type=int, default=5, help="seconds one airsim call to a drone may take before it is retried")
         self.parser.add_argument("--DDP_MASTER_PORT", type=int, default=20000, help="DDP MASTER_PORT")
 
         self.parser.add_argument("--continue_start_from_dagger_it", type=int)
@@ -20,9 +20,10 @@ import torch.multiprocessing as mp
 from tensorboardX import SummaryWriter
 
 from typing import List, Optional, DefaultDict
-import msgpack_numpy
 
 from utils.logger import logger
+from utils.trajectory_store import is_trajectory_key, load_episode
+from utils.trajectory_dataset import LMDBDatasetMixin, get_dataloader_kwargs, put_trajectory_episodes
 from utils.utils import get_rank, is_dist_avail_and_initialized, is_main_process, init_distributed_mode, manual_init_distributed_mode, FromPortGetPid
 from Model.il_trainer import VLNCETrainer
 from Model.utils.tensor_dict import DictTree, TensorDict
@@ -57,7 +58,7 @@ def CheckPort():
     return True
 
 
-class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
+class DDPIWTrajectoryDataset(LMDBDatasetMixin, torch.utils.data.IterableDataset):
     def __init__(
         self,
         lmdb_features_dir,
@@ -95,6 +96,8 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
         ) as pbar, lmdb_env.begin() as txn:
             for key in txn.cursor().iternext(keys=True, values=False):
                 pbar.update()
+                if is_trajectory_key(key.decode()):
+                    continue
                 if len(str(key.decode()).split('_')) <= 1:
                     self.keys.append(key.decode())
                 else:
@@ -122,12 +125,8 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
 
             new_preload = []
             lengths = []
-            with lmdb.open(
-                self.lmdb_features_dir,
-                map_size=int(self.lmdb_map_size),
-                readonly=True,
-                lock=False,
-            ) as lmdb_env, lmdb_env.begin(buffers=True) as txn:
+            trajectory_cache = {}
+            with self._get_lmdb_env().begin(buffers=True) as txn:
                 for i in range(self.preload_size):
                     if len(self.load_ordering) == 0:
                         break
@@ -136,10 +135,7 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
                         logger.warning("rank: {} \t lmdb load: {} / {}".format(self.rank, i+1, self.preload_size))
 
                     new_preload.append(
-                        msgpack_numpy.unpackb(
-                            txn.get(str(self.keys[self.load_ordering.pop()]).encode()),
-                            raw=False,
-                        )
+                        load_episode(txn, self.keys[self.load_ordering.pop()], trajectory_cache)
                     )
 
                     lengths.append(len(new_preload[-1][0]))
@@ -153,7 +149,7 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
             for idx in _block_shuffle(sorted_ordering, self.batch_size):
                 self._preload.append(new_preload[idx])
 
-            del new_preload, lengths
+            del new_preload, lengths, trajectory_cache
 
         return self._preload.pop()
 
@@ -181,17 +177,28 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
         )
 
     def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        self.worker_info = worker_info
+        if worker_info is None:
+            start = self.iter_start
+            end = self.iter_end
+        else:
+            per_worker = int(np.ceil((self.iter_end - self.iter_start) / worker_info.num_workers))
+
+            start = self.iter_start + per_worker * worker_info.id
+            end = min(start + per_worker, self.iter_end)
+
         # Reverse so we can use .pop()
         self.load_ordering = list(
             reversed(
-                _block_shuffle(list(range(self.iter_start, self.iter_end)), self.preload_size)
+                _block_shuffle(list(range(start, end)), self.preload_size)
             )
         )
 
         return self
 
 
-class IWTrajectoryDataset(torch.utils.data.IterableDataset):
+class IWTrajectoryDataset(LMDBDatasetMixin, torch.utils.data.IterableDataset):
     def __init__(
         self,
         lmdb_features_dir,
@@ -229,6 +236,8 @@ class IWTrajectoryDataset(torch.utils.data.IterableDataset):
         ) as pbar, lmdb_env.begin() as txn:
             for key in txn.cursor().iternext(keys=True, values=False):
                 pbar.update()
+                if is_trajectory_key(key.decode()):
+                    continue
                 if len(str(key.decode()).split('_')) <= 1:
                     self.keys.append(key.decode())
                 else:
@@ -249,12 +258,8 @@ class IWTrajectoryDataset(torch.utils.data.IterableDataset):
 
             new_preload = []
             lengths = []
-            with lmdb.open(
-                self.lmdb_features_dir,
-                map_size=int(self.lmdb_map_size),
-                readonly=True,
-                lock=False,
-            ) as lmdb_env, lmdb_env.begin(buffers=True) as txn:
+            trajectory_cache = {}
+            with self._get_lmdb_env().begin(buffers=True) as txn:
                 for i in range(self.preload_size):
                     if len(self.load_ordering) == 0:
                         break
@@ -266,10 +271,7 @@ class IWTrajectoryDataset(torch.utils.data.IterableDataset):
                             logger.info("{} lmdb load: {} / {}".format(0, i+1, self.preload_size))
 
                     new_preload.append(
-                        msgpack_numpy.unpackb(
-                            txn.get(str(self.keys[self.load_ordering.pop()]).encode()),
-                            raw=False,
-                        )
+                        load_episode(txn, self.keys[self.load_ordering.pop()], trajectory_cache)
                     )
 
                     lengths.append(len(new_preload[-1][0]))
@@ -283,7 +285,7 @@ class IWTrajectoryDataset(torch.utils.data.IterableDataset):
             for idx in _block_shuffle(sorted_ordering, self.batch_size):
                 self._preload.append(new_preload[idx])
 
-            del new_preload, lengths
+            del new_preload, lengths, trajectory_cache
 
         return self._preload.pop()
 
@@ -626,46 +628,9 @@ def collect_data(trainer, train_env, data_it=0):
                 for i in range(train_env.batch_size):
                     if dones[i] and not skips[i]:
                         if data_it == 0:
-                            _episodes = episodes[i].copy()
-                            for _i, _j in enumerate(train_env.trajectory_id_2_instruction_tokens[infos[i]['trajectory_id']]):
-                                for __i, __j in enumerate(_episodes):
-                                    _episodes[__i][0]['instruction'] = _j
-
-                                ep = _episodes.copy()
-                                traj_obs = batch_obs(
-                                    [step[0] for step in ep],
-                                    device=torch.device("cpu"),
-                                )
-                                del traj_obs['teacher_action']
-                                for k, v in traj_obs.items():
-                                    traj_obs[k] = v.numpy()
-
-                                transposed_ep = [
-                                    traj_obs,
-                                    np.array([step[1] for step in ep], dtype=np.int64),
-                                    np.array([step[2] for step in ep], dtype=np.int64),
-                                ]
-
-                                train_env.threading_lock_lmdb_features_txn.acquire()
-                                lmdb_key = str('{}_{}'.format(
-                                    train_env.trajectory_id_2_episode_ids[infos[i]['trajectory_id']][_i],
-                                    data_it
-                                ))
-                                train_env.lmdb_features_txn.put(
-                                    lmdb_key.encode(),
-                                    msgpack_numpy.packb(
-                                        transposed_ep, use_bin_type=True
-                                    ),
-                                )
-                                train_env.lmdb_features_txn.commit()
-                                train_env.lmdb_features_start_id = train_env.lmdb_features_env.stat()["entries"]
-                                train_env.lmdb_features_txn = train_env.lmdb_features_env.begin(write=True)
-                                train_env.lmdb_collected_keys.add(lmdb_key)
-                                train_env.threading_lock_lmdb_features_txn.release()
-                                logger.info('lmdb of {}, lmdb_start_id: {}'.format(train_env.split, train_env.lmdb_features_start_id))
+                            put_trajectory_episodes(train_env, episodes[i], infos[i]['trajectory_id'], data_it)
 
                             episodes[i] = []
-                            _episodes = []
                             envs_to_pause.append(i)
                             skips[i] = True
 
@@ -688,20 +653,11 @@ def collect_data(trainer, train_env, data_it=0):
                             if not (len(transposed_ep[2]) <= 500 and transposed_ep[2][-1] == 0):
                                 continue
 
-                            train_env.threading_lock_lmdb_features_txn.acquire()
                             lmdb_key = str('{}_{}'.format(infos[i]['episode_id'], data_it))
-                            train_env.lmdb_features_txn.put(
-                                lmdb_key.encode(),
-                                msgpack_numpy.packb(
-                                    transposed_ep, use_bin_type=True
-                                ),
+                            train_env.lmdb_features_writer.put(
+                                lmdb_key,
+                                train_env.lmdb_codec.encode(transposed_ep),
                             )
-                            train_env.lmdb_features_txn.commit()
-                            train_env.lmdb_features_start_id = train_env.lmdb_features_env.stat()["entries"]
-                            train_env.lmdb_features_txn = train_env.lmdb_features_env.begin(write=True)
-                            train_env.lmdb_collected_keys.add(lmdb_key)
-                            train_env.threading_lock_lmdb_features_txn.release()
-                            logger.info('lmdb of {}, lmdb_start_id: {}'.format(train_env.split, train_env.lmdb_features_start_id))
 
                             episodes[i] = []
                             envs_to_pause.append(i)
@@ -756,9 +712,7 @@ def collect_data(trainer, train_env, data_it=0):
 
                 # Make action and get the new state
                 actions = [temp[0] for temp in actions.cpu().numpy()]
-                train_env.makeActions(actions)
-
-                outputs = train_env.get_obs()
+                outputs = train_env.makeActionsAndGetObs(actions)
                 observations, _, dones, infos = [list(x) for x in zip(*outputs)]
                 batch = batch_obs(observations, trainer.device)
 
@@ -776,48 +730,9 @@ def collect_data(trainer, train_env, data_it=0):
                     continue
 
                 if data_it == 0:
-                    _episodes = episodes[i].copy()
-                    for _i, _j in enumerate(train_env.trajectory_id_2_instruction_tokens[infos[i]['trajectory_id']]):
-                        for __i, __j in enumerate(_episodes):
-                            _episodes[__i][0]['instruction'] = _j
-
-                        ep = _episodes.copy()
-                        if len(ep) <= 0:
-                            continue
-                        traj_obs = batch_obs(
-                            [step[0] for step in ep],
-                            device=torch.device("cpu"),
-                        )
-                        del traj_obs['teacher_action']
-                        for k, v in traj_obs.items():
-                            traj_obs[k] = v.numpy()
-
-                        transposed_ep = [
-                            traj_obs,
-                            np.array([step[1] for step in ep], dtype=np.int64),
-                            np.array([step[2] for step in ep], dtype=np.int64),
-                        ]
-
-                        train_env.threading_lock_lmdb_features_txn.acquire()
-                        lmdb_key = str('{}_{}'.format(
-                            train_env.trajectory_id_2_episode_ids[infos[i]['trajectory_id']][_i],
-                            data_it
-                        ))
-                        train_env.lmdb_features_txn.put(
-                            lmdb_key.encode(),
-                            msgpack_numpy.packb(
-                                transposed_ep, use_bin_type=True
-                            ),
-                        )
-                        train_env.lmdb_features_txn.commit()
-                        train_env.lmdb_features_start_id = train_env.lmdb_features_env.stat()["entries"]
-                        train_env.lmdb_features_txn = train_env.lmdb_features_env.begin(write=True)
-                        train_env.lmdb_collected_keys.add(lmdb_key)
-                        train_env.threading_lock_lmdb_features_txn.release()
-                        logger.info('lmdb of {}, lmdb_start_id: {}'.format(train_env.split, train_env.lmdb_features_start_id))
+                    put_trajectory_episodes(train_env, episodes[i], infos[i]['trajectory_id'], data_it)
 
                     episodes[i] = []
-                    _episodes = []
                     envs_to_pause.append(i)
                     skips[i] = True
 
@@ -842,20 +757,11 @@ def collect_data(trainer, train_env, data_it=0):
                     if not (len(transposed_ep[2]) <= 500 and transposed_ep[2][-1] == 0):
                         continue
 
-                    train_env.threading_lock_lmdb_features_txn.acquire()
                     lmdb_key = str('{}_{}'.format(infos[i]['episode_id'], data_it))
-                    train_env.lmdb_features_txn.put(
-                        lmdb_key.encode(),
-                        msgpack_numpy.packb(
-                            transposed_ep, use_bin_type=True
-                        ),
+                    train_env.lmdb_features_writer.put(
+                        lmdb_key,
+                        train_env.lmdb_codec.encode(transposed_ep),
                     )
-                    train_env.lmdb_features_txn.commit()
-                    train_env.lmdb_features_start_id = train_env.lmdb_features_env.stat()["entries"]
-                    train_env.lmdb_features_txn = train_env.lmdb_features_env.begin(write=True)
-                    train_env.lmdb_collected_keys.add(lmdb_key)
-                    train_env.threading_lock_lmdb_features_txn.release()
-                    logger.info('lmdb of {}, lmdb_start_id: {}'.format(train_env.split, train_env.lmdb_features_start_id))
 
                     episodes[i] = []
                     envs_to_pause.append(i)
@@ -871,6 +777,9 @@ def collect_data(trainer, train_env, data_it=0):
     if depth_hook is not None:
         depth_hook.remove()
 
+    # everything collected has to be committed before the lmdb is read or copied
+    train_env.flush_lmdb()
+
     #
     if dagger_it == 0 and is_main_process():
         try:
@@ -930,9 +839,8 @@ def train_vlnce(rank, world_size, dagger_it, config):
             batch_size=args.batchSize,
             shuffle=False,
             collate_fn=collate_fn,
-            pin_memory=False,
             drop_last=True,
-            num_workers=0,
+            **get_dataloader_kwargs(),
         )
     else:
         dataset = IWTrajectoryDataset(
@@ -948,9 +856,8 @@ def train_vlnce(rank, world_size, dagger_it, config):
             batch_size=args.batchSize,
             shuffle=False,
             collate_fn=collate_fn,
-            pin_memory=False,
             drop_last=True,
-            num_workers=0,
+            **get_dataloader_kwargs(),
         )
 
     AuxLosses.activate()
@@ -1252,9 +1159,7 @@ def _eval_checkpoint(
 
                 # Make action and get the new state
                 actions = [temp[0] for temp in actions.cpu().numpy()]
-                train_env.makeActions(actions)
-
-                outputs = train_env.get_obs()
+                outputs = train_env.makeActionsAndGetObs(actions)
                 observations, _, dones, infos = [list(x) for x in zip(*outputs)]
                 batch = batch_obs(observations, trainer.device)
 
@@ -2,7 +2,6 @@ import copy
 import random
 import time
 
-import msgpack_numpy
 import numpy as np
 import math
 from gym import spaces
@@ -11,8 +10,6 @@ import os
 import json
 from pathlib import Path
 import airsim
-import threading
-from fastdtw import fastdtw
 import tqdm
 
 from typing import Dict, List, Optional
@@ -21,11 +18,15 @@ sys.path.append("../..")
 
 from src.common.param import args
 from utils.logger import logger
-from airsim_plugin.AirVLNSimulatorClientTool import AirVLNSimulatorClientTool
+from airsim_plugin.AirVLNSimulatorClientTool import AirVLNSimulatorClientTool, SceneSlotError
 from airsim_plugin.airsim_settings import AirsimActions, AirsimActionSettings
-from utils.env_utils import SimState, getPoseAfterMakeAction, getPoseAfterMakeActions
+from utils.env_utils import SimState, SimStateBatch, batchPosesAfterAction, batchPosesAfterActions, arraysToPose
 from utils.env_vector import VectorEnvUtil
-from utils.shorest_path_sensor import EuclideanDistance3
+from utils.scene_scheduler import SceneScheduler
+from utils.scene_placement import ScenePlacement
+from utils.lmdb_writer import LMDBWriter
+from utils.trajectory_codec import TrajectoryCodec
+from utils.trajectory_store import is_trajectory_key
 
 
 def load_my_datasets(splits):
@@ -144,6 +145,12 @@ class AirVLNENV:
             self.data = self._group_scenes()
             logger.warning('dataset grouped by scene')
 
+        # keep every batch slot on the same scene for as long as possible
+        self.scene_scheduler = None
+        if dataset_group_by_scene:
+            self.scene_scheduler = SceneScheduler(batch_size, machines_info=args.machines_info)
+            self.scene_scheduler.schedule(self.data)
+
         scenes = [item['scene_id'] for item in self.data]
         self.scenes = set(scenes)
 
@@ -156,11 +163,21 @@ class AirVLNENV:
         })
         self.action_space = spaces.Discrete(int(len(AirsimActions)))
 
+        self.sim_state_batch = SimStateBatch(batch_size)
         self.sim_states: Optional[List[SimState], List[None]] = [None for _ in range(batch_size)]
         self.last_scene_id_list = []
+        self.scene_placement = ScenePlacement(args.machines_info)
+        self.machines_batch_indexes = []
         self.one_scene_could_use_num = 5000
         self.this_scene_used_cnt = 0
 
+        # encoding of every value written to the lmdb stores
+        self.lmdb_codec = TrajectoryCodec(
+            compression=args.lmdb_codec,
+            float16=bool(args.lmdb_codec_float16),
+            depth_uint8=bool(args.lmdb_codec_depth_uint8),
+        )
+
         if args.collect_type in ['TF']:
 
             if args.run_type in ['collect']:
@@ -182,29 +199,29 @@ class AirVLNENV:
                 try:
                     self.lmdb_features_env = lmdb.open(self.lmdb_features_dir, map_size=int(lmdb_features_map_size), readahead=False,)
                     self.lmdb_features_start_id = self.lmdb_features_env.stat()["entries"]
-                    self.lmdb_features_txn = self.lmdb_features_env.begin(write=True)
-                    self.threading_lock_lmdb_features_txn = threading.Lock()
                     logger.info('init lmdb of {}, {}, lmdb_start_id: {}'.format(split, 'features', self.lmdb_features_start_id))
 
                     self.lmdb_collected_keys = set()
                     with tqdm.tqdm(
                         total=int(self.lmdb_features_start_id), dynamic_ncols=True
-                    ) as pbar:
-                        for key in self.lmdb_features_txn.cursor().iternext(keys=True, values=False):
+                    ) as pbar, self.lmdb_features_env.begin() as txn:
+                        for key in txn.cursor().iternext(keys=True, values=False):
                             pbar.update()
+                            if is_trajectory_key(key.decode()):
+                                continue
                             self.lmdb_collected_keys.add(key.decode())
 
                     self.lmdb_rgb_env = lmdb.open(self.lmdb_rgb_dir, map_size=int(lmdb_rgb_map_size), readahead=False,)
                     self.lmdb_rgb_start_id = self.lmdb_rgb_env.stat()["entries"]
-                    self.lmdb_rgb_txn = self.lmdb_rgb_env.begin(write=True)
-                    self.threading_lock_lmdb_rgb_txn = threading.Lock()
                     logger.info('init lmdb of {}, {}, lmdb_start_id: {}'.format(split, 'rgb', self.lmdb_rgb_start_id))
 
                     self.lmdb_depth_env = lmdb.open(self.lmdb_depth_dir, map_size=int(lmdb_depth_map_size), readahead=False,)
                     self.lmdb_depth_start_id = self.lmdb_depth_env.stat()["entries"]
-                    self.lmdb_depth_txn = self.lmdb_depth_env.begin(write=True)
-                    self.threading_lock_lmdb_depth_txn = threading.Lock()
                     logger.info('init lmdb of {}, {}, lmdb_start_id: {}'.format(split, 'depth', self.lmdb_depth_start_id))
+
+                    self.lmdb_features_writer = self._make_lmdb_writer(self.lmdb_features_env, str(split), self.lmdb_collected_keys)
+                    self.lmdb_rgb_writer = self._make_lmdb_writer(self.lmdb_rgb_env, str(split)+'_rgb')
+                    self.lmdb_depth_writer = self._make_lmdb_writer(self.lmdb_depth_env, str(split)+'_depth')
                 except lmdb.Error as err:
                     logger.error(err)
                     raise err
@@ -220,18 +237,20 @@ class AirVLNENV:
                 try:
                     self.lmdb_features_env = lmdb.open(self.lmdb_features_dir, map_size=int(lmdb_features_map_size), readahead=False,)
                     self.lmdb_features_start_id = self.lmdb_features_env.stat()["entries"]
-                    self.lmdb_features_txn = self.lmdb_features_env.begin(write=True)
-                    self.threading_lock_lmdb_features_txn = threading.Lock()
                     logger.info('init lmdb of {}, {}, lmdb_start_id: {}'.format(split, 'features', self.lmdb_features_start_id))
 
                     self.lmdb_collected_keys = set()
                     with tqdm.tqdm(
                         total=int(self.lmdb_features_start_id), dynamic_ncols=True
-                    ) as pbar:
-                        for key in self.lmdb_features_txn.cursor().iternext(keys=True, values=False):
+                    ) as pbar, self.lmdb_features_env.begin() as txn:
+                        for key in txn.cursor().iternext(keys=True, values=False):
                             pbar.update()
+                            if is_trajectory_key(key.decode()):
+                                continue
                             self.lmdb_collected_keys.add(key.decode())
 
+                    self.lmdb_features_writer = self._make_lmdb_writer(self.lmdb_features_env, str(split), self.lmdb_collected_keys)
+
                 except lmdb.Error as err:
                     logger.error(err)
                     raise err
@@ -247,16 +266,16 @@ class AirVLNENV:
             try:
                 self.lmdb_features_env = lmdb.open(self.lmdb_features_dir, map_size=int(lmdb_features_map_size), readahead=False,)
                 self.lmdb_features_start_id = self.lmdb_features_env.stat()["entries"]
-                self.lmdb_features_txn = self.lmdb_features_env.begin(write=True)
-                self.threading_lock_lmdb_features_txn = threading.Lock()
                 logger.info('init lmdb of {}, {}, lmdb_start_id: {}'.format(split, 'features', self.lmdb_features_start_id))
 
                 self.lmdb_collected_keys = set()
                 with tqdm.tqdm(
                     total=int(self.lmdb_features_start_id), dynamic_ncols=True
-                ) as pbar:
-                    for key in self.lmdb_features_txn.cursor().iternext(keys=True, values=False):
+                ) as pbar, self.lmdb_features_env.begin() as txn:
+                    for key in txn.cursor().iternext(keys=True, values=False):
                         pbar.update()
+                        if is_trajectory_key(key.decode()):
+                            continue
                         if len(str(key.decode()).split('_')) <= 1:
                             self.lmdb_collected_keys.add(
                                 '{}_0'.format(key.decode())
@@ -264,12 +283,31 @@ class AirVLNENV:
                         else:
                             self.lmdb_collected_keys.add(key.decode())
 
+                self.lmdb_features_writer = self._make_lmdb_writer(self.lmdb_features_env, str(split), self.lmdb_collected_keys)
+
             except lmdb.Error as err:
                 logger.error(err)
                 raise err
 
         self.init_VectorEnvUtil()
 
+    def _make_lmdb_writer(self, lmdb_env, name: str, collected_keys=None) -> LMDBWriter:
+        return LMDBWriter(
+            lmdb_env, name,
+            collected_keys=collected_keys,
+            max_queue_size=int(args.lmdb_writer_queue_size),
+            group_commit_size=int(args.lmdb_group_commit_size),
+            group_commit_interval=float(args.lmdb_group_commit_interval),
+        )
+
+    def flush_lmdb(self) -> None:
+        """
+        wait for the background lmdb writers to commit everything collected so far
+        """
+        for name in ['lmdb_features_writer', 'lmdb_rgb_writer', 'lmdb_depth_writer']:
+            if hasattr(self, name):
+                getattr(self, name).flush()
+
     def _group_scenes(self):
         assert self.dataset_group_by_scene, 'error args param'
 
@@ -295,6 +333,9 @@ class AirVLNENV:
 
     #
     def next_minibatch(self, skip_scenes=[], data_it=0):
+        if self.scene_scheduler is not None:
+            return self._next_minibatch_by_scene_scheduler(skip_scenes=skip_scenes, data_it=data_it)
+
         batch = []
 
         while True:
@@ -315,32 +356,12 @@ class AirVLNENV:
                 break
 
             new_episode = self.data[self.index_data]
+            self.index_data += 1
 
-            #
-            if new_episode['scene_id'] in skip_scenes:
-                self.index_data += 1
+            if self._need_skip_episode(new_episode, skip_scenes=skip_scenes, data_it=data_it):
                 continue
 
-            if args.run_type in ['collect', 'train'] and args.collect_type in ['TF']:
-                lmdb_key = '{}'.format(new_episode['episode_id'])
-                if lmdb_key in self.lmdb_collected_keys:
-                    self.index_data += 1
-                    continue
-                else:
-                    batch.append(new_episode)
-                    self.index_data += 1
-            elif args.run_type in ['collect', 'train'] and args.collect_type in ['dagger', 'SF']:
-                lmdb_key = '{}_{}'.format(new_episode['episode_id'], data_it)
-                if lmdb_key in self.lmdb_collected_keys:
-                    self.index_data += 1
-                    continue
-                else:
-                    batch.append(new_episode)
-                    self.index_data += 1
-            else:
-                batch.append(new_episode)
-                self.index_data += 1
-
+            batch.append(new_episode)
             if len(batch) == self.batch_size:
                 break
 
@@ -349,6 +370,55 @@ class AirVLNENV:
 
         self.VectorEnvUtil.set_batch(self.batch)
 
+    def _next_minibatch_by_scene_scheduler(self, skip_scenes=[], data_it=0):
+        batch = [None for _ in range(self.batch_size)]
+
+        for slot in range(self.batch_size):
+            while batch[slot] is None:
+                new_episode = self.scene_scheduler.pop(slot)
+                if new_episode is None:
+                    break
+                self.index_data += 1
+
+                if self._need_skip_episode(new_episode, skip_scenes=skip_scenes, data_it=data_it):
+                    continue
+
+                batch[slot] = new_episode
+
+        if None in batch:
+            random.shuffle(self.data)
+            logger.warning('random shuffle data')
+            self.scene_scheduler.schedule(self.data)
+
+            if batch.count(None) == self.batch_size:
+                self.index_data = 0
+                self.batch = None
+                return
+
+            self.index_data = 0
+            for slot in range(self.batch_size):
+                if batch[slot] is None:
+                    batch[slot] = self.scene_scheduler.pop(slot)
+                    self.index_data += 1
+
+        self.batch = copy.deepcopy(batch)
+        assert len(self.batch) == self.batch_size, 'next_minibatch error'
+
+        self.VectorEnvUtil.set_batch(self.batch)
+
+    def _need_skip_episode(self, new_episode, skip_scenes=[], data_it=0) -> bool:
+        if new_episode['scene_id'] in skip_scenes:
+            return True
+
+        if args.run_type in ['collect', 'train'] and args.collect_type in ['TF']:
+            lmdb_key = '{}'.format(new_episode['episode_id'])
+            return lmdb_key in self.lmdb_features_writer
+        elif args.run_type in ['collect', 'train'] and args.collect_type in ['dagger', 'SF']:
+            lmdb_key = '{}_{}'.format(new_episode['episode_id'], data_it)
+            return lmdb_key in self.lmdb_features_writer
+
+        return False
+
 
     #
     def changeToNewEpisodes(self):
@@ -362,46 +432,55 @@ class AirVLNENV:
         scene_id_list = [item['scene_id'] for item in self.batch]
         assert len(scene_id_list) == self.batch_size, '错误'
 
-        machines_info_template = copy.deepcopy(args.machines_info)
         total_max_scene_num = 0
-        for item in machines_info_template:
+        for item in args.machines_info:
             total_max_scene_num += item['MAX_SCENE_NUM']
         assert self.batch_size <= total_max_scene_num, 'error args param: batch_size'
 
-        # 构造机器信息 TODO
-        machines_info = []
-        ix = 0
-        for index, item in enumerate(machines_info_template):
-            machines_info.append(item)
-            delta = min(self.batch_size, item['MAX_SCENE_NUM'], len(scene_id_list)-ix)
-            machines_info[index]['open_scenes'] = scene_id_list[ix : ix + delta]
-            ix += delta
-
-        #
-        cnt = 0
-        for item in machines_info:
-            cnt += len(item['open_scenes'])
-        assert self.batch_size == cnt, 'error create machines_info'
-
-        #
+        # every slot keeps its scene, e.g. consecutive batches of SceneScheduler
         if self.this_scene_used_cnt < self.one_scene_could_use_num and \
-                len(set(scene_id_list)) == 1 and len(set(self.last_scene_id_list)) == 1 and \
-                scene_id_list[0] is not None and self.last_scene_id_list[0] is not None and scene_id_list[0] == self.last_scene_id_list[0] and \
+                len(scene_id_list) == len(self.last_scene_id_list) and \
+                None not in scene_id_list and \
+                [str(_) for _ in scene_id_list] == [str(_) for _ in self.last_scene_id_list] and \
                 need_change == False:
             self.this_scene_used_cnt += 1
             logger.warning('no need to change env: {}'.format(scene_id_list))
             return
         else:
-            logger.warning('to change env: {}'.format(scene_id_list))
+            if len(scene_id_list) == len(self.last_scene_id_list):
+                switch_num = len([1 for a, b in zip(scene_id_list, self.last_scene_id_list) if str(a) != str(b)])
+            else:
+                switch_num = len(scene_id_list)
+            logger.warning('to change env: {}, scene switches: {}'.format(scene_id_list, switch_num))
+
+        # place slots on machines by measured step latency and open scenes
+        if hasattr(self, 'simulator_tool'):
+            for index, step_latency in enumerate(self.simulator_tool.getMachineStepLatencies()):
+                self.scene_placement.update_latency(
+                    self.machines_info[index]['MACHINE_IP'],
+                    step_latency,
+                    len(self.machines_info[index]['open_scenes']),
+                )
+            self.simulator_tool.shutdown()
+        machines_info, machines_batch_indexes = self.scene_placement.assign(scene_id_list)
+
+        cnt = 0
+        for item in machines_info:
+            cnt += len(item['open_scenes'])
+        assert self.batch_size == cnt, 'error create machines_info'
 
         #
         while True:
             try:
                 self.machines_info = copy.deepcopy(machines_info)
+                self.machines_batch_indexes = copy.deepcopy(machines_batch_indexes)
                 if (not args.ablate_rgb or not args.ablate_depth):
                     self.simulator_tool = AirVLNSimulatorClientTool(machines_info=self.machines_info)
                     self.simulator_tool.run_call()
                 break
+            except SceneSlotError as e:
+                logger.error("启动场景失败 {}".format(e))
+                raise e
             except Exception as e:
                 logger.error("启动场景失败 {}".format(e))
                 time.sleep(3)
@@ -419,56 +498,94 @@ class AirVLNENV:
 
         #
         poses = []
-        cnt = 0
-        for index_1, item in enumerate(self.machines_info):
-            poses.append([])
-            for index_2, _ in enumerate(item['open_scenes']):
-                pose = airsim.Pose(
-                    position_val=airsim.Vector3r(
-                        x_val=start_position_list[cnt][0],
-                        y_val=start_position_list[cnt][1],
-                        z_val=start_position_list[cnt][2],
-                    ),
-                    orientation_val=airsim.Quaternionr(
-                        x_val=start_rotation_list[cnt][1],
-                        y_val=start_rotation_list[cnt][2],
-                        z_val=start_rotation_list[cnt][3],
-                        w_val=start_rotation_list[cnt][0],
-                    ),
-                )
-                poses[index_1].append(pose)
-                cnt += 1
+        for cnt, _ in enumerate(self.batch):
+            pose = airsim.Pose(
+                position_val=airsim.Vector3r(
+                    x_val=start_position_list[cnt][0],
+                    y_val=start_position_list[cnt][1],
+                    z_val=start_position_list[cnt][2],
+                ),
+                orientation_val=airsim.Quaternionr(
+                    x_val=start_rotation_list[cnt][1],
+                    y_val=start_rotation_list[cnt][2],
+                    z_val=start_rotation_list[cnt][3],
+                    w_val=start_rotation_list[cnt][0],
+                ),
+            )
+            poses.append(pose)
 
         #
         if (not args.ablate_rgb or not args.ablate_depth):
-            result = self.simulator_tool.setPoses(poses=poses)
-            if not result:
-                logger.error('设置位置失败')
-                self.reset_to_this_pose(poses)
+            poses_formatted = self._formatPoses(poses)
+            self._setPoses(poses_formatted)
 
         #
-        cnt = 0
-        for index_1, item in enumerate(self.machines_info):
-            for index_2, _ in enumerate(item['open_scenes']):
-                pose = airsim.Pose(
-                    position_val=airsim.Vector3r(
-                        x_val=start_position_list[cnt][0],
-                        y_val=start_position_list[cnt][1],
-                        z_val=start_position_list[cnt][2],
-                    ),
-                    orientation_val=airsim.Quaternionr(
-                        x_val=start_rotation_list[cnt][1],
-                        y_val=start_rotation_list[cnt][2],
-                        z_val=start_rotation_list[cnt][3],
-                        w_val=start_rotation_list[cnt][0],
-                    ),
-                )
-                self.sim_states[cnt] = SimState(index=cnt, step=0, episode_info=self.batch[cnt], pose=pose)
-                self.sim_states[cnt].trajectory = [[
-                    pose.position.x_val, pose.position.y_val, pose.position.z_val, # xyz
-                    pose.orientation.x_val, pose.orientation.y_val, pose.orientation.z_val, pose.orientation.w_val, # xyzw
-                ]]
-                cnt += 1
+        for cnt, pose in enumerate(poses):
+            self.sim_states[cnt] = SimState(index=cnt, step=0, episode_info=self.batch[cnt], pose=pose, store=self.sim_state_batch)
+            self.sim_states[cnt].append_trajectory(pose)
+
+    # (index_1, index_2) of every drone, nested like self.machines_info
+    def _allDrones(self) -> list:
+        return [
+            (index_1, index_2)
+            for index_1, item in enumerate(self.machines_info)
+            for index_2 in range(len(item['open_scenes']))
+        ]
+
+    def _dronesAvailable(self, drones: list) -> bool:
+        return all([self.simulator_tool.droneAvailable(index_1, index_2) for index_1, index_2 in drones])
+
+    def _setPoses(self, poses_formatted: list) -> None:
+        """
+        Place every drone, a failed drone is placed again on its own. Only when its
+        circuit breaker is open (the scene is gone) are all scenes reset.
+        """
+        self.simulator_tool.setPoses(poses=poses_formatted, drones=self._allDrones())
+        failed_drones = self.simulator_tool.failed_drones
+        while len(failed_drones) > 0:
+            logger.error('设置位置失败: {}'.format(failed_drones))
+            if not self._dronesAvailable(failed_drones):
+                self.reset_to_this_pose(poses_formatted)
+                return
+
+            self.simulator_tool.setPoses(poses=poses_formatted, drones=failed_drones)
+            failed_drones = self.simulator_tool.failed_drones
+
+    def _recoverDrones(self, responses: list, failed_drones: list, camera_id='front_0') -> list:
+        """
+        Place the failed drones at their current pose again and fetch their images,
+        the other drones keep their responses. Only when a circuit breaker is open
+        (the scene is gone) are all scenes reset and observed again.
+        """
+        while len(failed_drones) > 0:
+            logger.error('获取图片失败: {}'.format(failed_drones))
+            if not self._dronesAvailable(failed_drones):
+                self.reset_to_this_pose(self._get_current_pose())
+                responses = [[None for _ in item['open_scenes']] for item in self.machines_info]
+                failed_drones = self._allDrones()
+
+            retry_responses = self.simulator_tool.stepAndObserve(
+                poses=self._get_current_pose(),
+                get_rgb=not bool(args.ablate_rgb),
+                get_depth=not bool(args.ablate_depth),
+                camera_id=camera_id,
+                drones=failed_drones,
+            )
+            for index_1, index_2 in failed_drones:
+                responses[index_1][index_2] = retry_responses[index_1][index_2]
+            failed_drones = self.simulator_tool.failed_drones
+
+        return responses
+
+    # batch ordered list -> [machine][scene] nested list of self.machines_info
+    def _formatPoses(self, poses: list) -> list:
+        poses_formatted = []
+        for index_1, _ in enumerate(self.machines_info):
+            poses_formatted.append([])
+            for cnt in self.machines_batch_indexes[index_1]:
+                poses_formatted[index_1].append(poses[cnt])
+
+        return poses_formatted
 
 
     #
@@ -480,18 +597,15 @@ class AirVLNENV:
 
         return obs
 
-    def _getStates(self, camera_id='front_0'):
-        while True:
+    def _getStates(self, camera_id='front_0', responses=None, failed_drones=None):
+        if responses is None:
             if (not args.ablate_rgb or not args.ablate_depth):
-                responses = self.simulator_tool.getImageResponses(get_rgb=not bool(args.ablate_rgb), get_depth=not bool(args.ablate_depth), camera_id=camera_id)
+                responses = self.simulator_tool.getImageResponses(get_rgb=not bool(args.ablate_rgb), get_depth=not bool(args.ablate_depth), camera_id=camera_id, drones=self._allDrones())
+                failed_drones = self.simulator_tool.failed_drones
             else:
                 responses = [[(None, None) for j in range(self.batch_size)] for i in range(len(self.machines_info))]
-            if responses is None:
-                poses = self._get_current_pose()
-                self.reset_to_this_pose(poses)
-                time.sleep(3)
-            else:
-                break
+        if failed_drones is not None and len(failed_drones) > 0:
+            responses = self._recoverDrones(responses, failed_drones, camera_id)
 
         #
         cnt = 0
@@ -503,9 +617,9 @@ class AirVLNENV:
         #
         if args.run_type in ['eval'] or \
             (args.run_type in ['collect'] and args.collect_type in ['dagger']):
-            cnt = 0
             for index_1, item in enumerate(self.machines_info):
                 for index_2 in range(len(item['open_scenes'])):
+                    cnt = self.machines_batch_indexes[index_1][index_2]
                     depth_image = responses[index_1][index_2][1]
                     collision_sensor_result = (np.array(depth_image) < 0.004).sum() / np.array(depth_image).flatten().shape[0]
                     if collision_sensor_result > 1:
@@ -513,13 +627,11 @@ class AirVLNENV:
                         self.sim_states[cnt].is_end = True
                         logger.warning('collisioned: {}'.format(cnt))
 
-                    cnt += 1
-
         #
         states = [None for _ in range(self.batch_size)]
-        cnt = 0
         for index_1, item in enumerate(self.machines_info):
             for index_2 in range(len(item['open_scenes'])):
+                cnt = self.machines_batch_indexes[index_1][index_2]
                 rgb_image = responses[index_1][index_2][0]
                 if rgb_image is not None:
                     _rgb_image = np.array(rgb_image)
@@ -535,7 +647,6 @@ class AirVLNENV:
                 state = self.sim_states[cnt]
 
                 states[cnt] = (_rgb_image, _depth_image, state)
-                cnt += 1
 
                 #
                 if self.split in ['train'] and args.run_type in ['collect'] and args.collect_type in ['TF']:
@@ -545,40 +656,21 @@ class AirVLNENV:
                     lmdb_depth_key = '{}_{}_depth'.format(trajectory_id, step)
 
                     if rgb_image is not None:
-                        self.threading_lock_lmdb_rgb_txn.acquire()
-                        self.lmdb_rgb_txn.put(
-                            lmdb_rgb_key.encode(),
-                            msgpack_numpy.packb(
-                                rgb_image, use_bin_type=True
-                            ),
+                        self.lmdb_rgb_writer.put(
+                            lmdb_rgb_key,
+                            self.lmdb_codec.encode(rgb_image, 'rgb'),
                         )
-                        self.threading_lock_lmdb_rgb_txn.release()
 
                     if depth_image is not None:
-                        self.threading_lock_lmdb_depth_txn.acquire()
-                        self.lmdb_depth_txn.put(
-                            lmdb_depth_key.encode(),
-                            msgpack_numpy.packb(
-                                depth_image, use_bin_type=True
-                            ),
+                        self.lmdb_depth_writer.put(
+                            lmdb_depth_key,
+                            self.lmdb_codec.encode(depth_image, 'depth'),
                         )
-                        self.threading_lock_lmdb_depth_txn.release()
 
         return states
 
     def _get_current_pose(self) -> list:
-        poses = []
-
-        cnt = 0
-        for index_1, item in enumerate(self.machines_info):
-            poses.append([])
-            for index_2, _ in enumerate(item['open_scenes']):
-                poses[index_1].append(
-                    self.sim_states[cnt].pose
-                )
-                cnt += 1
-
-        return poses
+        return self._formatPoses([state.pose for state in self.sim_states])
 
 
     #
@@ -588,8 +680,15 @@ class AirVLNENV:
 
 
     def reset_to_this_pose(self, poses, need_change=True):
+        # poses are nested by the current placement, _changeEnv may place the slots anew
+        batch_poses = [None for _ in range(self.batch_size)]
+        for index_1, _ in enumerate(poses):
+            for index_2, pose in enumerate(poses[index_1]):
+                batch_poses[self.machines_batch_indexes[index_1][index_2]] = pose
+
         #
         self._changeEnv(need_change=need_change)
+        poses = self._formatPoses(batch_poses)
 
         #
         if (not args.ablate_rgb or not args.ablate_depth):
@@ -603,8 +702,46 @@ class AirVLNENV:
             self,
             action_list: List[int],
             update_statue=True):
+        poses, poses_formatted = self._getPosesAfterActions(action_list)
+
         #
-        poses = []
+        if (not args.ablate_rgb or not args.ablate_depth):
+            self._setPoses(poses_formatted)
+
+        if update_statue:
+            self._updateStatesAfterActions(action_list, poses)
+
+    # make actions and get the new observations in a single pass over the simulators
+    def makeActionsAndGetObs(
+            self,
+            action_list: List[int],
+            camera_id='front_0'):
+        poses, poses_formatted = self._getPosesAfterActions(action_list)
+
+        responses = None
+        failed_drones = None
+        if (not args.ablate_rgb or not args.ablate_depth):
+            responses = self.simulator_tool.stepAndObserve(
+                poses=poses_formatted,
+                get_rgb=not bool(args.ablate_rgb),
+                get_depth=not bool(args.ablate_depth),
+                camera_id=camera_id,
+                drones=self._allDrones(),
+            )
+            failed_drones = self.simulator_tool.failed_drones
+
+        self._updateStatesAfterActions(action_list, poses)
+
+        # failed drones are placed at their new pose again inside _getStates
+        obs_states = self._getStates(camera_id, responses=responses, failed_drones=failed_drones)
+
+        obs, states = self.VectorEnvUtil.get_obs(obs_states)
+        self.sim_states = states
+
+        return obs
+
+    def _getPosesAfterActions(self, action_list: List[int]):
+        actions = []
         for index, action in enumerate(action_list):
             if self.sim_states[index].is_end == True:
                 action = AirsimActions.STOP
@@ -613,47 +750,36 @@ class AirVLNENV:
             if action == AirsimActions.STOP or self.sim_states[index].step >= int(args.maxAction):
                 self.sim_states[index].is_end = True
 
+            actions.append(action)
 
-            state = self.sim_states[index]
-
-            pose = copy.deepcopy(state.pose)
-            new_pose = getPoseAfterMakeAction(pose, action)
-            poses.append(new_pose)
+        # the whole batch at once, on the SimStateBatch arrays
+        positions, orientations = batchPosesAfterAction(
+            self.sim_state_batch.position[:len(actions)],
+            self.sim_state_batch.orientation[:len(actions)],
+            actions,
+        )
+        poses = [arraysToPose(positions[index], orientations[index]) for index in range(len(actions))]
 
-        poses_formatted = []
-        cnt = 0
-        for index_1, item in enumerate(self.machines_info):
-            poses_formatted.append([])
-            for index_2, _ in enumerate(item['open_scenes']):
-                poses_formatted[index_1].append(poses[cnt])
-                cnt += 1
+        poses_formatted = self._formatPoses(poses)
 
-        #
-        if (not args.ablate_rgb or not args.ablate_depth):
-            result = self.simulator_tool.setPoses(poses=poses_formatted)
-            if not result:
-                logger.error('设置位置失败')
-                self.reset_to_this_pose(poses_formatted)
+        return poses, poses_formatted
 
-        if update_statue:
-            for index, action in enumerate(action_list):
-                if self.sim_states[index].is_end == True:
-                    continue
+    def _updateStatesAfterActions(self, action_list: List[int], poses: list):
+        for index, action in enumerate(action_list):
+            if self.sim_states[index].is_end == True:
+                continue
 
-                if action == AirsimActions.STOP or self.sim_states[index].step >= int(args.maxAction):
-                    self.sim_states[index].is_end = True
+            if action == AirsimActions.STOP or self.sim_states[index].step >= int(args.maxAction):
+                self.sim_states[index].is_end = True
 
-                self.sim_states[index].step += 1
-                self.sim_states[index].pose = poses[index]
-                self.sim_states[index].trajectory.append([
-                    poses[index].position.x_val, poses[index].position.y_val, poses[index].position.z_val, # xyz
-                    poses[index].orientation.x_val, poses[index].orientation.y_val, poses[index].orientation.z_val, poses[index].orientation.w_val, # xyzw
-                ])
-                self.sim_states[index].pre_action = action
+            self.sim_states[index].step += 1
+            self.sim_states[index].pose = poses[index]
+            self.sim_states[index].append_trajectory(poses[index])
+            self.sim_states[index].pre_action = action
 
-            # update measurement
-            if args.run_type not in ['collect']:
-                self.update_measurements()
+        # update measurement
+        if args.run_type not in ['collect']:
+            self.update_measurements()
 
 
     # support make a squence of action at once
@@ -662,7 +788,7 @@ class AirVLNENV:
             action_list: List[List],
             update_statue=True):
         #
-        poses = []
+        actions_list = []
         for index, actions in enumerate(action_list):
             if self.sim_states[index].is_end == True:
                 actions = []
@@ -673,25 +799,19 @@ class AirVLNENV:
                 act_idx = actions.index(AirsimActions.STOP)
                 actions = actions[:act_idx]
 
-            state = self.sim_states[index]
+            actions_list.append(actions)
 
-            pose = copy.deepcopy(state.pose)
-            new_pose = getPoseAfterMakeActions(pose, actions)
-            poses.append(new_pose)
+        positions, orientations = batchPosesAfterActions(
+            self.sim_state_batch.position[:len(actions_list)],
+            self.sim_state_batch.orientation[:len(actions_list)],
+            actions_list,
+        )
+        poses = [arraysToPose(positions[index], orientations[index]) for index in range(len(actions_list))]
 
-        poses_formatted = []
-        cnt = 0
-        for index_1, item in enumerate(self.machines_info):
-            poses_formatted.append([])
-            for index_2, _ in enumerate(item['open_scenes']):
-                poses_formatted[index_1].append(poses[cnt])
-                cnt += 1
+        poses_formatted = self._formatPoses(poses)
 
         if (not args.ablate_rgb or not args.ablate_depth):
-            result = self.simulator_tool.setPoses(poses=poses_formatted)
-            if not result:
-                logger.error('设置位置失败')
-                self.reset_to_this_pose(poses_formatted)
+            self._setPoses(poses_formatted)
 
         for index, actions in enumerate(action_list):
             self.sim_states[index].pose = poses[index]
@@ -711,112 +831,24 @@ class AirVLNENV:
         #     if args.run_type not in ['collect']:
         #         self.update_measurements()
 
-    # metrics related to success
+    # metrics related to success, updated for the whole batch on the SimStateBatch arrays
     def update_measurements(self):
-        self._update_DistanceToGoal()
-        self._updata_Success()
         self._updata_NDTW()
-        self._updata_SDTW()
-        self._update_PathLength()
-        self._update_OracleSuccess()
-        self._update_StepsTaken()
-
-    def _update_DistanceToGoal(self):
-        for i, state in enumerate(self.sim_states):
-
-            current_position = np.array([
-                state.pose.position.x_val,
-                state.pose.position.y_val,
-                state.pose.position.z_val
-            ])
-
-            if self.sim_states[i].DistanceToGoal['_previous_position'] is None or \
-                not np.allclose(self.sim_states[i].DistanceToGoal['_previous_position'], current_position, atol=1):
-                distance_to_target = EuclideanDistance3(
-                    np.array(current_position)[0:2],
-                    np.array(state.episode_info['goals'][0]['position'])[0:2]
-                )
-                self.sim_states[i].DistanceToGoal['_previous_position'] = current_position
-                self.sim_states[i].DistanceToGoal['_metric'] = distance_to_target
-
-    # update if success
-    def _updata_Success(self):
-        for i, state in enumerate(self.sim_states):
-            distance_to_target = self.sim_states[i].DistanceToGoal['_metric']
-            if (
-                self.sim_states[i].is_end
-                and distance_to_target <= self.sim_states[i].SUCCESS_DISTANCE
-            ):
-                self.sim_states[i].Success['_metric'] = 1.0
-            else:
-                self.sim_states[i].Success['_metric'] = 0.0
+        self.sim_state_batch.update_measurements()
 
     def _updata_NDTW(self):
-        def euclidean_distance(
-                position_a,
-                position_b,
-        ) -> float:
-            return np.linalg.norm(
-                np.array(position_b) - np.array(position_a), ord=2
-            )
-
         for i, state in enumerate(self.sim_states):
+            current_position = self.sim_state_batch.position[i]
 
-            current_position = np.array([
-                state.pose.position.x_val,
-                state.pose.position.y_val,
-                state.pose.position.z_val
-            ])
-
-            if len(state.NDTW['locations']) == 0:
-                self.sim_states[i].NDTW['locations'].append(current_position)
-            else:
-                if current_position.tolist() == state.NDTW['locations'][-1].tolist():
-                    continue
-                self.sim_states[i].NDTW['locations'].append(current_position)
-
-            dtw_distance = fastdtw(
-                self.sim_states[i].NDTW['locations'], self.sim_states[i].NDTW['gt_locations'], dist=euclidean_distance
-            )[0]
+            dtw = state.NDTW['dtw']
+            if dtw.last_location is not None and np.array_equal(current_position, dtw.last_location):
+                continue
+            dtw_distance = dtw.add(current_position)
 
             nDTW = np.exp(
-                -dtw_distance / (len(self.sim_states[i].NDTW['gt_locations']) * self.sim_states[i].SUCCESS_DISTANCE)
+                -dtw_distance / (len(state.NDTW['gt_locations']) * state.SUCCESS_DISTANCE)
             )
-            self.sim_states[i].NDTW['_metric'] = nDTW
-
-    def _updata_SDTW(self):
-        for i, state in enumerate(self.sim_states):
-            ep_success = self.sim_states[i].Success['_metric']
-            nDTW = self.sim_states[i].NDTW['_metric']
-            self.sim_states[i].SDTW['_metric'] = ep_success * nDTW
-
-    def _update_PathLength(self):
-        for i, state in enumerate(self.sim_states):
-
-            current_position = np.array([
-                state.pose.position.x_val,
-                state.pose.position.y_val,
-                state.pose.position.z_val
-            ])
-
-            if state.PathLength['_previous_position'] is None:
-                self.sim_states[i].PathLength['_previous_position'] = current_position
-
-            self.sim_states[i].PathLength['_metric'] += EuclideanDistance3(
-                current_position, self.sim_states[i].PathLength['_previous_position']
-            )
-            self.sim_states[i].PathLength['_previous_position'] = current_position
-
-    def _update_OracleSuccess(self):
-        for i, state in enumerate(self.sim_states):
-            d = self.sim_states[i].DistanceToGoal['_metric']
-            self.sim_states[i].OracleSuccess['_metric'] = float(
-                self.sim_states[i].OracleSuccess['_metric'] or d <= self.sim_states[i].SUCCESS_DISTANCE
-            )
-
-    def _update_StepsTaken(self):
-        for i, state in enumerate(self.sim_states):
-            self.sim_states[i].StepsTaken['_metric'] = self.sim_states[i].step
+            state.NDTW['_metric'] = nDTW
 
     def navi_task_preprocessing(self, item):
         instruction_text = item["instruction"]["instruction_text"]
@@ -18,9 +18,10 @@ import torch.backends.cudnn as cudnn
 from tensorboardX import SummaryWriter
 
 from typing import List, Optional, DefaultDict
-import msgpack_numpy
 
 from utils.logger import logger
+from utils.trajectory_store import is_trajectory_key, load_episode
+from utils.trajectory_dataset import LMDBDatasetMixin, get_dataloader_kwargs, put_trajectory_episodes
 from utils.utils import get_rank, is_dist_avail_and_initialized, is_main_process, init_distributed_mode
 from Model.il_trainer import VLNCETrainer
 from Model.utils.tensor_dict import DictTree, TensorDict
@@ -46,7 +47,7 @@ def setup():
     cudnn.deterministic = False
 
 
-class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
+class DDPIWTrajectoryDataset(LMDBDatasetMixin, torch.utils.data.IterableDataset):
     def __init__(
         self,
         lmdb_features_dir,
@@ -82,6 +83,8 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
         ) as pbar, lmdb_env.begin() as txn:
             for key in txn.cursor().iternext(keys=True, values=False):
                 pbar.update()
+                if is_trajectory_key(key.decode()):
+                    continue
                 self.keys.append(key.decode())
 
         self.length = len(self.keys)
@@ -104,12 +107,8 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
 
             new_preload = []
             lengths = []
-            with lmdb.open(
-                self.lmdb_features_dir,
-                map_size=int(self.lmdb_map_size),
-                readonly=True,
-                lock=False,
-            ) as lmdb_env, lmdb_env.begin(buffers=True) as txn:
+            trajectory_cache = {}
+            with self._get_lmdb_env().begin(buffers=True) as txn:
                 for i in range(self.preload_size):
                     if len(self.load_ordering) == 0:
                         break
@@ -118,10 +117,7 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
                         logger.warning("rank: {} \t lmdb load: {} / {}".format(self.rank, i+1, self.preload_size))
 
                     new_preload.append(
-                        msgpack_numpy.unpackb(
-                            txn.get(str(self.keys[self.load_ordering.pop()]).encode()),
-                            raw=False,
-                        )
+                        load_episode(txn, self.keys[self.load_ordering.pop()], trajectory_cache)
                     )
 
                     lengths.append(len(new_preload[-1][0]))
@@ -135,7 +131,7 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
             for idx in _block_shuffle(sorted_ordering, self.batch_size):
                 self._preload.append(new_preload[idx])
 
-            del new_preload, lengths
+            del new_preload, lengths, trajectory_cache
 
         return self._preload.pop()
 
@@ -163,17 +159,28 @@ class DDPIWTrajectoryDataset(torch.utils.data.IterableDataset):
         )
 
     def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        self.worker_info = worker_info
+        if worker_info is None:
+            start = self.iter_start
+            end = self.iter_end
+        else:
+            per_worker = int(np.ceil((self.iter_end - self.iter_start) / worker_info.num_workers))
+
+            start = self.iter_start + per_worker * worker_info.id
+            end = min(start + per_worker, self.iter_end)
+
         # Reverse so we can use .pop()
         self.load_ordering = list(
             reversed(
-                _block_shuffle(list(range(self.iter_start, self.iter_end)), self.preload_size)
+                _block_shuffle(list(range(start, end)), self.preload_size)
             )
         )
 
         return self
 
 
-class IWTrajectoryDataset(torch.utils.data.IterableDataset):
+class IWTrajectoryDataset(LMDBDatasetMixin, torch.utils.data.IterableDataset):
     def __init__(
         self,
         lmdb_features_dir,
@@ -209,6 +216,8 @@ class IWTrajectoryDataset(torch.utils.data.IterableDataset):
         ) as pbar, lmdb_env.begin() as txn:
             for key in txn.cursor().iternext(keys=True, values=False):
                 pbar.update()
+                if is_trajectory_key(key.decode()):
+                    continue
                 self.keys.append(key.decode())
 
         self.length = len(self.keys)
@@ -224,12 +233,8 @@ class IWTrajectoryDataset(torch.utils.data.IterableDataset):
 
             new_preload = []
             lengths = []
-            with lmdb.open(
-                self.lmdb_features_dir,
-                map_size=int(self.lmdb_map_size),
-                readonly=True,
-                lock=False,
-            ) as lmdb_env, lmdb_env.begin(buffers=True) as txn:
+            trajectory_cache = {}
+            with self._get_lmdb_env().begin(buffers=True) as txn:
                 for i in range(self.preload_size):
                     if len(self.load_ordering) == 0:
                         break
@@ -241,10 +246,7 @@ class IWTrajectoryDataset(torch.utils.data.IterableDataset):
                             logger.info("{} lmdb load: {} / {}".format(0, i+1, self.preload_size))
 
                     new_preload.append(
-                        msgpack_numpy.unpackb(
-                            txn.get(str(self.keys[self.load_ordering.pop()]).encode()),
-                            raw=False,
-                        )
+                        load_episode(txn, self.keys[self.load_ordering.pop()], trajectory_cache)
                     )
 
                     lengths.append(len(new_preload[-1][0]))
@@ -258,7 +260,7 @@ class IWTrajectoryDataset(torch.utils.data.IterableDataset):
             for idx in _block_shuffle(sorted_ordering, self.batch_size):
                 self._preload.append(new_preload[idx])
 
-            del new_preload, lengths
+            del new_preload, lengths, trajectory_cache
 
         return self._preload.pop()
 
@@ -569,55 +571,9 @@ def collect_data(data_it=0):
                 for i in range(train_env.batch_size):
                     if dones[i] and not skips[i]:
                         if args.collect_type in ['TF']:
-                            _episodes = episodes[i].copy()
-                            for _i, _j in enumerate(train_env.trajectory_id_2_instruction_tokens[infos[i]['trajectory_id']]):
-                                for __i, __j in enumerate(_episodes):
-                                    _episodes[__i][0]['instruction'] = _j
-
-                                ep = _episodes.copy()
-                                traj_obs = batch_obs(
-                                    [step[0] for step in ep],
-                                    device=torch.device("cpu"),
-                                )
-                                del traj_obs['teacher_action']
-                                for k, v in traj_obs.items():
-                                    traj_obs[k] = v.numpy()
-
-                                transposed_ep = [
-                                    traj_obs,
-                                    np.array([step[1] for step in ep], dtype=np.int64),
-                                    np.array([step[2] for step in ep], dtype=np.int64),
-                                ]
-
-                                train_env.threading_lock_lmdb_features_txn.acquire()
-                                lmdb_key = str(train_env.trajectory_id_2_episode_ids[infos[i]['trajectory_id']][_i])
-                                train_env.lmdb_features_txn.put(
-                                    lmdb_key.encode(),
-                                    msgpack_numpy.packb(
-                                        transposed_ep, use_bin_type=True
-                                    ),
-                                )
-                                train_env.lmdb_features_txn.commit()
-                                train_env.lmdb_features_start_id = train_env.lmdb_features_env.stat()["entries"]
-                                train_env.lmdb_features_txn = train_env.lmdb_features_env.begin(write=True)
-                                train_env.threading_lock_lmdb_features_txn.release()
-                                logger.info('lmdb of {}, lmdb_start_id: {}'.format(train_env.split, train_env.lmdb_features_start_id))
-
-                            if args.run_type in ['collect'] and args.collect_type in ['TF']:
-                                train_env.threading_lock_lmdb_rgb_txn.acquire()
-                                train_env.lmdb_rgb_txn.commit()
-                                train_env.lmdb_rgb_start_id = train_env.lmdb_rgb_env.stat()["entries"]
-                                train_env.lmdb_rgb_txn = train_env.lmdb_rgb_env.begin(write=True)
-                                train_env.threading_lock_lmdb_rgb_txn.release()
-
-                                train_env.threading_lock_lmdb_depth_txn.acquire()
-                                train_env.lmdb_depth_txn.commit()
-                                train_env.lmdb_depth_start_id = train_env.lmdb_depth_env.stat()["entries"]
-                                train_env.lmdb_depth_txn = train_env.lmdb_depth_env.begin(write=True)
-                                train_env.threading_lock_lmdb_depth_txn.release()
+                            put_trajectory_episodes(train_env, episodes[i], infos[i]['trajectory_id'])
 
                             episodes[i] = []
-                            _episodes = []
                             envs_to_pause.append(i)
                             skips[i] = True
 
@@ -637,33 +593,11 @@ def collect_data(data_it=0):
                                 np.array([step[2] for step in ep], dtype=np.int64),
                             ]
 
-                            train_env.threading_lock_lmdb_features_txn.acquire()
                             lmdb_key = str(infos[i]['episode_id'])
-                            train_env.lmdb_features_txn.put(
-                                lmdb_key.encode(),
-                                msgpack_numpy.packb(
-                                    transposed_ep, use_bin_type=True
-                                ),
+                            train_env.lmdb_features_writer.put(
+                                lmdb_key,
+                                train_env.lmdb_codec.encode(transposed_ep),
                             )
-                            train_env.lmdb_features_txn.commit()
-                            train_env.lmdb_features_start_id = train_env.lmdb_features_env.stat()["entries"]
-                            train_env.lmdb_features_txn = train_env.lmdb_features_env.begin(write=True)
-                            train_env.lmdb_collected_keys.add(lmdb_key)
-                            train_env.threading_lock_lmdb_features_txn.release()
-                            logger.info('lmdb of {}, lmdb_start_id: {}'.format(train_env.split, train_env.lmdb_features_start_id))
-
-                            if args.run_type in ['collect'] and args.collect_type in ['TF']:
-                                train_env.threading_lock_lmdb_rgb_txn.acquire()
-                                train_env.lmdb_rgb_txn.commit()
-                                train_env.lmdb_rgb_start_id = train_env.lmdb_rgb_env.stat()["entries"]
-                                train_env.lmdb_rgb_txn = train_env.lmdb_rgb_env.begin(write=True)
-                                train_env.threading_lock_lmdb_rgb_txn.release()
-
-                                train_env.threading_lock_lmdb_depth_txn.acquire()
-                                train_env.lmdb_depth_txn.commit()
-                                train_env.lmdb_depth_start_id = train_env.lmdb_depth_env.stat()["entries"]
-                                train_env.lmdb_depth_txn = train_env.lmdb_depth_env.begin(write=True)
-                                train_env.threading_lock_lmdb_depth_txn.release()
 
                             episodes[i] = []
                             envs_to_pause.append(i)
@@ -712,9 +646,7 @@ def collect_data(data_it=0):
 
                 # Make action and get the new state
                 actions = [temp[0] for temp in actions.cpu().numpy()]
-                train_env.makeActions(actions)
-
-                outputs = train_env.get_obs()
+                outputs = train_env.makeActionsAndGetObs(actions)
                 observations, _, dones, infos = [list(x) for x in zip(*outputs)]
                 batch = batch_obs(observations, trainer.device)
 
@@ -731,58 +663,9 @@ def collect_data(data_it=0):
                     continue
 
                 if args.collect_type in ['TF']:
-                    _episodes = episodes[i].copy()
-                    for _i, _j in enumerate(train_env.trajectory_id_2_instruction_tokens[infos[i]['trajectory_id']]):
-                        for __i, __j in enumerate(_episodes):
-                            _episodes[__i][0]['instruction'] = _j
-
-                        ep = _episodes.copy()
-                        if len(ep) <= 0:
-                            continue
-                        traj_obs = batch_obs(
-                            [step[0] for step in ep],
-                            device=torch.device("cpu"),
-                        )
-                        del traj_obs['teacher_action']
-                        for k, v in traj_obs.items():
-                            traj_obs[k] = v.numpy()
-
-                        transposed_ep = [
-                            traj_obs,
-                            np.array([step[1] for step in ep], dtype=np.int64),
-                            np.array([step[2] for step in ep], dtype=np.int64),
-                        ]
-
-                        train_env.threading_lock_lmdb_features_txn.acquire()
-                        lmdb_key = str(train_env.trajectory_id_2_episode_ids[infos[i]['trajectory_id']][_i])
-                        train_env.lmdb_features_txn.put(
-                            lmdb_key.encode(),
-                            msgpack_numpy.packb(
-                                transposed_ep, use_bin_type=True
-                            ),
-                        )
-                        train_env.lmdb_features_txn.commit()
-                        train_env.lmdb_features_start_id = train_env.lmdb_features_env.stat()["entries"]
-                        train_env.lmdb_features_txn = train_env.lmdb_features_env.begin(write=True)
-                        train_env.lmdb_collected_keys.add(lmdb_key)
-                        train_env.threading_lock_lmdb_features_txn.release()
-                        logger.info('lmdb of {}, lmdb_start_id: {}'.format(train_env.split, train_env.lmdb_features_start_id))
-
-                    if args.run_type in ['collect'] and args.collect_type in ['TF']:
-                        train_env.threading_lock_lmdb_rgb_txn.acquire()
-                        train_env.lmdb_rgb_txn.commit()
-                        train_env.lmdb_rgb_start_id = train_env.lmdb_rgb_env.stat()["entries"]
-                        train_env.lmdb_rgb_txn = train_env.lmdb_rgb_env.begin(write=True)
-                        train_env.threading_lock_lmdb_rgb_txn.release()
-
-                        train_env.threading_lock_lmdb_depth_txn.acquire()
-                        train_env.lmdb_depth_txn.commit()
-                        train_env.lmdb_depth_start_id = train_env.lmdb_depth_env.stat()["entries"]
-                        train_env.lmdb_depth_txn = train_env.lmdb_depth_env.begin(write=True)
-                        train_env.threading_lock_lmdb_depth_txn.release()
+                    put_trajectory_episodes(train_env, episodes[i], infos[i]['trajectory_id'])
 
                     episodes[i] = []
-                    _episodes = []
                     envs_to_pause.append(i)
                     skips[i] = True
 
@@ -804,33 +687,11 @@ def collect_data(data_it=0):
                         np.array([step[2] for step in ep], dtype=np.int64),
                     ]
 
-                    train_env.threading_lock_lmdb_features_txn.acquire()
                     lmdb_key = str(infos[i]['episode_id'])
-                    train_env.lmdb_features_txn.put(
-                        lmdb_key.encode(),
-                        msgpack_numpy.packb(
-                            transposed_ep, use_bin_type=True
-                        ),
+                    train_env.lmdb_features_writer.put(
+                        lmdb_key,
+                        train_env.lmdb_codec.encode(transposed_ep),
                     )
-                    train_env.lmdb_features_txn.commit()
-                    train_env.lmdb_features_start_id = train_env.lmdb_features_env.stat()["entries"]
-                    train_env.lmdb_features_txn = train_env.lmdb_features_env.begin(write=True)
-                    train_env.lmdb_collected_keys.add(lmdb_key)
-                    train_env.threading_lock_lmdb_features_txn.release()
-                    logger.info('lmdb of {}, lmdb_start_id: {}'.format(train_env.split, train_env.lmdb_features_start_id))
-
-                    if args.run_type in ['collect'] and args.collect_type in ['TF']:
-                        train_env.threading_lock_lmdb_rgb_txn.acquire()
-                        train_env.lmdb_rgb_txn.commit()
-                        train_env.lmdb_rgb_start_id = train_env.lmdb_rgb_env.stat()["entries"]
-                        train_env.lmdb_rgb_txn = train_env.lmdb_rgb_env.begin(write=True)
-                        train_env.threading_lock_lmdb_rgb_txn.release()
-
-                        train_env.threading_lock_lmdb_depth_txn.acquire()
-                        train_env.lmdb_depth_txn.commit()
-                        train_env.lmdb_depth_start_id = train_env.lmdb_depth_env.stat()["entries"]
-                        train_env.lmdb_depth_txn = train_env.lmdb_depth_env.begin(write=True)
-                        train_env.threading_lock_lmdb_depth_txn.release()
 
                     episodes[i] = []
                     envs_to_pause.append(i)
@@ -846,6 +707,9 @@ def collect_data(data_it=0):
     if depth_hook is not None:
         depth_hook.remove()
 
+    # everything collected has to be committed before the lmdb is read or copied
+    train_env.flush_lmdb()
+
     try:
         train_env.simulator_tool.closeScenes()
     except:
@@ -888,9 +752,8 @@ def train_vlnce():
                 batch_size=args.batchSize,
                 shuffle=False,
                 collate_fn=collate_fn,
-                pin_memory=False,
                 drop_last=True,
-                num_workers=0,
+                **get_dataloader_kwargs(),
             )
         else:
             dataset = IWTrajectoryDataset(
@@ -905,9 +768,8 @@ def train_vlnce():
                 batch_size=args.batchSize,
                 shuffle=False,
                 collate_fn=collate_fn,
-                pin_memory=False,
                 drop_last=True,
-                num_workers=0,
+                **get_dataloader_kwargs(),
             )
 
         AuxLosses.activate()
@@ -1186,9 +1048,7 @@ def _eval_checkpoint(
 
                 # Make action and get the new state
                 actions = [temp[0] for temp in actions.cpu().numpy()]
-                train_env.makeActions(actions)
-
-                outputs = train_env.get_obs()
+                outputs = train_env.makeActionsAndGetObs(actions)
                 observations, _, dones, infos = [list(x) for x in zip(*outputs)]
                 batch = batch_obs(observations, trainer.device)
 
@@ -13,47 +13,232 @@ from utils.logger import logger
 from utils.shorest_path_sensor import ShortestPathSensor, EuclideanDistance3, EuclideanDistance1
 
 
+# SimState metric dict name -> SimStateBatch.metrics key
+METRIC_NAMES = {
+    'DistanceToGoal': 'distance_to_goal',
+    'Success': 'success',
+    'NDTW': 'ndtw',
+    'SDTW': 'sdtw',
+    'PathLength': 'path_length',
+    'OracleSuccess': 'oracle_success',
+    'StepsTaken': 'steps_taken',
+}
+
+
+class SimStateBatch:
+    """
+    Numpy store of the per-step state of a whole batch.
+
+    Poses, steps, flags, metric scalars and trajectories live in preallocated arrays
+    indexed by batch slot; SimState objects are views on one slot of it, so metrics
+    can be updated for the whole batch at once.
+    """
+    def __init__(self, batch_size: int, max_steps: int = None):
+        if max_steps is None:
+            max_steps = int(args.maxAction)
+
+        self.batch_size = batch_size
+
+        self.position = np.zeros((batch_size, 3), dtype=np.float64)
+        self.orientation = np.zeros((batch_size, 4), dtype=np.float64)  # xyzw
+        self.step = np.zeros((batch_size,), dtype=np.int64)
+        self.is_end = np.zeros((batch_size,), dtype=bool)
+        self.is_collisioned = np.zeros((batch_size,), dtype=bool)
+        self.success_distance = np.full((batch_size,), 20, dtype=np.float64)
+        self.goal_position = np.full((batch_size, 3), np.nan, dtype=np.float64)
+
+        self.metrics = {
+            name: np.zeros((batch_size,), dtype=np.float64) for name in METRIC_NAMES.values()
+        }
+        # nan rows stand for None
+        self.previous_position = {
+            name: np.full((batch_size, 3), np.nan, dtype=np.float64) for name in ['distance_to_goal', 'path_length']
+        }
+
+        # xyz + xyzw per step, the start pose included
+        self.trajectory = np.zeros((batch_size, max_steps + 2, 7), dtype=np.float64)
+        self.trajectory_len = np.zeros((batch_size,), dtype=np.int64)
+
+    def reset_at(self, index: int) -> None:
+        self.position[index] = 0
+        self.orientation[index] = (0, 0, 0, 1)
+        self.step[index] = 0
+        self.is_end[index] = False
+        self.is_collisioned[index] = False
+        self.success_distance[index] = 20
+        self.goal_position[index] = np.nan
+        for name in self.metrics.keys():
+            self.metrics[name][index] = 0
+        for name in self.previous_position.keys():
+            self.previous_position[name][index] = np.nan
+        self.trajectory_len[index] = 0
+
+    def append_trajectory(self, index: int, pose: airsim.Pose) -> None:
+        length = self.trajectory_len[index]
+        if length >= self.trajectory.shape[1]:
+            self.trajectory = np.concatenate([self.trajectory, np.zeros_like(self.trajectory)], axis=1)
+
+        self.trajectory[index, length] = (
+            pose.position.x_val, pose.position.y_val, pose.position.z_val,
+            pose.orientation.x_val, pose.orientation.y_val, pose.orientation.z_val, pose.orientation.w_val,
+        )
+        self.trajectory_len[index] = length + 1
+
+    def get_trajectory(self, index: int) -> np.ndarray:
+        return self.trajectory[index, :self.trajectory_len[index]]
+
+    def update_measurements(self) -> None:
+        """
+        DistanceToGoal, Success, SDTW, PathLength, OracleSuccess and StepsTaken of every slot
+        in one pass over the arrays; metrics['ndtw'] has to be up to date already.
+        """
+        position = self.position
+        metrics = self.metrics
+
+        # DistanceToGoal, only refreshed after moving more than 1 m, like np.allclose(atol=1)
+        previous_position = self.previous_position['distance_to_goal']
+        moved = np.isnan(previous_position[:, 0]) | ~np.all(
+            np.abs(previous_position - position) <= 1 + 1e-05 * np.abs(position), axis=1
+        )
+        distance_to_goal = np.linalg.norm(position[:, 0:2] - self.goal_position[:, 0:2], axis=1)
+        metrics['distance_to_goal'] = np.where(moved, distance_to_goal, metrics['distance_to_goal'])
+        previous_position[moved] = position[moved]
+
+        # Success
+        near_goal = metrics['distance_to_goal'] <= self.success_distance
+        metrics['success'] = (self.is_end & near_goal).astype(np.float64)
+
+        # SDTW
+        metrics['sdtw'] = metrics['success'] * metrics['ndtw']
+
+        # PathLength
+        previous_position = self.previous_position['path_length']
+        previous_position[:] = np.where(np.isnan(previous_position), position, previous_position)
+        metrics['path_length'] += np.linalg.norm(position - previous_position, axis=1)
+        previous_position[:] = position
+
+        # OracleSuccess
+        metrics['oracle_success'] = ((metrics['oracle_success'] > 0) | near_goal).astype(np.float64)
+
+        # StepsTaken
+        metrics['steps_taken'] = self.step.astype(np.float64)
+
+
+@nb.njit(nogil=True, cache=True)
+def _extend_dtw_row(prev_row: np.array, distances: np.array) -> np.array:
+    row = np.empty_like(prev_row)
+    row[0] = distances[0] + prev_row[0]
+    for j in range(1, len(prev_row)):
+        row[j] = distances[j] + min(prev_row[j], row[j - 1], prev_row[j - 1])
+    return row
+
+
+class DTWAccumulator:
+    """
+    Exact DTW of a growing trajectory against a fixed reference path.
+
+    Only the last row of the DP matrix against gt_locations is kept; every new
+    location adds one row in O(len(gt_locations)), instead of rerunning DTW over
+    the whole trajectory.
+    """
+    def __init__(self, gt_locations: np.array):
+        self.gt_locations = np.ascontiguousarray(gt_locations, dtype=np.float64)
+        self.row = None
+        self.last_location = None
+
+    def add(self, location: np.array) -> float:
+        location = np.array(location, dtype=np.float64)
+        distances = np.linalg.norm(self.gt_locations - location, axis=1)
+
+        if self.row is None:
+            self.row = np.cumsum(distances)
+        else:
+            self.row = _extend_dtw_row(self.row, distances)
+        self.last_location = location
+
+        return self.distance
+
+    @property
+    def distance(self) -> float:
+        return float(self.row[-1])
+
+
+class MetricView:
+    """
+    dict-like access to one metric of one SimState, '_metric' and '_previous_position'
+    are read from and written to the SimStateBatch arrays, other keys stay in the view.
+    """
+    def __init__(self, store: SimStateBatch, name: str, index: int, extra: dict = None):
+        self._store = store
+        self._name = name
+        self._index = index
+        self._extra = extra if extra is not None else {}
+
+    def __getitem__(self, key):
+        if key == '_metric':
+            return float(self._store.metrics[self._name][self._index])
+        if key == '_previous_position':
+            position = self._store.previous_position[self._name][self._index]
+            if np.isnan(position[0]):
+                return None
+            return position.copy()
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key == '_metric':
+            self._store.metrics[self._name][self._index] = value
+        elif key == '_previous_position':
+            self._store.previous_position[self._name][self._index] = np.nan if value is None else value
+        else:
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        if key == '_previous_position':
+            return self._name in self._store.previous_position
+        return key == '_metric' or key in self._extra
+
+
 class SimState:
+    """
+    The state of one episode, a view on slot `index` of a SimStateBatch.
+
+    Without a store a private single slot SimStateBatch is created.
+    """
     def __init__(self, index=-1,
                  step=0,
                  episode_info={},
                  pose=airsim.Pose(),
+                 store: SimStateBatch = None,
                  ):
+        if store is None:
+            store = SimStateBatch(1)
+            index = 0
+        store.reset_at(index)
+
+        self._store = store
         self.index = index
         self.step = step
-        self.episode_info = copy.deepcopy(episode_info)
+        # the env hands over its own copy of the episode
+        self.episode_info = episode_info
 
         self.pose = pose
-        self.trajectory = []
         self.is_end = False
+        if 'goals' in episode_info:
+            store.goal_position[index] = episode_info['goals'][0]['position'][0:3]
 
         self.SUCCESS_DISTANCE = 20
 
-        self.DistanceToGoal = {
-            '_metric': 0,
-            '_previous_position': None,
-        }
-        self.Success = {
-            '_metric': 0,
-        }
-        self.NDTW = {
-            '_metric': 0,
-            'locations': [],
-            'gt_locations': (np.array(episode_info['reference_path'])[:, 0:3]).tolist(),
-        }
-        self.SDTW = {
-            '_metric': 0,
-        }
-        self.PathLength = {
-            '_metric': 0,
-            '_previous_position': None,
-        }
-        self.OracleSuccess = {
-            '_metric': 0,
-        }
-        self.StepsTaken = {
-            '_metric': 0,
-        }
+        self.DistanceToGoal = MetricView(store, 'distance_to_goal', index)
+        self.Success = MetricView(store, 'success', index)
+        gt_locations = np.array(episode_info['reference_path'], dtype=np.float64)[:, 0:3]
+        self.NDTW = MetricView(store, 'ndtw', index, extra={
+            'gt_locations': gt_locations,
+            'dtw': DTWAccumulator(gt_locations),
+        })
+        self.SDTW = MetricView(store, 'sdtw', index)
+        self.PathLength = MetricView(store, 'path_length', index)
+        self.OracleSuccess = MetricView(store, 'oracle_success', index)
+        self.StepsTaken = MetricView(store, 'steps_taken', index)
 
         self.distance_data_pre_frame = {
             'distance_front_data': 0.0,
@@ -72,25 +257,224 @@ class SimState:
         self.pre_action = AirsimActions.STOP
         self.is_collisioned = False
 
+        # False until the ENV worker holds the WORKER_STATE_FIELDS of this state
+        self.worker_synced = False
+
+    @property
+    def pose(self) -> airsim.Pose:
+        return arraysToPose(self._store.position[self.index], self._store.orientation[self.index])
+
+    @pose.setter
+    def pose(self, pose: airsim.Pose) -> None:
+        self._store.position[self.index] = (pose.position.x_val, pose.position.y_val, pose.position.z_val)
+        self._store.orientation[self.index] = (
+            pose.orientation.x_val, pose.orientation.y_val, pose.orientation.z_val, pose.orientation.w_val,
+        )
+
+    @property
+    def position(self) -> np.ndarray:
+        return self._store.position[self.index]
+
+    @property
+    def step(self) -> int:
+        return int(self._store.step[self.index])
+
+    @step.setter
+    def step(self, step: int) -> None:
+        self._store.step[self.index] = step
+
+    @property
+    def is_end(self) -> bool:
+        return bool(self._store.is_end[self.index])
+
+    @is_end.setter
+    def is_end(self, is_end: bool) -> None:
+        self._store.is_end[self.index] = is_end
+
+    @property
+    def is_collisioned(self) -> bool:
+        return bool(self._store.is_collisioned[self.index])
+
+    @is_collisioned.setter
+    def is_collisioned(self, is_collisioned: bool) -> None:
+        self._store.is_collisioned[self.index] = is_collisioned
+
+    @property
+    def SUCCESS_DISTANCE(self) -> float:
+        return float(self._store.success_distance[self.index])
+
+    @SUCCESS_DISTANCE.setter
+    def SUCCESS_DISTANCE(self, success_distance: float) -> None:
+        self._store.success_distance[self.index] = success_distance
+
+    @property
+    def trajectory(self) -> list:
+        return self._store.get_trajectory(self.index).tolist()
+
+    @trajectory.setter
+    def trajectory(self, trajectory: list) -> None:
+        self._store.trajectory_len[self.index] = 0
+        for item in trajectory:
+            self._store.append_trajectory(self.index, airsim.Pose(
+                position_val=airsim.Vector3r(x_val=item[0], y_val=item[1], z_val=item[2]),
+                orientation_val=airsim.Quaternionr(x_val=item[3], y_val=item[4], z_val=item[5], w_val=item[6]),
+            ))
+
+    def append_trajectory(self, pose: airsim.Pose) -> None:
+        self._store.append_trajectory(self.index, pose)
+
+
+# SimState fields read and updated inside the ENV workers (teacher action / progress sensor)
+WORKER_STATE_FIELDS = [
+    'pre_carrot_idx',
+    'start_point_nearest_node_token',
+    'end_point_nearest_node_token',
+    'progress',
+    'waypoint',
+    'unique_path',
+]
+
+
+class WorkerState:
+    """
+    The part of a SimState an ENV worker needs, kept in the worker between steps.
+
+    Every step only a compact record (step, is_end, pose, pre_action) is sent to the
+    worker and only the changed WORKER_STATE_FIELDS are sent back, instead of pickling
+    the whole SimState with its episode, trajectory and metrics both ways.
+    """
+    def __init__(self, episode_info: dict, worker_fields: dict):
+        self.episode_info = episode_info
+
+        self.step = 0
+        self.is_end = False
+        self.pose = airsim.Pose()
+        self.pre_action = AirsimActions.STOP
+
+        for name in WORKER_STATE_FIELDS:
+            setattr(self, name, copy.deepcopy(worker_fields[name]))
+
+    def update_record(self, record: tuple) -> None:
+        step, is_end, pose, pre_action, _ = record
+        self.step = step
+        self.is_end = is_end
+        self.pose = airsim.Pose(
+            position_val=airsim.Vector3r(x_val=pose[0], y_val=pose[1], z_val=pose[2]),
+            orientation_val=airsim.Quaternionr(x_val=pose[3], y_val=pose[4], z_val=pose[5], w_val=pose[6]),
+        )
+        self.pre_action = pre_action
+
+    def snapshot(self) -> dict:
+        snapshot = {
+            name: getattr(self, name)
+            for name in WORKER_STATE_FIELDS if name not in ['waypoint', 'unique_path']
+        }
+        # shallow copies: waypoints are replaced and unique_path is appended to in place, never mutated deeper
+        snapshot['waypoint'] = dict(self.waypoint)
+        snapshot['unique_path'] = list(self.unique_path) if self.unique_path is not None else None
+        return snapshot
+
+    def get_delta(self, snapshot: dict) -> dict:
+        delta = {}
+        for name in WORKER_STATE_FIELDS:
+            if name == 'waypoint':
+                changed_waypoint = {
+                    k: v for k, v in self.waypoint.items()
+                    if k not in snapshot['waypoint'] or _is_changed(snapshot['waypoint'][k], v)
+                }
+                if len(changed_waypoint) > 0:
+                    delta['waypoint'] = changed_waypoint
+            elif _is_changed(snapshot[name], getattr(self, name)):
+                delta[name] = getattr(self, name)
+        return delta
+
+
+def _is_changed(old, new) -> bool:
+    # numpy values do not compare to a single bool, a value that cannot be compared is sent
+    try:
+        return bool(old != new)
+    except ValueError:
+        try:
+            return not np.array_equal(np.asarray(old), np.asarray(new))
+        except ValueError:
+            return True
+
+
+def make_state_record(state: SimState) -> tuple:
+    pose = state.pose
+    worker_fields = None
+    if not state.worker_synced:
+        worker_fields = {name: getattr(state, name) for name in WORKER_STATE_FIELDS}
+
+    return (
+        int(state.step),
+        bool(state.is_end),
+        (
+            pose.position.x_val, pose.position.y_val, pose.position.z_val,
+            pose.orientation.x_val, pose.orientation.y_val, pose.orientation.z_val, pose.orientation.w_val,
+        ),
+        state.pre_action,
+        worker_fields,
+    )
+
+
+def apply_state_delta(state: SimState, delta: dict) -> SimState:
+    for name, value in delta.items():
+        if name == 'waypoint':
+            state.waypoint.update(value)
+        else:
+            setattr(state, name, value)
+    state.worker_synced = True
+    return state
+
 
 class ENV:
     def __init__(self, load_scenes: list):
         self.batch = None
 
         if args.run_type in ['collect', 'train'] and args.collect_type in ['dagger', 'SF']:
-            self.shortest_path_sensor = ShortestPathSensor(args.nav_graph_path, args.token_dict_path, load_scenes)
+            self.shortest_path_sensor = ShortestPathSensor(
+                args.nav_graph_path, args.token_dict_path, load_scenes,
+                csr_path=args.nav_graph_csr_path,
+                scene_cache_size=args.nav_graph_cache_size,
+            )
 
-            self.nav_graph_token_dict = {}
-            for scen_id in load_scenes:
-                self.nav_graph_token_dict[scen_id] = self.shortest_path_sensor.token_dicts[scen_id]
+            # scene_id -> token dict, loaded lazily by the sensor
+            self.nav_graph_token_dict = self.shortest_path_sensor.token_dicts
 
-    def set_batch(self, batch):
-        self.batch = copy.deepcopy(batch)
+    def set_batch(self, batch: dict):
+        """
+        :param batch: batch index -> episode, only the episodes this worker serves
+        """
+        self.batch = batch
+        self.worker_states = {index: None for index in self.batch.keys()}
         return
 
+    def get_obs_at_record(self, index: int, record: tuple):
+        """
+        get_obs_at for a record of make_state_record, returns the changed worker fields instead of the state
+        """
+        worker_fields = record[4]
+        if worker_fields is not None or self.worker_states.get(index) is None:
+            assert worker_fields is not None, 'worker state of {} is not synced'.format(index)
+            self.worker_states[index] = WorkerState(self.batch[index], worker_fields)
+
+        state = self.worker_states[index]
+        state.update_record(record)
+        snapshot = state.snapshot()
+
+        (teacher_action, teacher_next_point, done, progress), state = self.get_obs_at(index, state)
+
+        return (teacher_action, teacher_next_point, done, progress), state.get_delta(snapshot)
+
     def get_obs_at(self, index: int, state):
+        """
+        teacher_action is None when teacher_next_point is set, the caller picks it with
+        get_teacher_actions_towards for all envs at once
+        """
         assert self.batch is not None, 'batch is None'
         item = self.batch[index]
+        teacher_next_point = None
 
         if args.run_type in ['collect', 'train'] and args.collect_type in ['TF']:
             if state.step >= len(item['actions']) or state.is_end:
@@ -113,7 +497,7 @@ class ENV:
             if state.is_end:
                 teacher_action = AirsimActions.STOP
             else:
-                teacher_action, state = get_teacher_action_at(index, state, self.nav_graph_token_dict, self.shortest_path_sensor)
+                (teacher_action, teacher_next_point), state = get_teacher_target_at(index, state, self.nav_graph_token_dict, self.shortest_path_sensor)
 
             done = state.is_end
             progress, state = get_progress_sensor_at(index, state, self.nav_graph_token_dict, self.shortest_path_sensor)
@@ -129,11 +513,15 @@ class ENV:
             logger.error('wrong type')
             raise NotImplementedError
 
-        return (teacher_action, done, progress), state
+        return (teacher_action, teacher_next_point, done, progress), state
 
 
-def get_teacher_action_at(index: int, state: SimState, nav_graph_token_dict: dict, shortest_path_sensor: ShortestPathSensor):
-    prev_action = state.pre_action
+def get_teacher_target_at(index: int, state: SimState, nav_graph_token_dict: dict, shortest_path_sensor: ShortestPathSensor):
+    """
+    :return: (teacher_action, None) when the action is known here (on the reference path, STOP),
+             otherwise (None, next nav graph node) to be scored by get_teacher_actions_towards
+    """
+    teacher_next_point = None
 
     if state.step < len(state.episode_info['reference_path']) and \
         np.allclose(
@@ -148,123 +536,52 @@ def get_teacher_action_at(index: int, state: SimState, nav_graph_token_dict: dic
         scene_id = int(state.episode_info['scene_id'])
 
         source = [state.pose.position.x_val, state.pose.position.y_val, state.pose.position.z_val]
-        source_nearest_node_token = cast_point_to_nearest_node_in_nav_graph_2(source, nav_graph_token_dict[scene_id])
 
+        target_nearest_node_token = None
         if args.dagger_mode == 'end':
-            if state.end_point_nearest_node_token is not None:
-                target_nearest_node_token = state.end_point_nearest_node_token
-            else:
-                target = state.episode_info['goals'][0]['position']
-                target_nearest_node_token = cast_point_to_nearest_node_in_nav_graph_2(target, nav_graph_token_dict[scene_id])
-
-                state.end_point_nearest_node_token = target_nearest_node_token
+            target = state.episode_info['goals'][0]['position']
+            target_nearest_node_token = state.end_point_nearest_node_token
 
         elif args.dagger_mode == 'nearest':
             waypoint, state = find_waypoint_at(index, state)
-            waypoint_token = cast_point_to_nearest_node_in_nav_graph_2(waypoint, nav_graph_token_dict[scene_id])
-
             target = waypoint
-            target_nearest_node_token = waypoint_token
 
         else:
             raise NotImplementedError
 
-        pose = state.pose
-
+        # source and target nodes in one query
+        if target_nearest_node_token is None:
+            source_nearest_node_token, target_nearest_node_token = shortest_path_sensor.get_nearest_tokens(
+                [source, target], [scene_id, scene_id]
+            )
+            if args.dagger_mode == 'end':
+                state.end_point_nearest_node_token = target_nearest_node_token
+        else:
+            source_nearest_node_token = shortest_path_sensor.get_nearest_token(source, scene_id)
 
         while True:
-            shortest_paths = shortest_path_sensor.get_shortest_paths(
+            vs_token = shortest_path_sensor.get_next_hop(
                 str(source_nearest_node_token),
                 str(target_nearest_node_token),
                 int(scene_id)
             )
-            if len(shortest_paths) <= 1:
+            if vs_token is None:
                 if state.pre_carrot_idx < len(state.unique_path)-1:
                     waypoint, state = find_waypoint_at(index, state, force_to_find_next=True)
-                    waypoint_token = cast_point_to_nearest_node_in_nav_graph_2(waypoint, nav_graph_token_dict[scene_id])
+                    waypoint_token = shortest_path_sensor.get_nearest_token(waypoint, scene_id)
 
                     target = waypoint
                     target_nearest_node_token = waypoint_token
                 else:
                     teacher_action = AirsimActions.STOP
-                    return teacher_action, state
+                    return (teacher_action, teacher_next_point), state
             else:
                 break
 
-        vs_token = shortest_path_sensor.get_vs_token(shortest_paths[1], scene_id)
-        next_point = np.array(nav_graph_token_dict[scene_id][vs_token])
-
-
-        #
-        end_to_current_yaw = math.atan2(next_point[1] - pose.position.y_val, next_point[0] - pose.position.x_val) - airsim.to_eularian_angles(pose.orientation)[2]
-        if abs(end_to_current_yaw) > math.radians(90):
-            if abs(end_to_current_yaw) > math.radians(180):
-                if end_to_current_yaw > 0:
-                    end_to_current_yaw = math.radians(-360) + end_to_current_yaw
-                else:
-                    end_to_current_yaw = math.radians(360) + end_to_current_yaw
-
-            if end_to_current_yaw > 0:
-                teacher_action = AirsimActions.TURN_RIGHT
-            else:
-                teacher_action = AirsimActions.TURN_LEFT
-
-            return teacher_action, state
-
-
-        #
-        new_poses = []
-        action_list = [action for action in AirsimActions._known_actions.values()]
-        for action in action_list:
-            new_pose = getPoseAfterMakeAction(pose, action)
-
-            if action in [AirsimActions.TURN_LEFT, AirsimActions.TURN_RIGHT]:
-                new_pose = getPoseAfterMakeAction(new_pose, AirsimActions.MOVE_FORWARD)
-
-            new_poses.append(new_pose)
-
-        new_positions = []
-        for new_pose in new_poses:
-            new_positions.append(
-                np.array([new_pose.position.x_val, new_pose.position.y_val, new_pose.position.z_val])
-            )
-
-        distance_list = []
-        for position in new_positions:
-            distance_list.append(
-                EuclideanDistance3(position, next_point)
-            )
-        distance_list_argsort = np.array(distance_list).argsort()
-
-
-        #
-        teacher_action = AirsimActions.STOP
-        for i in range(len(distance_list_argsort)):
-            if distance_list_argsort[i] in [AirsimActions.STOP]:
-                continue
-
-            # 上下
-            if action_list[distance_list_argsort[i]] == AirsimActions.GO_UP and prev_action == AirsimActions.GO_DOWN:
-                continue
-            elif action_list[distance_list_argsort[i]] == AirsimActions.GO_DOWN and prev_action == AirsimActions.GO_UP:
-                continue
-
-            # 左右
-            elif action_list[distance_list_argsort[i]] == AirsimActions.MOVE_LEFT and prev_action == AirsimActions.MOVE_RIGHT:
-                continue
-            elif action_list[distance_list_argsort[i]] == AirsimActions.MOVE_RIGHT and prev_action == AirsimActions.MOVE_LEFT:
-                continue
-
-            # 左转 右转
-            elif action_list[distance_list_argsort[i]] == AirsimActions.TURN_LEFT and prev_action == AirsimActions.TURN_RIGHT:
-                continue
-            elif action_list[distance_list_argsort[i]] == AirsimActions.TURN_RIGHT and prev_action == AirsimActions.TURN_LEFT:
-                continue
-
-            teacher_action = action_list[distance_list_argsort[i]]
-            break
+        teacher_action = None
+        teacher_next_point = np.array(nav_graph_token_dict[scene_id][vs_token][0:3], dtype=np.float64)
 
-    return teacher_action, state
+    return (teacher_action, teacher_next_point), state
 
 
 def find_waypoint_at(index: int, state: SimState, force_to_find_next=False):
@@ -335,40 +652,33 @@ def find_carrot_pos(curr_pos, pre_carrot_idx, path, unique_path):
 def get_progress_sensor_at(index: int, state: SimState, nav_graph_token_dict: dict, shortest_path_sensor: ShortestPathSensor):
     scene_id = int(state.episode_info['scene_id'])
 
-    # 1
-    if state.start_point_nearest_node_token is not None:
-        start_point_token = state.start_point_nearest_node_token
-    else:
-        start_point = state.episode_info['start_position']
-        start_point_token = cast_point_to_nearest_node_in_nav_graph_2(start_point, nav_graph_token_dict[scene_id])
-        state.start_point_nearest_node_token = start_point_token
-
     # 2
     curr_pos = [state.pose.position.x_val, state.pose.position.y_val, state.pose.position.z_val]
-    curr_pos_token = cast_point_to_nearest_node_in_nav_graph_2(curr_pos, nav_graph_token_dict[scene_id])
 
     # 3
     waypoint, state = find_waypoint_at(index, state)
-    waypoint_token = cast_point_to_nearest_node_in_nav_graph_2(waypoint, nav_graph_token_dict[scene_id])
 
-    # 4
-    if state.end_point_nearest_node_token is not None:
-        goal_token = state.end_point_nearest_node_token
-    else:
-        goal = state.episode_info['goals'][0]['position']
-        goal_token = cast_point_to_nearest_node_in_nav_graph_2(goal, nav_graph_token_dict[scene_id])
-        state.end_point_nearest_node_token = goal_token
+    # 1, 4 the start and goal nodes are looked up once per episode, all nodes in one query
+    positions = [curr_pos, waypoint]
+    if state.start_point_nearest_node_token is None:
+        positions.append(state.episode_info['start_position'])
+    if state.end_point_nearest_node_token is None:
+        positions.append(state.episode_info['goals'][0]['position'])
+
+    tokens = shortest_path_sensor.get_nearest_tokens(positions, [scene_id for _ in positions])
+    curr_pos_token, waypoint_token = tokens[0], tokens[1]
+    tokens = tokens[2:]
+    if state.start_point_nearest_node_token is None:
+        state.start_point_nearest_node_token = tokens.pop(0)
+    if state.end_point_nearest_node_token is None:
+        state.end_point_nearest_node_token = tokens.pop(0)
 
     # 1
-    curr_pos_2_waypoint_shortest_paths = shortest_path_sensor.get_shortest_paths(
+    curr_pos_2_waypoint_steps = shortest_path_sensor.get_hop_count(
         source=curr_pos_token,
         target=waypoint_token,
         scene_id=int(scene_id),
     )
-    if len(curr_pos_2_waypoint_shortest_paths) <= 1:
-        curr_pos_2_waypoint_steps = 0
-    else:
-        curr_pos_2_waypoint_steps = len(curr_pos_2_waypoint_shortest_paths) - 1
 
     # 2
     waypoint_2_goal_steps = len(state.unique_path)-1 - state.pre_carrot_idx
@@ -390,161 +700,212 @@ def get_progress_sensor_at(index: int, state: SimState, nav_graph_token_dict: di
     return progress, state
 
 
-def getPoseAfterMakeAction(pose: airsim.Pose, action):
-    current_position = np.array([pose.position.x_val, pose.position.y_val, pose.position.z_val])
-    current_rotation = np.array([
-        pose.orientation.x_val, pose.orientation.y_val, pose.orientation.z_val, pose.orientation.w_val
-    ])
-
-    if action == AirsimActions.MOVE_FORWARD:
-        pitch, roll, yaw = airsim.to_eularian_angles(airsim.Quaternionr(
-            x_val=current_rotation[0],
-            y_val=current_rotation[1],
-            z_val=current_rotation[2],
-            w_val=current_rotation[3]
-        ))
-        pitch = 0
-        roll = 0
-
-        unit_x = 1 * math.cos(pitch) * math.cos(yaw)
-        unit_y = 1 * math.cos(pitch) * math.sin(yaw)
-        unit_z = 1 * math.sin(pitch) * (-1)
-        unit_vector = np.array([unit_x, unit_y, unit_z])
-        assert unit_z == 0
-
-        new_position = np.array(current_position) + unit_vector * AirsimActionSettings.FORWARD_STEP_SIZE
-        new_rotation = current_rotation.copy()
-    elif action == AirsimActions.TURN_LEFT:
-        pitch, roll, yaw = airsim.to_eularian_angles(airsim.Quaternionr(
-            x_val=current_rotation[0],
-            y_val=current_rotation[1],
-            z_val=current_rotation[2],
-            w_val=current_rotation[3]
-        ))
-        pitch = 0
-        roll = 0
-
-        new_pitch = pitch
-        new_roll = roll
-        new_yaw = yaw - math.radians(AirsimActionSettings.TURN_ANGLE)
-        if float(new_yaw * 180 / math.pi) < -180:
-            new_yaw = math.radians(360) + new_yaw
-
-        new_position = current_position.copy()
-        new_rotation = airsim.to_quaternion(new_pitch, new_roll, new_yaw)
-        new_rotation = [
-            new_rotation.x_val, new_rotation.y_val, new_rotation.z_val, new_rotation.w_val
-        ]
-    elif action == AirsimActions.TURN_RIGHT:
-        pitch, roll, yaw = airsim.to_eularian_angles(airsim.Quaternionr(
-            x_val=current_rotation[0],
-            y_val=current_rotation[1],
-            z_val=current_rotation[2],
-            w_val=current_rotation[3]
-        ))
-        pitch = 0
-        roll = 0
-
-        new_pitch = pitch
-        new_roll = roll
-        new_yaw = yaw + math.radians(AirsimActionSettings.TURN_ANGLE)
-        if float(new_yaw * 180 / math.pi) > 180:
-            new_yaw = math.radians(-360) + new_yaw
-
-        new_position = current_position.copy()
-        new_rotation = airsim.to_quaternion(new_pitch, new_roll, new_yaw)
-        new_rotation = [
-            new_rotation.x_val, new_rotation.y_val, new_rotation.z_val, new_rotation.w_val
-        ]
-    elif action == AirsimActions.GO_UP:
-        pitch, roll, yaw = airsim.to_eularian_angles(airsim.Quaternionr(
-            x_val=current_rotation[0],
-            y_val=current_rotation[1],
-            z_val=current_rotation[2],
-            w_val=current_rotation[3]
-        ))
-        pitch = 0
-        roll = 0
-
-        unit_vector = np.array([0, 0, -1])
-
-        new_position = np.array(current_position) + unit_vector * AirsimActionSettings.UP_DOWN_STEP_SIZE
-        new_rotation = current_rotation.copy()
-    elif action == AirsimActions.GO_DOWN:
-        pitch, roll, yaw = airsim.to_eularian_angles(airsim.Quaternionr(
-            x_val=current_rotation[0],
-            y_val=current_rotation[1],
-            z_val=current_rotation[2],
-            w_val=current_rotation[3]
-        ))
-        pitch = 0
-        roll = 0
-
-        unit_vector = np.array([0, 0, -1])
-
-        new_position = np.array(current_position) + unit_vector * AirsimActionSettings.UP_DOWN_STEP_SIZE * (-1)
-        new_rotation = current_rotation.copy()
-    elif action == AirsimActions.MOVE_LEFT:
-        pitch, roll, yaw = airsim.to_eularian_angles(airsim.Quaternionr(
-            x_val=current_rotation[0],
-            y_val=current_rotation[1],
-            z_val=current_rotation[2],
-            w_val=current_rotation[3]
-        ))
-        pitch = 0
-        roll = 0
-
-        unit_x = 1.0 * math.cos(math.radians(float(yaw * 180 / math.pi) + 90))
-        unit_y = 1.0 * math.sin(math.radians(float(yaw * 180 / math.pi) + 90))
-        unit_vector = np.array([unit_x, unit_y, 0])
-
-        new_position = np.array(current_position) + unit_vector * AirsimActionSettings.LEFT_RIGHT_STEP_SIZE * (-1)
-        new_rotation = current_rotation.copy()
-    elif action == AirsimActions.MOVE_RIGHT:
-        pitch, roll, yaw = airsim.to_eularian_angles(airsim.Quaternionr(
-            x_val=current_rotation[0],
-            y_val=current_rotation[1],
-            z_val=current_rotation[2],
-            w_val=current_rotation[3]
-        ))
-        pitch = 0
-        roll = 0
-
-        unit_x = 1.0 * math.cos(math.radians(float(yaw * 180 / math.pi) + 90))
-        unit_y = 1.0 * math.sin(math.radians(float(yaw * 180 / math.pi) + 90))
-        unit_vector = np.array([unit_x, unit_y, 0])
-
-        new_position = np.array(current_position) + unit_vector * AirsimActionSettings.LEFT_RIGHT_STEP_SIZE
-        new_rotation = current_rotation.copy()
-    else:
-        new_position = current_position.copy()
-        new_rotation = current_rotation.copy()
+def _buildActionTables():
+    """
+    :return: (local displacement (forward, right, down) per action id, turn step per action id)
+    """
+    action_num = max([int(_) for _ in AirsimActions._known_actions.values()]) + 1
+    displacements = np.zeros((action_num, 3), dtype=np.float64)
+    turns = np.zeros((action_num,), dtype=np.int64)
+
+    displacements[AirsimActions.MOVE_FORWARD] = (AirsimActionSettings.FORWARD_STEP_SIZE, 0, 0)
+    displacements[AirsimActions.GO_UP] = (0, 0, -AirsimActionSettings.UP_DOWN_STEP_SIZE)
+    displacements[AirsimActions.GO_DOWN] = (0, 0, AirsimActionSettings.UP_DOWN_STEP_SIZE)
+    displacements[AirsimActions.MOVE_LEFT] = (0, -AirsimActionSettings.LEFT_RIGHT_STEP_SIZE, 0)
+    displacements[AirsimActions.MOVE_RIGHT] = (0, AirsimActionSettings.LEFT_RIGHT_STEP_SIZE, 0)
+    turns[AirsimActions.TURN_LEFT] = -1
+    turns[AirsimActions.TURN_RIGHT] = 1
+
+    return displacements, turns
+
+
+ACTION_DISPLACEMENTS, ACTION_TURNS = _buildActionTables()
+
+
+def getYaws(orientations: np.ndarray) -> np.ndarray:
+    """
+    yaw of airsim.to_eularian_angles for (N, 4) xyzw quaternions
+    """
+    x, y, z, w = orientations[:, 0], orientations[:, 1], orientations[:, 2], orientations[:, 3]
+    return np.arctan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z))
+
+
+def batchPosesAfterActions(positions, orientations, actions_list):
+    """
+    Apply one action sequence per pose to a whole batch of poses.
+
+    Every action moves in the yaw plane of the current heading (pitch and roll are ignored),
+    turns change the yaw by TURN_ANGLE and reset pitch and roll. A sequence therefore
+    reduces to a displacement in the frame of the start yaw plus a net turn count,
+    with no quaternion round trip per action.
+
+    :param positions: (N, 3)
+    :param orientations: (N, 4) xyzw
+    :param actions_list: N action sequences
+    :return: new (positions, orientations)
+    """
+    positions = np.array(positions, dtype=np.float64).reshape((-1, 3))
+    orientations = np.array(orientations, dtype=np.float64).reshape((-1, 4))
+    assert len(positions) == len(actions_list), 'wrong args of batchPosesAfterActions'
+
+    max_len = max([len(actions) for actions in actions_list] + [1])
+    actions = np.full((len(actions_list), max_len), AirsimActions.STOP, dtype=np.int64)
+    for index, item in enumerate(actions_list):
+        actions[index, :len(item)] = item
+
+    # net turns before every action, then the displacements rotated into the start yaw frame
+    turn_steps = ACTION_TURNS[actions]
+    turn_cnt = np.cumsum(turn_steps, axis=1)
+    turn_angles = turn_cnt * math.radians(AirsimActionSettings.TURN_ANGLE)
+    cos_turn, sin_turn = np.cos(turn_angles), np.sin(turn_angles)
+
+    displacements = ACTION_DISPLACEMENTS[actions]
+    local_x = np.sum(cos_turn * displacements[:, :, 0] - sin_turn * displacements[:, :, 1], axis=1)
+    local_y = np.sum(sin_turn * displacements[:, :, 0] + cos_turn * displacements[:, :, 1], axis=1)
+
+    yaws = getYaws(orientations)
+    cos_yaw, sin_yaw = np.cos(yaws), np.sin(yaws)
+
+    new_positions = positions.copy()
+    new_positions[:, 0] += cos_yaw * local_x - sin_yaw * local_y
+    new_positions[:, 1] += sin_yaw * local_x + cos_yaw * local_y
+    new_positions[:, 2] += np.sum(displacements[:, :, 2], axis=1)
+
+    new_yaws = yaws + turn_cnt[:, -1] * math.radians(AirsimActionSettings.TURN_ANGLE)
+    new_yaws -= 2 * math.pi * np.round(new_yaws / (2 * math.pi))
+
+    new_orientations = orientations.copy()
+    is_turned = np.any(turn_steps != 0, axis=1)
+    new_orientations[is_turned] = np.stack([
+        np.zeros_like(new_yaws), np.zeros_like(new_yaws), np.sin(new_yaws / 2), np.cos(new_yaws / 2),
+    ], axis=1)[is_turned]
+
+    return new_positions, new_orientations
+
+
+def batchPosesAfterAction(positions, orientations, actions):
+    """
+    batchPosesAfterActions with a single action per pose
+    """
+    return batchPosesAfterActions(positions, orientations, [[int(action)] for action in actions])
+
+
+def poseToArrays(pose: airsim.Pose):
+    """
+    :return: (position xyz, orientation xyzw)
+    """
+    return (
+        np.array([pose.position.x_val, pose.position.y_val, pose.position.z_val], dtype=np.float64),
+        np.array([
+            pose.orientation.x_val, pose.orientation.y_val, pose.orientation.z_val, pose.orientation.w_val
+        ], dtype=np.float64),
+    )
+
 
-    new_pose = airsim.Pose(
+def arraysToPose(position, orientation) -> airsim.Pose:
+    return airsim.Pose(
         position_val=airsim.Vector3r(
-            x_val=new_position[0],
-            y_val=new_position[1],
-            z_val=new_position[2]
+            x_val=float(position[0]), y_val=float(position[1]), z_val=float(position[2]),
         ),
         orientation_val=airsim.Quaternionr(
-            x_val=new_rotation[0],
-            y_val=new_rotation[1],
-            z_val=new_rotation[2],
-            w_val=new_rotation[3]
-        )
+            x_val=float(orientation[0]), y_val=float(orientation[1]),
+            z_val=float(orientation[2]), w_val=float(orientation[3]),
+        ),
     )
-    return new_pose
+
+
+def getPoseAfterMakeAction(pose: airsim.Pose, action):
+    return getPoseAfterMakeActions(pose, [action])
 
 
 def getPoseAfterMakeActions(
         pose: airsim.Pose,
         actions,
 ):
-    current_pose = copy.deepcopy(pose)
-    for action in actions:
-        current_pose = getPoseAfterMakeAction(current_pose, action)
+    position, orientation = poseToArrays(pose)
+    new_positions, new_orientations = batchPosesAfterActions(position, orientation, [list(actions)])
+    return arraysToPose(new_positions[0], new_orientations[0])
+
+
+def _buildTeacherTables():
+    """
+    :return: (candidate displacement per action in the body frame at yaw 0, reversal of every action)
+    """
+    action_list = sorted([int(action) for action in AirsimActions._known_actions.values()])
+
+    # turns are judged by where the following forward step would end up
+    actions_list = []
+    for action in action_list:
+        if action in [AirsimActions.TURN_LEFT, AirsimActions.TURN_RIGHT]:
+            actions_list.append([action, AirsimActions.MOVE_FORWARD])
+        else:
+            actions_list.append([action])
+    displacements, _ = batchPosesAfterActions(
+        np.zeros((len(action_list), 3)),
+        np.tile([0.0, 0.0, 0.0, 1.0], (len(action_list), 1)),
+        actions_list,
+    )
 
-    return current_pose
+    reverse_actions = np.full((len(action_list),), -1, dtype=np.int64)
+    for action_a, action_b in [
+        (AirsimActions.GO_UP, AirsimActions.GO_DOWN),
+        (AirsimActions.MOVE_LEFT, AirsimActions.MOVE_RIGHT),
+        (AirsimActions.TURN_LEFT, AirsimActions.TURN_RIGHT),
+    ]:
+        reverse_actions[action_a] = action_b
+        reverse_actions[action_b] = action_a
+
+    return displacements, reverse_actions
+
+
+TEACHER_DISPLACEMENTS, TEACHER_REVERSE_ACTIONS = _buildTeacherTables()
+
+
+def get_teacher_actions_towards(positions, orientations, next_points, prev_actions) -> np.ndarray:
+    """
+    Teacher action of every pose towards its next nav graph node.
+
+    Facing away (more than 90 degrees) turns towards the node. Otherwise the action whose
+    candidate position (the displacement table rotated by the current yaw) is nearest to
+    the node wins, never undoing the previous action and never STOP.
+
+    :param positions: (N, 3)
+    :param orientations: (N, 4) xyzw
+    :param next_points: (N, 3)
+    :param prev_actions: N previous actions
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape((-1, 3))
+    next_points = np.asarray(next_points, dtype=np.float64).reshape((-1, 3))
+    yaws = getYaws(np.asarray(orientations, dtype=np.float64).reshape((-1, 4)))
+    prev_actions = np.array([-1 if _ is None else int(_) for _ in prev_actions], dtype=np.int64)
+
+    # candidates (N, A, 3)
+    cos_yaw, sin_yaw = np.cos(yaws)[:, None], np.sin(yaws)[:, None]
+    candidates = np.empty((len(positions), len(TEACHER_DISPLACEMENTS), 3), dtype=np.float64)
+    candidates[:, :, 0] = positions[:, 0:1] + cos_yaw * TEACHER_DISPLACEMENTS[:, 0] - sin_yaw * TEACHER_DISPLACEMENTS[:, 1]
+    candidates[:, :, 1] = positions[:, 1:2] + sin_yaw * TEACHER_DISPLACEMENTS[:, 0] + cos_yaw * TEACHER_DISPLACEMENTS[:, 1]
+    candidates[:, :, 2] = positions[:, 2:3] + TEACHER_DISPLACEMENTS[:, 2]
+    distances = np.linalg.norm(candidates - next_points[:, None, :], axis=2)
+
+    is_reversal = np.arange(len(TEACHER_DISPLACEMENTS))[None, :] == np.where(
+        prev_actions >= 0, TEACHER_REVERSE_ACTIONS[np.clip(prev_actions, 0, None)], -1
+    )[:, None]
+    is_reversal[:, AirsimActions.STOP] = True
+    distances[is_reversal] = np.inf
+    teacher_actions = np.argmin(distances, axis=1)
+    teacher_actions[np.all(is_reversal, axis=1)] = AirsimActions.STOP
+
+    # facing away from the next node, judged on the unwrapped yaw difference as before,
+    # the turn direction on the wrapped one
+    end_to_current_yaws = np.arctan2(next_points[:, 1] - positions[:, 1], next_points[:, 0] - positions[:, 0]) - yaws
+    is_facing_away = np.abs(end_to_current_yaws) > math.radians(90)
+    end_to_current_yaws = np.where(end_to_current_yaws > math.pi, end_to_current_yaws - 2 * math.pi, end_to_current_yaws)
+    end_to_current_yaws = np.where(end_to_current_yaws < -math.pi, end_to_current_yaws + 2 * math.pi, end_to_current_yaws)
+    teacher_actions[is_facing_away] = np.where(
+        end_to_current_yaws[is_facing_away] > 0, AirsimActions.TURN_RIGHT, AirsimActions.TURN_LEFT
+    )
+
+    return teacher_actions
 
 
 def cast_point_to_nearest_node_in_nav_graph_2(pos, nav_graph_token_dict) -> str:
@@ -649,7 +1010,8 @@ def _cast_point_to_nearest_node_in_nav_graph_NUMBA(pos, node_key_list, distance_
 def get_pano_observations(
         current_pose: airsim.Pose,
         tool: AirVLNSimulatorClientTool,
-        scene_id=0
+        scene_id=0,
+        use_pano_cameras=False,
 ):
     # return pano rgb-d observation.
     # pano sequence:
@@ -659,6 +1021,20 @@ def get_pano_observations(
     pano_obs = []
     pano_pose = []
     new_pose = current_pose
+
+    # all 8 views in one request from the pano camera ring, the drone is not rotated
+    if use_pano_cameras:
+        for i in range(8):
+            pano_pose.append(np.array(
+                [new_pose.position.x_val, new_pose.position.y_val, new_pose.position.z_val,
+                 new_pose.orientation.x_val,new_pose.orientation.y_val,new_pose.orientation.z_val,new_pose.orientation.w_val]))
+            new_pose = getPoseAfterMakeActions(new_pose, actions)
+
+        obs_responses = tool.getPanoImageResponses()
+        pano_obs = list(obs_responses[0][0])
+
+        return pano_obs, pano_pose
+
     for i in range(8):
         pano_pose.append(np.array(
             [new_pose.position.x_val, new_pose.position.y_val, new_pose.position.z_val,
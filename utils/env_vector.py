@@ -13,12 +13,12 @@ from typing import (
 )
 import numpy as np
 import attr
-import copy
 
 from src.common.param import args
 
 from utils.pickle5_multiprocessing import ConnectionWrapper
-from utils.env_utils import ENV
+from utils.env_utils import ENV, make_state_record, apply_state_delta, get_teacher_actions_towards
+from utils.shorest_path_sensor import ConvertNavGraphsToCSR
 from utils.logger import logger
 
 
@@ -117,6 +117,10 @@ class VectorEnvUtil:
         self.load_scenes = load_scenes
         self._num_envs = int(num_envs)
 
+        # convert once here, the workers then only memory-map the shared files
+        if args.run_type in ['collect', 'train'] and args.collect_type in ['dagger', 'SF']:
+            ConvertNavGraphsToCSR(args.nav_graph_path, args.token_dict_path, args.nav_graph_csr_path, load_scenes)
+
         self._mp_ctx = mp.get_context(multiprocessing_start_method)
         self._workers = []
         (
@@ -163,10 +167,10 @@ class VectorEnvUtil:
                     connection_write_fn(True)
 
                 elif command == COMMAND_GET_OBS:
-                    index, state = data
-                    (teacher_action, done, progress), state = env.get_obs_at(index, state)
+                    index, record = data
+                    (teacher_action, teacher_next_point, done, progress), delta = env.get_obs_at_record(index, record)
                     connection_write_fn(
-                        ((teacher_action, done, progress), state)
+                        ((teacher_action, teacher_next_point, done, progress), delta)
                     )
 
                 elif command == COMMAND_GET_COLLISION_SENSOR:
@@ -257,11 +261,16 @@ class VectorEnvUtil:
 
 
     def set_batch(self, batch):
-        self.batch = copy.deepcopy(batch)
+        # read only here, the caller already hands over its own copy
+        self.batch = list(batch)
 
+        # worker i only serves batch[i], the pipe pickling is its copy
         for index in range(self._num_envs):
+            episode = {
+                key: value for key, value in self.batch[index].items() if key not in ['instruction']
+            } if index < len(self.batch) else None
             self._connection_write_fns[index](
-                (COMMAND_SET_BATCH, copy.deepcopy(batch))
+                (COMMAND_SET_BATCH, {index: episode})
             )
 
         results = [
@@ -274,27 +283,45 @@ class VectorEnvUtil:
     def get_obs(self, obs_states) -> Tuple[List[Any], List[Any]]:
         self.obs_states = obs_states
 
+        # only a compact record goes to the worker, images stay in this process
         for index in range(len(obs_states)):
             _, _, state = obs_states[index]
             self._connection_write_fns[index](
-                (COMMAND_GET_OBS, (index, state))
+                (COMMAND_GET_OBS, (index, make_state_record(state)))
             )
 
         results = [
             self._connection_read_fns[index]() for index in range(len(obs_states))
         ]
 
-        obs = []
         sim_states = []
         for index in range(len(obs_states)):
-            (teacher_action, done, progress), sim_state = results[index]
+            _, delta = results[index]
+            sim_state = apply_state_delta(obs_states[index][2], delta)
 
             self.obs_states[index] = (obs_states[index][0], obs_states[index][1], sim_state)
+            sim_states.append(sim_state)
 
+        # workers only find the next nav graph node, the actions towards it are picked in one batch
+        teacher_actions = [results[index][0][0] for index in range(len(obs_states))]
+        target_indexes = [index for index in range(len(obs_states)) if results[index][0][1] is not None]
+        if len(target_indexes) > 0:
+            poses = [sim_states[index].pose for index in target_indexes]
+            target_actions = get_teacher_actions_towards(
+                np.array([[pose.position.x_val, pose.position.y_val, pose.position.z_val] for pose in poses]),
+                np.array([[pose.orientation.x_val, pose.orientation.y_val, pose.orientation.z_val, pose.orientation.w_val] for pose in poses]),
+                np.array([results[index][0][1] for index in target_indexes]),
+                [sim_states[index].pre_action for index in target_indexes],
+            )
+            for index, teacher_action in zip(target_indexes, target_actions):
+                teacher_actions[index] = int(teacher_action)
+
+        obs = []
+        for index in range(len(obs_states)):
+            _, _, done, progress = results[index][0]
             obs.append(
-                self._format_obs_at(index, teacher_action, done, progress)
+                self._format_obs_at(index, teacher_actions[index], done, progress)
             )
-            sim_states.append(sim_state)
 
         return obs, sim_states
 
@@ -0,0 +1,168 @@
+import atexit
+import queue
+import threading
+import time
+from typing import Optional, Set
+
+import lmdb
+
+from utils.logger import logger
+
+
+class LMDBWriter:
+    """
+    Background writer of one LMDB environment.
+
+    put() only enqueues, a writer thread drains the queue into one write transaction and
+    commits it once `group_commit_size` entries or `group_commit_bytes` bytes are pending,
+    or `group_commit_interval` seconds after the first pending entry, so the stepping thread
+    never waits on a commit. A full queue blocks put() (back-pressure) instead of growing.
+
+    When a `collected_keys` set is given, a key only enters it after the transaction holding it
+    has been committed, `key in writer` also sees keys that are still queued. Entries put with
+    track=False (e.g. shared trajectory records) are written without entering the set.
+
+    A failed commit stops the writer: the keys of everything not committed are dropped,
+    later put() and flush() calls raise the error. flush() after close() returns at once.
+    """
+    def __init__(
+        self,
+        lmdb_env: lmdb.Environment,
+        name: str,
+        collected_keys: Optional[Set[str]] = None,
+        max_queue_size: int = 256,
+        group_commit_size: int = 32,
+        group_commit_bytes: int = 256 * 1024 * 1024,
+        group_commit_interval: float = 5.0,
+    ):
+        self.lmdb_env = lmdb_env
+        self.name = name
+        self.collected_keys = collected_keys
+
+        self.group_commit_size = group_commit_size
+        self.group_commit_bytes = group_commit_bytes
+        self.group_commit_interval = group_commit_interval
+
+        self.start_id = self.lmdb_env.stat()["entries"]
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._pending_keys = set()
+        self._pending_lock = threading.Lock()
+        self._error = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name='LMDBWriter-{}'.format(name))
+        self._thread.daemon = True
+        self._thread.start()
+
+        atexit.register(self.close)
+
+    def __contains__(self, key: str) -> bool:
+        assert self.collected_keys is not None, 'LMDBWriter {} does not track keys'.format(self.name)
+        if key in self.collected_keys:
+            return True
+        with self._pending_lock:
+            return key in self._pending_keys
+
+    def put(self, key: str, value: bytes, track: bool = True) -> None:
+        self._raise_error()
+        assert not self._closed, 'LMDBWriter {} is closed'.format(self.name)
+
+        track = track and self.collected_keys is not None
+        if track:
+            with self._pending_lock:
+                self._pending_keys.add(key)
+
+        item = (key, value, track)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            logger.warning('lmdb writer of {} is full, waiting for commit'.format(self.name))
+            self._queue.put(item)
+
+    def flush(self) -> None:
+        """
+        Block until everything put so far is committed, a closed writer already committed all
+        """
+        self._raise_error()
+        if self._closed:
+            return
+        self._queue.put(None)
+        self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._queue.put(None)
+            self._queue.join()
+        finally:
+            self._queue.put(False)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        # queue items: (key, value, track), None asks for a commit now (flush), False stops the thread
+        while True:
+            items = [self._queue.get()]
+            first_time = time.time()
+            group_bytes = len(items[0][1]) if isinstance(items[0], tuple) else 0
+
+            # gather one group
+            while isinstance(items[-1], tuple) \
+                    and len(items) < self.group_commit_size \
+                    and group_bytes < self.group_commit_bytes:
+                timeout = self.group_commit_interval - (time.time() - first_time)
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                if isinstance(items[-1], tuple):
+                    group_bytes += len(items[-1][1])
+
+            entries = [_ for _ in items if isinstance(_, tuple)]
+            try:
+                if self._error is None and len(entries) > 0:
+                    self._commit(entries)
+            except Exception as e:
+                logger.error('lmdb writer of {} failed: {}'.format(self.name, e))
+                self._error = e
+            finally:
+                # nothing is written after a failure, the keys must not count as collected
+                if self._error is not None:
+                    self._discard(entries)
+                for _ in items:
+                    self._queue.task_done()
+
+            if items[-1] is False:
+                return
+
+    def _discard(self, entries: list) -> None:
+        with self._pending_lock:
+            for key, _, _ in entries:
+                self._pending_keys.discard(key)
+
+    def _commit(self, entries: list) -> None:
+        with self.lmdb_env.begin(write=True) as txn:
+            for key, value, _ in entries:
+                txn.put(key.encode(), value)
+
+        self.start_id = self.lmdb_env.stat()["entries"]
+        logger.info('lmdb of {}, commit {} entries, lmdb_start_id: {}'.format(self.name, len(entries), self.start_id))
+
+        if self.collected_keys is None:
+            return
+        with self._pending_lock:
+            for key, _, track in entries:
+                if not track:
+                    continue
+                self.collected_keys.add(key)
+                self._pending_keys.discard(key)
@@ -0,0 +1,127 @@
+import copy
+from typing import Dict, List, Optional
+
+from utils.logger import logger
+
+
+class ScenePlacement:
+    """
+    Decides which machine opens which batch slot.
+
+    Every machine keeps a moving average of its per-scene step latency (the time of one
+    batched simulator call divided by the scenes it served). Slot counts are handed out
+    greedily to the machine whose predicted step time stays lowest, capped by MAX_SCENE_NUM,
+    so a slow render node gets fewer scenes instead of gating every step. Within those counts
+    a scene stays on the machine that already had it open. A machine that got no scenes is not
+    measured, its estimate decays toward the mean of the others until it is handed scenes again.
+    """
+    def __init__(self, machines_info: list, latency_decay: float = 0.8, rebalance_threshold: float = 0.1):
+        self.machines_info = copy.deepcopy(machines_info)
+        self.latency_decay = latency_decay
+        self.rebalance_threshold = rebalance_threshold
+
+        # MACHINE_IP -> seconds per open scene per batched call
+        self.scene_step_latency: Dict[str, float] = {}
+
+        self.last_slot_nums: Optional[List[int]] = None
+        self.last_open_scenes: List[list] = [[] for _ in self.machines_info]
+
+    def update_latency(self, machine_ip: str, step_latency: float, scene_num: int) -> None:
+        if scene_num <= 0 or step_latency is None:
+            self._decay_latency(machine_ip)
+            return
+
+        latency = float(step_latency) / scene_num
+        if machine_ip not in self.scene_step_latency:
+            self.scene_step_latency[machine_ip] = latency
+        else:
+            self.scene_step_latency[machine_ip] = \
+                self.latency_decay * self.scene_step_latency[machine_ip] + (1 - self.latency_decay) * latency
+
+    def _decay_latency(self, machine_ip: str) -> None:
+        # without a measurement a slow estimate would never change and starve the machine for good
+        if machine_ip not in self.scene_step_latency:
+            return
+
+        others = [latency for ip, latency in self.scene_step_latency.items() if ip != machine_ip]
+        if len(others) == 0:
+            return
+
+        mean_latency = sum(others) / len(others)
+        self.scene_step_latency[machine_ip] = \
+            self.latency_decay * self.scene_step_latency[machine_ip] + (1 - self.latency_decay) * mean_latency
+
+    def _get_scene_step_latencies(self) -> List[float]:
+        measured = list(self.scene_step_latency.values())
+        default_latency = sum(measured) / len(measured) if len(measured) > 0 else 1.0
+        return [
+            self.scene_step_latency.get(item['MACHINE_IP'], default_latency)
+            for item in self.machines_info
+        ]
+
+    def _predict_step_latency(self, slot_nums: List[int]) -> float:
+        latencies = self._get_scene_step_latencies()
+        return max([latency * num for latency, num in zip(latencies, slot_nums)])
+
+    def _get_slot_nums(self, slot_num: int) -> List[int]:
+        latencies = self._get_scene_step_latencies()
+
+        slot_nums = [0 for _ in self.machines_info]
+        for _ in range(slot_num):
+            candidates = [
+                index for index, item in enumerate(self.machines_info)
+                if slot_nums[index] < int(item['MAX_SCENE_NUM'])
+            ]
+            assert len(candidates) > 0, 'error args param: batch_size'
+            best = min(candidates, key=lambda index: (latencies[index] * (slot_nums[index] + 1), index))
+            slot_nums[best] += 1
+
+        # only move scenes between machines when it pays off noticeably
+        if self.last_slot_nums is not None and sum(self.last_slot_nums) == slot_num:
+            last_latency = self._predict_step_latency(self.last_slot_nums)
+            new_latency = self._predict_step_latency(slot_nums)
+            if new_latency > last_latency * (1 - self.rebalance_threshold):
+                return list(self.last_slot_nums)
+
+            logger.info(
+                'rebalance machines: {} -> {}, predicted step latency: {:.4f}s -> {:.4f}s'.format(
+                    self.last_slot_nums, slot_nums, last_latency, new_latency,
+                )
+            )
+
+        return slot_nums
+
+    def assign(self, scene_id_list: list):
+        """
+        :return: (machines_info with open_scenes filled in, batch indexes nested as [machine][scene])
+        """
+        slot_nums = self._get_slot_nums(len(scene_id_list))
+
+        batch_indexes = [[] for _ in self.machines_info]
+        unassigned = list(range(len(scene_id_list)))
+
+        # open-scene affinity: keep a scene on the machine that has it running
+        for index_1, _ in enumerate(self.machines_info):
+            last_open_scenes = [str(_) for _ in self.last_open_scenes[index_1]]
+            for index in list(unassigned):
+                if len(batch_indexes[index_1]) >= slot_nums[index_1]:
+                    break
+                if str(scene_id_list[index]) in last_open_scenes:
+                    last_open_scenes.remove(str(scene_id_list[index]))
+                    batch_indexes[index_1].append(index)
+                    unassigned.remove(index)
+
+        for index_1, _ in enumerate(self.machines_info):
+            while len(batch_indexes[index_1]) < slot_nums[index_1]:
+                batch_indexes[index_1].append(unassigned.pop(0))
+            batch_indexes[index_1].sort()
+        assert len(unassigned) == 0, 'error create machines_info'
+
+        machines_info = copy.deepcopy(self.machines_info)
+        for index_1, item in enumerate(machines_info):
+            item['open_scenes'] = [scene_id_list[index] for index in batch_indexes[index_1]]
+
+        self.last_slot_nums = list(slot_nums)
+        self.last_open_scenes = [list(item['open_scenes']) for item in machines_info]
+
+        return machines_info, batch_indexes
@@ -0,0 +1,80 @@
+import collections
+from typing import Dict, List, Optional
+
+from utils.logger import logger
+
+
+class SceneScheduler:
+    """
+    Packs the episodes of one epoch into `slot_num` lanes, lane i feeds slot i of every batch.
+
+    Scenes are sorted by episode count and poured lane after lane (wrap-around), so every
+    lane runs through a few long single-scene segments and a slot only changes its scene
+    at a segment border. With S scenes and B lanes there are at most S + B - 1 segments,
+    i.e. at most S - 1 scene switches per epoch besides the B initial scene loads.
+    """
+    def __init__(self, slot_num: int, machines_info: Optional[list] = None):
+        if machines_info is not None:
+            total_max_scene_num = sum([int(item['MAX_SCENE_NUM']) for item in machines_info])
+            assert slot_num <= total_max_scene_num, 'error args param: slot_num'
+
+        self.slot_num = slot_num
+        self.lanes: List[collections.deque] = [collections.deque() for _ in range(slot_num)]
+
+        self.expected_scene_loads = 0
+        self.expected_scene_switches = 0
+
+    def schedule(self, episodes: list) -> None:
+        scene_episodes: Dict[str, list] = collections.OrderedDict()
+        for item in episodes:
+            scene_episodes.setdefault(str(item['scene_id']), []).append(item)
+        scene_order = sorted(scene_episodes.keys(), key=lambda k: len(scene_episodes[k]), reverse=True)
+
+        lane_len = -(-len(episodes) // self.slot_num)
+        self.lanes = [collections.deque() for _ in range(self.slot_num)]
+
+        lane_index = 0
+        for scene_id in scene_order:
+            for item in scene_episodes[scene_id]:
+                if len(self.lanes[lane_index]) >= lane_len:
+                    lane_index += 1
+                self.lanes[lane_index].append(item)
+
+        self.expected_scene_loads = sum([self._count_segments(lane) for lane in self.lanes])
+        self.expected_scene_switches = max(
+            self.expected_scene_loads - len([lane for lane in self.lanes if len(lane) > 0]), 0
+        )
+        logger.info(
+            'scene scheduler: {} episodes, {} scenes, {} slots, expected scene loads per epoch: {}, expected scene switches per epoch: {}'.format(
+                len(episodes), len(scene_order), self.slot_num,
+                self.expected_scene_loads, self.expected_scene_switches,
+            )
+        )
+
+    def pop(self, slot: int):
+        """
+        Next episode for `slot`, None when the epoch is used up.
+
+        An empty lane takes over the tail of the longest lane, which keeps the head
+        scene of that lane in place.
+        """
+        if len(self.lanes[slot]) > 0:
+            return self.lanes[slot].popleft()
+
+        longest_lane = max(self.lanes, key=len)
+        if len(longest_lane) == 0:
+            return None
+        return longest_lane.pop()
+
+    def __len__(self) -> int:
+        return sum([len(lane) for lane in self.lanes])
+
+    @staticmethod
+    def _count_segments(lane) -> int:
+        segments = 0
+        last_scene_id = None
+        for item in lane:
+            if str(item['scene_id']) != last_scene_id:
+                segments += 1
+                last_scene_id = str(item['scene_id'])
+        return segments
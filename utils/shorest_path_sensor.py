@@ -5,7 +5,13 @@ import numpy as np
 import numba as nb
 import networkx as nx
 import json
+import shutil
+import collections
+import collections.abc
 from pathlib import Path
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 # import igraph as ig
 
 
@@ -42,18 +48,269 @@ def Distance(edge, termial, token_dict):
     return float(distance)
 
 
+class NavNodeIndex:
+    """
+    KD-tree over the node positions of one scene, built once per loaded scene.
+    """
+    def __init__(self, tokens, points: np.ndarray):
+        self.tokens = tokens
+        self.tree = cKDTree(np.asarray(points, dtype=np.float64).reshape((-1, 3)))
+
+    def query(self, pos) -> str:
+        _, idx = self.tree.query(np.array(pos, dtype=np.float64)[0:3])
+        return str(self.tokens[int(idx)])
+
+    def query_batch(self, positions) -> list:
+        _, idxs = self.tree.query(np.array(positions, dtype=np.float64).reshape((-1, 3)))
+        return [str(self.tokens[int(idx)]) for idx in idxs]
+
+
+CSR_FILE_NAMES = ['indptr', 'indices', 'weights', 'points', 'tokens', 'sorted_tokens', 'sorted_vs_indexes']
+
+
+def GraphToCSR(graph):
+    """
+    Symmetric weighted adjacency of an undirected igraph graph, parallel edges keep the lightest weight
+
+    :return: (indptr, indices, weights) of a csr matrix, one entry per direction of every edge
+    """
+    vertex_num = graph.vcount()
+    edges = np.array(graph.get_edgelist(), dtype=np.int64).reshape((-1, 2))
+    weights = np.array(graph.es["weight"], dtype=np.float64)
+
+    u = np.minimum(edges[:, 0], edges[:, 1])
+    v = np.maximum(edges[:, 0], edges[:, 1])
+    order = np.lexsort((weights, v, u))
+    u, v, weights = u[order], v[order], weights[order]
+    keep = (u != v)
+    keep[1:] &= (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    u, v, weights = u[keep], v[keep], weights[keep]
+
+    matrix = csr_matrix(
+        (np.concatenate([weights, weights]), (np.concatenate([u, v]), np.concatenate([v, u]))),
+        shape=(vertex_num, vertex_num),
+    )
+    matrix.sort_indices()
+
+    return (
+        matrix.indptr.astype(np.int32),
+        matrix.indices.astype(np.int32),
+        matrix.data.astype(np.float64),
+    )
+
+
+CSR_SOURCE_FILE_NAME = 'source.json'
+
+
+def _GetCSRSource(nav_graph_file, token_dict_file) -> dict:
+    # mtime and size of the files a scene was converted from
+    source = {}
+    for file in [nav_graph_file, token_dict_file]:
+        stat = os.stat(str(file))
+        source[str(file)] = [int(stat.st_mtime_ns), int(stat.st_size)]
+    return source
+
+
+def _IsCSRUpToDate(scene_path, source: dict) -> bool:
+    try:
+        with open(Path(scene_path) / CSR_SOURCE_FILE_NAME, 'r', encoding='utf-8') as file:
+            return json.load(file) == source
+    except (OSError, ValueError):
+        return False
+
+
+def ConvertSceneToCSR(nav_graph_path, token_dict_path, csr_path, scene_id) -> str:
+    """
+    Convert nav_graph_dict_{id}.pkl and TokenDict_{id}.json into the .npy files read by NavGraphCSR.
+
+    The mtime and size of both source files are kept in source.json, a scene is converted again
+    when they change. Written into a temporary directory first and renamed, so workers converting
+    the same scene concurrently never see half-written files.
+    """
+    scene_path = Path(csr_path) / 'scene_{}'.format(scene_id)
+    nav_graph_file = Path(nav_graph_path) / 'nav_graph_dict_{}.pkl'.format(scene_id)
+    token_dict_file = Path(token_dict_path) / 'TokenDict_{}.json'.format(scene_id)
+
+    source = _GetCSRSource(nav_graph_file, token_dict_file)
+    if scene_path.exists() and _IsCSRUpToDate(scene_path, source):
+        return str(scene_path)
+
+    import igraph as ig
+
+    print(
+        "{}\tConvertSceneToCSR of Scene {}".format(
+            str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+            scene_id
+        )
+    )
+
+    graph = ig.Graph.Read_Pickle(str(nav_graph_file))
+    with open(token_dict_file, 'r', encoding='utf-8') as file:
+        token_dict = json.load(file)
+
+    tokens = np.array([str(name) for name in graph.vs['name']])
+    points = np.array([token_dict[str(name)] for name in tokens], dtype=np.float64).reshape((-1, 3))
+    indptr, indices, weights = GraphToCSR(graph)
+    sorted_vs_indexes = np.argsort(tokens, kind='stable').astype(np.int32)
+
+    arrays = {
+        'indptr': indptr,
+        'indices': indices,
+        'weights': weights,
+        'points': points,
+        'tokens': tokens,
+        'sorted_tokens': tokens[sorted_vs_indexes],
+        'sorted_vs_indexes': sorted_vs_indexes,
+    }
+
+    os.makedirs(str(Path(csr_path)), exist_ok=True)
+    tmp_path = Path(csr_path) / 'scene_{}.tmp{}'.format(scene_id, os.getpid())
+    os.makedirs(str(tmp_path), exist_ok=True)
+    for name in CSR_FILE_NAMES:
+        np.save(str(tmp_path / '{}.npy'.format(name)), arrays[name])
+    with open(tmp_path / CSR_SOURCE_FILE_NAME, 'w', encoding='utf-8') as file:
+        json.dump(source, file)
+
+    # move a stale conversion aside, processes that mapped its files keep reading them
+    if scene_path.exists() and not _IsCSRUpToDate(scene_path, source):
+        stale_path = Path(csr_path) / 'scene_{}.stale{}'.format(scene_id, os.getpid())
+        try:
+            os.rename(str(scene_path), str(stale_path))
+            shutil.rmtree(str(stale_path), ignore_errors=True)
+        except OSError:
+            pass
+
+    try:
+        os.rename(str(tmp_path), str(scene_path))
+    except OSError:
+        # another process finished the same scene first
+        shutil.rmtree(str(tmp_path), ignore_errors=True)
+
+    return str(scene_path)
+
+
+def ConvertNavGraphsToCSR(nav_graph_path, token_dict_path, csr_path, scene_ids=SCENE_IDS) -> None:
+    for scene_id in scene_ids:
+        ConvertSceneToCSR(nav_graph_path, token_dict_path, csr_path, int(scene_id))
+
+
+class NavGraphCSR:
+    """
+    Read-only nav graph of one scene, every array is memory-mapped so that all
+    processes on a machine share the same pages.
+    """
+    def __init__(self, scene_path):
+        for name in CSR_FILE_NAMES:
+            setattr(self, name, np.load(str(Path(scene_path) / '{}.npy'.format(name)), mmap_mode='r'))
+
+        vertex_num = len(self.tokens)
+        self.csr = csr_matrix((self.weights, self.indices, self.indptr), shape=(vertex_num, vertex_num), copy=False)
+        self.token_dict = SceneTokenDict(self)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def get_vs_index(self, token: str) -> int:
+        token = str(token)
+        pos = int(np.searchsorted(self.sorted_tokens, token))
+        if pos >= len(self.sorted_tokens) or str(self.sorted_tokens[pos]) != token:
+            raise KeyError(token)
+        return int(self.sorted_vs_indexes[pos])
+
+    def get_token(self, vs_index: int) -> str:
+        return str(self.tokens[int(vs_index)])
+
+
+class SceneTokenDict(collections.abc.Mapping):
+    """
+    token -> position view of a NavGraphCSR, the drop-in for one TokenDict_{id}.json
+    """
+    def __init__(self, nav_graph: NavGraphCSR):
+        self.nav_graph = nav_graph
+
+    def __getitem__(self, token):
+        return self.nav_graph.points[self.nav_graph.get_vs_index(token)]
+
+    def __iter__(self):
+        return (str(token) for token in self.nav_graph.tokens)
+
+    def __len__(self) -> int:
+        return len(self.nav_graph)
+
+
+class GoalTree:
+    """
+    Shortest-path tree of one scene rooted at a goal / waypoint vertex.
+
+    The adjacency stores both directions of every edge, so the tree parent of a vertex is its next hop towards the root
+    and its depth is the hop count of that path.
+    """
+    def __init__(self, csr_graph: csr_matrix, root: int):
+        self.root = int(root)
+        self.distances, self.predecessors = dijkstra(
+            csr_graph, directed=True, indices=self.root, return_predecessors=True,
+        )
+
+        # parents are strictly closer to the root, so ascending distance is a topological order
+        self.hops = np.full(len(self.predecessors), -1, dtype=np.int64)
+        self.hops[self.root] = 0
+        reachable = np.flatnonzero(np.isfinite(self.distances))
+        for vs_index in reachable[np.argsort(self.distances[reachable], kind='stable')]:
+            if vs_index != self.root:
+                self.hops[vs_index] = self.hops[self.predecessors[vs_index]] + 1
+
+    def next_hop(self, vs_index: int) -> int:
+        """
+        :return: next vertex towards the root, -1 at the root or when unreachable
+        """
+        if vs_index == self.root:
+            return -1
+        return int(self.predecessors[vs_index]) if self.predecessors[vs_index] >= 0 else -1
+
+    def hop_count(self, vs_index: int) -> int:
+        """
+        :return: edges between vertex and root, -1 when unreachable
+        """
+        return int(self.hops[vs_index])
+
+
+class SceneTokenDicts(collections.abc.Mapping):
+    """
+    scene_id -> SceneTokenDict of a ShortestPathSensor, a scene is loaded when it is first looked up
+    """
+    def __init__(self, sensor):
+        self.sensor = sensor
+
+    def __getitem__(self, scene_id):
+        return self.sensor.get_token_dict(scene_id)
+
+    def __iter__(self):
+        return iter(self.sensor.load_scenes)
+
+    def __len__(self) -> int:
+        return len(self.sensor.load_scenes)
+
+
 class ShortestPathSensor:
-    def __init__(self, nav_graph_path, token_dict_path, load_scenes=SCENE_IDS) -> None:
+    def __init__(self, nav_graph_path, token_dict_path, load_scenes=SCENE_IDS, goal_tree_cache_size=64, csr_path=None, scene_cache_size=8) -> None:
         self.nav_graph_path = nav_graph_path
         self.token_dict_path = token_dict_path
+        self.csr_path = csr_path if csr_path is not None else str(Path(nav_graph_path) / 'csr')
 
         self.load_scenes = load_scenes
 
         # build
         # self.graphs, self.token_dicts = self._BuildNXGraphs(scene_ids=load_scenes)
 
-        # load only
-        self.graphs, self.token_dicts = self._LoadNXGraphs(scene_ids=load_scenes)
+        # load only, on first use of a scene
+        # scene_id -> (NavGraphCSR, NavNodeIndex), LRU
+        self.scene_cache_size = scene_cache_size
+        self.scenes = collections.OrderedDict()
+        self.token_dicts = SceneTokenDicts(self)
+
+        # (scene_id, root token) -> GoalTree, LRU
+        self.goal_tree_cache_size = goal_tree_cache_size
+        self.goal_trees = collections.OrderedDict()
 
     def _LoadOriFiles(self, scene_idx):
         file_name_graph = Path(args.ori_nav_graph_path) / 'nav_graph_dict_{}.json'.format(scene_idx)
@@ -148,6 +405,8 @@ class ShortestPathSensor:
         return graphs, token_dicts
 
     def _LoadNXGraphs(self, scene_ids=SCENE_IDS):
+        import igraph as ig
+
         graphs = {}
         token_dicts = {}
 
@@ -169,36 +428,131 @@ class ShortestPathSensor:
 
         return graphs, token_dicts
 
-    def get_shortest_paths(self, source: str, target: str, scene_id: int):
-        assert scene_id in self.load_scenes, 'wrong scene_id of get_shortest_paths'
-        graph = self.graphs[int(scene_id)]
+    def _LoadCSRGraph(self, scene_id: int):
+        print(
+            "{}\tLoadCSRGraph of Scene {}".format(
+                str(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())),
+                scene_id
+            )
+        )
 
-        try:
-            source_vs = graph.vs.find(name=str(source))
-            target_vs = graph.vs.find(name=str(target))
-        except Exception as e:
-            print('wrong token of get_shortest_paths: {}'.format(e))
-            raise Exception(e)
+        scene_path = ConvertSceneToCSR(self.nav_graph_path, self.token_dict_path, self.csr_path, int(scene_id))
+        graph = NavGraphCSR(scene_path)
+        node_index = NavNodeIndex(graph.tokens, graph.points)
 
-        shortest_paths = graph.get_shortest_paths(
-            source_vs,
-            to=target_vs,
-            weights=graph.es["weight"],
-            output="vpath",
-        )
-        if shortest_paths is None or len(shortest_paths) <= 0:
+        return graph, node_index
+
+    def _get_scene(self, scene_id: int):
+        assert int(scene_id) in self.load_scenes, 'wrong scene_id of _get_scene'
+        scene_id = int(scene_id)
+
+        if scene_id in self.scenes:
+            self.scenes.move_to_end(scene_id)
+            return self.scenes[scene_id]
+
+        self.scenes[scene_id] = self._LoadCSRGraph(scene_id)
+        while len(self.scenes) > self.scene_cache_size:
+            evicted_scene_id, _ = self.scenes.popitem(last=False)
+            for key in [key for key in self.goal_trees.keys() if key[0] == evicted_scene_id]:
+                del self.goal_trees[key]
+
+        return self.scenes[scene_id]
+
+    def get_graph(self, scene_id: int) -> NavGraphCSR:
+        return self._get_scene(scene_id)[0]
+
+    def get_token_dict(self, scene_id: int) -> SceneTokenDict:
+        return self._get_scene(scene_id)[0].token_dict
+
+    def get_shortest_paths(self, source: str, target: str, scene_id: int):
+        """
+        :return: vertex indexes from source to target, [] when unreachable
+        """
+        goal_tree = self.get_goal_tree(target, scene_id)
+
+        vs_index = self._get_vs_index(source, int(scene_id))
+        if goal_tree.hop_count(vs_index) < 0:
             print('get_shortest_paths error, could not found path')
             return []
 
-        return shortest_paths[0]
+        shortest_paths = [vs_index]
+        while shortest_paths[-1] != goal_tree.root:
+            shortest_paths.append(goal_tree.next_hop(shortest_paths[-1]))
+
+        return shortest_paths
+
+    def _get_vs_index(self, token: str, scene_id: int) -> int:
+        try:
+            return self.get_graph(scene_id).get_vs_index(token)
+        except KeyError as e:
+            print('wrong token of get_goal_tree: {}'.format(e))
+            raise Exception(e)
+
+    def get_goal_tree(self, target: str, scene_id: int) -> GoalTree:
+        """
+        Shortest-path tree rooted at target, computed once and kept while it is in use
+        """
+        assert scene_id in self.load_scenes, 'wrong scene_id of get_goal_tree'
+        scene_id = int(scene_id)
+
+        key = (scene_id, str(target))
+        if key in self.goal_trees:
+            self.goal_trees.move_to_end(key)
+            return self.goal_trees[key]
+
+        goal_tree = GoalTree(self.get_graph(scene_id).csr, self._get_vs_index(target, scene_id))
+
+        self.goal_trees[key] = goal_tree
+        while len(self.goal_trees) > self.goal_tree_cache_size:
+            self.goal_trees.popitem(last=False)
+
+        return goal_tree
+
+    def get_next_hop(self, source: str, target: str, scene_id: int):
+        """
+        :return: token of the next node on the shortest path from source to target,
+                 None when source is target or target is unreachable
+        """
+        goal_tree = self.get_goal_tree(target, scene_id)
+        vs_index = goal_tree.next_hop(self._get_vs_index(source, int(scene_id)))
+        if vs_index < 0:
+            return None
+        return self.get_vs_token(vs_index, scene_id)
+
+    def get_hop_count(self, source: str, target: str, scene_id: int) -> int:
+        """
+        :return: edges on the shortest path from source to target, 0 when unreachable
+        """
+        goal_tree = self.get_goal_tree(target, scene_id)
+        return max(goal_tree.hop_count(self._get_vs_index(source, int(scene_id))), 0)
+
+    def get_nearest_token(self, pos, scene_id: int) -> str:
+        """
+        Token of the nav graph node nearest to pos
+        """
+        assert int(scene_id) in self.load_scenes, 'wrong scene_id of get_nearest_token'
+        return self._get_scene(scene_id)[1].query(pos)
+
+    def get_nearest_tokens(self, positions: list, scene_ids: list) -> list:
+        """
+        get_nearest_token for a whole batch, one KD-tree query per scene
+        """
+        assert len(positions) == len(scene_ids), 'wrong args of get_nearest_tokens'
+
+        tokens = [None for _ in positions]
+        for scene_id in set([int(_) for _ in scene_ids]):
+            idxs = [i for i, _ in enumerate(scene_ids) if int(_) == scene_id]
+            scene_tokens = self._get_scene(scene_id)[1].query_batch([positions[i][0:3] for i in idxs])
+            for i, token in zip(idxs, scene_tokens):
+                tokens[i] = token
+
+        return tokens
 
     def get_vs_token(self, vs_index, scene_id: int):
         assert scene_id in self.load_scenes, 'wrong scene_id of get_vs_token'
 
         try:
-            graph = self.graphs[int(scene_id)]
-
-            vs_token = str(graph.vs[vs_index]['name'])
+            vs_token = self.get_graph(scene_id).get_token(vs_index)
         except Exception as e:
             print('wrong vs_token of get_vs_token: {}'.format(e))
             raise Exception(e)
@@ -0,0 +1,137 @@
+import struct
+import zlib
+
+import msgpack
+import msgpack_numpy
+import numpy as np
+
+from utils.logger import logger
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+
+# b'AVLN' + uint8 version, blobs without it are plain msgpack_numpy
+CODEC_MAGIC = b'AVLN'
+CODEC_VERSION = 1
+CODEC_HEADER = CODEC_MAGIC + struct.pack('<B', CODEC_VERSION)
+
+COMPRESSIONS = ['none', 'zlib', 'zstd']
+
+
+def _is_depth(name: str) -> bool:
+    return name == 'depth' or (name.startswith('depth') and not name.endswith('_features'))
+
+
+def _is_features(name: str) -> bool:
+    return name.endswith('_features')
+
+
+class TrajectoryCodec:
+    """
+    Typed, compressed encoding of the trajectories and frames written to the lmdb stores.
+
+    Every numpy array is stored on its own with its original dtype and shape, optionally
+    narrowed (float16 for features and depth, uint8 for depth quantized to its own value
+    range) and compressed (zstd, zlib). decode() restores the original dtype, so readers
+    get the same arrays back whatever the writer was configured with.
+    """
+    def __init__(self, compression: str = 'zstd', level: int = 3, float16: bool = False, depth_uint8: bool = False):
+        assert compression in COMPRESSIONS, 'error args param: lmdb_codec'
+
+        if compression == 'zstd' and zstd is None:
+            logger.warning('zstandard is not installed, trajectory codec falls back to zlib')
+            compression = 'zlib'
+
+        self.compression = compression
+        self.level = level
+        self.float16 = float16
+        self.depth_uint8 = depth_uint8
+
+        self._compressor = zstd.ZstdCompressor(level=level) if compression == 'zstd' else None
+
+    def encode(self, obj, name: str = '') -> bytes:
+        """
+        :param name: name of obj when it is a bare array (e.g. 'rgb', 'depth'), dict keys name nested arrays
+        """
+        return CODEC_HEADER + msgpack.packb(self._encode_item(obj, name), use_bin_type=True)
+
+    def _encode_item(self, obj, name: str):
+        if isinstance(obj, np.ndarray):
+            return self._encode_array(obj, name)
+        if isinstance(obj, dict):
+            return {k: self._encode_item(v, str(k)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [self._encode_item(v, name) for v in obj]
+        return obj
+
+    def _encode_array(self, array: np.ndarray, name: str) -> dict:
+        array = np.ascontiguousarray(array)
+        item = {
+            '__nd__': True,
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+        }
+
+        if array.dtype.kind == 'f':
+            if self.depth_uint8 and _is_depth(name) and array.size > 0:
+                low, high = float(np.min(array)), float(np.max(array))
+                scale = (high - low) / 255 if high > low else 1.0
+                item['quant'] = [low, scale]
+                array = np.round((array - low) / scale).astype(np.uint8)
+            elif self.float16 and (_is_features(name) or _is_depth(name)):
+                array = array.astype(np.float16)
+
+        item['stored'] = array.dtype.str
+        item['codec'] = self.compression
+        item['data'] = self._compress(array.tobytes())
+        return item
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == 'zstd':
+            return self._compressor.compress(data)
+        if self.compression == 'zlib':
+            return zlib.compress(data, self.level)
+        return data
+
+
+def _decompress(data: bytes, compression: str) -> bytes:
+    if compression == 'zstd':
+        assert zstd is not None, 'zstandard is needed to decode this lmdb store'
+        return zstd.ZstdDecompressor().decompress(data)
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    return data
+
+
+def _decode_item(obj):
+    if isinstance(obj, dict):
+        if obj.get('__nd__', False) is True:
+            data = _decompress(obj['data'], obj['codec'])
+            array = np.frombuffer(data, dtype=np.dtype(obj['stored'])).reshape(obj['shape'])
+            if 'quant' in obj:
+                low, scale = obj['quant']
+                array = array.astype(np.float64) * scale + low
+            return array.astype(np.dtype(obj['dtype']), copy=False)
+        return {k: _decode_item(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_decode_item(v) for v in obj]
+    return obj
+
+
+def decode(buffer):
+    """
+    Decode a value of the lmdb stores, written by TrajectoryCodec or as plain msgpack_numpy
+    """
+    header = bytes(buffer[:len(CODEC_HEADER)])
+    if header[:len(CODEC_MAGIC)] != CODEC_MAGIC:
+        return msgpack_numpy.unpackb(buffer, raw=False)
+
+    version = struct.unpack('<B', header[len(CODEC_MAGIC):])[0]
+    assert version <= CODEC_VERSION, 'lmdb store written by a newer trajectory codec: {}'.format(version)
+
+    return _decode_item(
+        msgpack.unpackb(bytes(buffer[len(CODEC_HEADER):]), raw=False)
+    )
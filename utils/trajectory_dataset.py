@@ -0,0 +1,91 @@
+import os
+
+import lmdb
+import numpy as np
+import torch
+
+from src.common.param import args
+from utils.trajectory_store import trajectory_key, make_episode_record
+
+
+class LMDBDatasetMixin:
+    """
+    One read-only lmdb environment per process (main process or DataLoader worker),
+    opened on first use and kept open across preloads and epochs
+    """
+    _lmdb_env = None
+    _lmdb_env_pid = None
+
+    def _get_lmdb_env(self) -> lmdb.Environment:
+        # handles inherited from the parent process through fork must not be used
+        if self._lmdb_env is None or self._lmdb_env_pid != os.getpid():
+            self._lmdb_env = lmdb.open(
+                self.lmdb_features_dir,
+                map_size=int(self.lmdb_map_size),
+                readonly=True,
+                lock=False,
+                readahead=False,
+            )
+            self._lmdb_env_pid = os.getpid()
+        return self._lmdb_env
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lmdb_env'] = None
+        state['_lmdb_env_pid'] = None
+        return state
+
+
+def get_dataloader_kwargs() -> dict:
+    num_workers = int(args.dataloader_num_workers)
+    kwargs = {
+        'num_workers': num_workers,
+        'pin_memory': torch.cuda.is_available(),
+    }
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = int(args.dataloader_prefetch_factor)
+        kwargs['persistent_workers'] = True
+    return kwargs
+
+
+def put_trajectory_episodes(train_env, ep, trajectory_id, data_it=None):
+    """
+    observations are stored once per trajectory, every instruction only keeps its tokens
+
+    :param ep: steps of (observations, prev_action, oracle_action)
+    :param data_it: dagger iteration appended to the episode keys, None for plain episode ids
+    """
+    if len(ep) <= 0:
+        return
+
+    traj_obs = {}
+    for sensor in ep[0][0].keys():
+        if sensor in ['teacher_action', 'instruction']:
+            continue
+        traj_obs[sensor] = torch.stack(
+            [torch.as_tensor(step[0][sensor]) for step in ep], dim=0
+        ).numpy()
+
+    transposed_ep = [
+        traj_obs,
+        np.array([step[1] for step in ep], dtype=np.int64),
+        np.array([step[2] for step in ep], dtype=np.int64),
+    ]
+
+    train_env.lmdb_features_writer.put(
+        trajectory_key(trajectory_id),
+        train_env.lmdb_codec.encode(transposed_ep),
+        track=False,
+    )
+    for _i, _j in enumerate(train_env.trajectory_id_2_instruction_tokens[trajectory_id]):
+        episode_id = train_env.trajectory_id_2_episode_ids[trajectory_id][_i]
+        if data_it is None:
+            lmdb_key = str(episode_id)
+        else:
+            lmdb_key = str('{}_{}'.format(episode_id, data_it))
+        train_env.lmdb_features_writer.put(
+            lmdb_key,
+            train_env.lmdb_codec.encode(
+                make_episode_record(trajectory_id, torch.as_tensor(_j).numpy())
+            ),
+        )
@@ -0,0 +1,59 @@
+import numpy as np
+
+from utils.trajectory_codec import decode
+
+
+# Layout of the teacher-forcing features lmdb:
+#   'trajectory/<trajectory_id>' -> [obs without 'instruction', prev_actions, oracle_actions]
+#   '<episode_id>'               -> {'trajectory_id': ..., 'instruction': instruction tokens}
+# so the observations of a trajectory are stored once for all of its instructions.
+# Values of older stores hold the whole episode under '<episode_id>' and are read as they are.
+TRAJECTORY_KEY_PREFIX = 'trajectory/'
+
+
+def trajectory_key(trajectory_id) -> str:
+    return '{}{}'.format(TRAJECTORY_KEY_PREFIX, trajectory_id)
+
+
+def is_trajectory_key(key: str) -> bool:
+    return key.startswith(TRAJECTORY_KEY_PREFIX)
+
+
+def make_episode_record(trajectory_id, instruction) -> dict:
+    return {
+        'trajectory_id': str(trajectory_id),
+        'instruction': np.asarray(instruction),
+    }
+
+
+def is_episode_record(value) -> bool:
+    return isinstance(value, dict) and 'trajectory_id' in value
+
+
+def join_episode(record: dict, trajectory: list) -> list:
+    """
+    Episode of `record` from its shared trajectory, the instruction is repeated for every step
+    """
+    obs, prev_actions, oracle_actions = trajectory
+
+    obs = dict(obs)
+    obs['instruction'] = np.repeat(
+        record['instruction'][np.newaxis], len(prev_actions), axis=0
+    )
+
+    return [obs, prev_actions, oracle_actions]
+
+
+def load_episode(txn, key: str, trajectory_cache: dict) -> list:
+    """
+    :param trajectory_cache: trajectory_id -> decoded trajectory, shared by the loads of one preload
+    """
+    value = decode(txn.get(str(key).encode()))
+    if not is_episode_record(value):
+        return value
+
+    trajectory_id = value['trajectory_id']
+    if trajectory_id not in trajectory_cache:
+        trajectory_cache[trajectory_id] = decode(txn.get(trajectory_key(trajectory_id).encode()))
+
+    return join_episode(value, trajectory_cache[trajectory_id])